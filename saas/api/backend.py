@@ -23,9 +23,10 @@
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from rest_framework import status
-from rest_framework.generics import RetrieveAPIView
+from rest_framework.generics import GenericAPIView, RetrieveAPIView
 from rest_framework.response import Response
 
+from ..backends.telemetry import get_telemetry
 from ..mixins import OrganizationMixin
 from .serializers import BankSerializer, CardSerializer
 
@@ -59,6 +60,7 @@ class RetrieveBankAPIView(OrganizationMixin, RetrieveAPIView):
           "balance_unit": "usd"
         }
     """
+    query_budget = 10
     serializer_class = BankSerializer
 
     def retrieve(self, request, *args, **kwargs):
@@ -87,9 +89,51 @@ class RetrieveCardAPIView(OrganizationMixin, RetrieveAPIView):
           "exp_date": "12/2015"
         }
     """
+    query_budget = 12
     serializer_class = CardSerializer
 
     def retrieve(self, request, *args, **kwargs):
         #pylint: disable=unused-argument
         return Response(
             self.organization.retrieve_card(), status=status.HTTP_200_OK)
+
+
+class ProcessorTelemetryAPIView(GenericAPIView):
+    """
+    Latency histograms (in milliseconds), error counts by exception class
+    and number of calls in flight for each method of the
+    :doc:`payment processor backend<backends>` called by the site.
+
+    **Examples
+
+    .. code-block:: http
+
+        GET /api/metrics/processor/ HTTP/1.1
+
+    responds
+
+    .. code-block:: json
+
+        {
+          "retrieve_card": {
+            "calls": 12,
+            "in_flight": 0,
+            "avg_ms": 182,
+            "latency": [{"le": "50", "count": 0},
+                        {"le": "100", "count": 2},
+                        {"le": "250", "count": 9},
+                        {"le": "500", "count": 1},
+                        {"le": "1000", "count": 0},
+                        {"le": "2500", "count": 0},
+                        {"le": "5000", "count": 0},
+                        {"le": "10000", "count": 0},
+                        {"le": "inf", "count": 0}],
+            "errors": {"ProcessorConnectionError": 1}
+          }
+        }
+    """
+    query_budget = 6
+
+    def get(self, request, *args, **kwargs):
+        #pylint: disable=unused-argument
+        return Response(get_telemetry(), status=status.HTTP_200_OK)
@@ -29,8 +29,9 @@ from rest_framework.generics import (get_object_or_404,
 from rest_framework.response import Response
 
 from .. import settings
+from ..instrumentation import instrumented
 from ..mixins import DateRangeMixin
-from ..managers.metrics import abs_monthly_balances, monthly_balances
+from ..managers.metrics import monthly_balances_by_selector
 from ..models import BalanceLine
 from .serializers import BalanceLineSerializer, MetricsSerializer
 
@@ -72,19 +73,22 @@ class BrokerBalancesAPIView(DateRangeMixin, GenericAPIView):
             ]
         }
     """
+    query_budget = 6
     serializer_class = MetricsSerializer
 
+    @instrumented('metrics.broker_balances')
     def get(self, request, *args, **kwargs): #pylint: disable=unused-argument
         result = []
         report = self.kwargs.get('report')
         unit = settings.DEFAULT_UNIT
-        for line in BalanceLine.objects.filter(report=report).order_by('rank'):
+        lines = list(
+            BalanceLine.objects.filter(report=report).order_by('rank'))
+        balances = monthly_balances_by_selector(
+            [line.selector for line in lines], until=self.ends_at)
+        for line in lines:
+            values, _unit = balances[line.selector]
             if line.is_positive:
-                balances_func = abs_monthly_balances
-            else:
-                balances_func = monthly_balances
-            values, _unit = balances_func(
-                like_account=line.selector, until=self.ends_at)
+                values = [(item[0], abs(item[1])) for item in values]
             if _unit:
                 unit = _unit
 
@@ -124,6 +128,7 @@ class BalanceLineListAPIView(ListCreateAPIView):
             ]
         }
     """
+    query_budget = 6
     serializer_class = BalanceLineSerializer
     queryset = BalanceLine.objects.all()
 
@@ -218,6 +223,7 @@ class BalanceLineDetailAPIView(RetrieveUpdateDestroyAPIView):
             "rank": 1
         }
     """
+    query_budget = 6
     serializer_class = BalanceLineSerializer
 
     def put(self, request, *args, **kwargs):
@@ -27,11 +27,12 @@ APIs for cart and checkout functionality.
 """
 from __future__ import unicode_literals
 
-import csv, logging
+import codecs, csv, logging
 
 from django.core.exceptions import MultipleObjectsReturned
 from django.contrib import messages
 from django.shortcuts import get_object_or_404
+from django.utils import six
 from django.utils.translation import ugettext_lazy as _
 from rest_framework.generics import (CreateAPIView, DestroyAPIView,
     GenericAPIView, RetrieveAPIView)
@@ -43,7 +44,7 @@ from ..backends import ProcessorError
 from ..compat import is_authenticated
 from ..docs import swagger_auto_schema, OpenAPIResponse
 from ..mixins import CartMixin, OrganizationMixin
-from ..models import CartItem
+from ..models import CartItem, Plan
 from .serializers import (ChargeSerializer, InvoicableSerializer,
     NoModelSerializer, PlanRelatedField, ValidationErrorSerializer)
 
@@ -147,6 +148,7 @@ class CartItemAPIView(CartMixin, CreateAPIView):
     payment can be made by one ``Organization`` for another ``Organization``
     to be subscribed (see :ref:`GroupBuy orders<group_buy>`).
     """
+    query_budget = 6
     #pylint: disable=no-member
 
     model = CartItem
@@ -188,6 +190,15 @@ class CartItemAPIView(CartMixin, CreateAPIView):
         return Response(cart_items[0], status=status_code, headers=headers)
 
 
+class CartItemUploadRowSerializer(serializers.ModelSerializer):
+    """
+    Serializer for a row in an uploaded file of cart items.
+    """
+    class Meta:
+        model = CartItem
+        fields = ('option', 'first_name', 'last_name', 'sync_on')
+
+
 class CartItemUploadSerializer(NoModelSerializer):
 
     created = serializers.CharField()
@@ -203,7 +214,8 @@ class CartItemUploadAPIView(CartMixin, GenericAPIView):
     This works bulk fashion of :ref:`/cart/ endpoint<api_cart>`. The
     uploaded file must be a CSV containing the fields ``first_name``,
     ``last_name`` and email. The CSV file must not contain a header
-    line, only data.
+    line, only data. Rows whose email is already in the cart are reported
+    as updated.
 
     **Examples
 
@@ -242,40 +254,50 @@ class CartItemUploadAPIView(CartMixin, GenericAPIView):
             "failed": []
         }
     """
+    query_budget = 8
     serializer_class = CartItemUploadSerializer
 
     def post(self, request, *args, **kwargs):
         #pylint:disable=unused-argument
-        plan = kwargs.get('plan')
-        filed = csv.reader(request.FILES['file'])
+        plan = get_object_or_404(Plan.objects.all(), slug=kwargs.get('plan'))
+        uploaded = request.FILES['file']
+        if not six.PY2:
+            uploaded = codecs.iterdecode(uploaded, 'utf-8')
         response = {'created': [],
                     'updated': [],
                     'failed': []}
 
-        for row in filed:
-            try:
-                first_name, last_name, email = row
-            except csv.Error:
-                response['failed'].append({'data': {'raw': row},
-                                           'error': 'Unable to parse row'})
-            else:
-                serializer = CartItemCreateSerializer(
-                    data={'plan': plan,
-                          'first_name': first_name,
+        items = []
+        try:
+            for row in csv.reader(uploaded):
+                try:
+                    first_name, last_name, email = row
+                except ValueError:
+                    response['failed'].append({'data': {'raw': row},
+                                               'error': 'Unable to parse row'})
+                    continue
+                serializer = CartItemUploadRowSerializer(
+                    data={'first_name': first_name,
                           'last_name': last_name,
                           'sync_on': email})
                 if serializer.is_valid():
-                    cart_item, created = self.insert_item(
-                        request, **serializer.data)
-                    if isinstance(cart_item, CartItem):
-                        cart_item = serializer.to_representation(cart_item)
-                    if created:
-                        response['created'].append(cart_item)
-                    else:
-                        response['updated'].append(cart_item)
+                    items += [serializer.validated_data]
                 else:
-                    response['failed'].append({'data': serializer.data,
-                                               'error': serializer.errors})
+                    response['failed'].append({
+                        'data': dict(serializer.data, plan=plan.slug),
+                        'error': serializer.errors})
+        except (csv.Error, UnicodeDecodeError) as err:
+            response['failed'].append({'data': {'raw': None},
+                                       'error': 'Unable to parse row: %s' % err})
+
+        item_serializer = CartItemCreateSerializer()
+        for cart_item, created in self.insert_items(request, plan, items):
+            if isinstance(cart_item, CartItem):
+                cart_item = item_serializer.to_representation(cart_item)
+            if created:
+                response['created'].append(cart_item)
+            else:
+                response['updated'].append(cart_item)
 
         return Response(response)
 
@@ -290,6 +312,7 @@ class CartItemDestroyAPIView(DestroyAPIView):
 
         DELETE /api/cart/open-space/ HTTP/1.1
     """
+    query_budget = 7
 
     model = CartItem
 
@@ -371,6 +394,7 @@ class CouponRedeemAPIView(GenericAPIView):
             "details": "Coupon 'LABORDAY' was successfully applied."
         }
     """
+    query_budget = 11
     serializer_class = RedeemCouponSerializer
 
     # XXX This is not a ValidationErrorSerializer but we return a message.
@@ -463,6 +487,7 @@ class CheckoutAPIView(CartMixin, OrganizationMixin,
         }]
         }
     """
+    query_budget = 16
     # XXX replace key `items` by `results` to match other serializers?
     serializer_class = OrganizationCartSerializer
 
@@ -511,8 +536,7 @@ class CheckoutAPIView(CartMixin, OrganizationMixin,
         return self.create(request, *args, **kwargs)
 
     def get_queryset(self):
-        return super(CheckoutAPIView, self).as_invoicables(
-            self.request.user, self.organization)
+        return self.as_cached_invoicables(self.request, self.organization)
 
     def get(self, request, *args, **kwargs):
         queryset = self.get_queryset()
@@ -523,7 +547,9 @@ class CheckoutAPIView(CartMixin, OrganizationMixin,
         serializer = CheckoutSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
-        queryset = self.get_queryset()
+        # Prices are recomputed rather than served from the cache
+        # such that the customer is charged what is current.
+        queryset = self.as_invoicables(request.user, self.organization)
         items_options = data.get('items')
         if items_options:
             for index, item in enumerate(items_options):
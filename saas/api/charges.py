@@ -26,7 +26,7 @@ from __future__ import unicode_literals
 from django.http import Http404
 from django.db import transaction
 from django.utils.translation import ugettext_lazy as _
-from extra_views.contrib.mixins import SearchableListMixin, SortableListMixin
+from extra_views.contrib.mixins import SortableListMixin
 from rest_framework import status
 from rest_framework.generics import (CreateAPIView, ListAPIView,
     GenericAPIView, RetrieveAPIView)
@@ -38,7 +38,8 @@ from .. import signals
 from ..docs import OpenAPIResponse, swagger_auto_schema
 from ..filters import SortableDateRangeSearchableFilterBackend
 from ..models import Charge, InsufficientFunds
-from ..mixins import ChargeMixin, DateRangeMixin, OrganizationMixin
+from ..mixins import (ChargeMixin, DateRangeMixin, OrganizationMixin,
+    SearchableListMixin)
 from ..pagination import TotalPagination
 
 #pylint: disable=no-init
@@ -88,6 +89,7 @@ class ChargeResourceView(RetrieveChargeMixin, RetrieveAPIView):
             "state": "DONE"
         }
     """
+    query_budget = 15
     serializer_class = ChargeSerializer
 
 
@@ -160,6 +162,7 @@ class ChargeListAPIView(SmartChargeListMixin,
                 "state": "DONE"
             } ...]
     """
+    query_budget = 6
     serializer_class = ChargeSerializer
     pagination_class = TotalPagination
 
@@ -250,6 +253,7 @@ class ChargeRefundAPIView(RetrieveChargeMixin, CreateAPIView):
             "state": "DONE"
         }
     """
+    query_budget = 51
     serializer_class = RefundChargeSerializer
 
     @swagger_auto_schema(responses={
@@ -308,6 +312,7 @@ class EmailChargeReceiptAPIView(RetrieveChargeMixin, GenericAPIView):
     The service sends a duplicate e-mail receipt for charge `ch_XAb124EF`
     to the e-mail address of the customer, i.e. `joe@localhost.localdomain`.
     """
+    query_budget = 15
     serializer_class = EmailChargeReceiptSerializer
 
     def post(self, request, *args, **kwargs): #pylint: disable=unused-argument
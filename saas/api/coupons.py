@@ -26,11 +26,11 @@ from __future__ import unicode_literals
 from rest_framework import serializers
 from rest_framework.generics import (ListCreateAPIView,
     RetrieveUpdateDestroyAPIView)
-from extra_views.contrib.mixins import SearchableListMixin, SortableListMixin
+from extra_views.contrib.mixins import SortableListMixin
 
 from ..filters import SortableDateRangeSearchableFilterBackend
 from ..models import Coupon
-from ..mixins import CouponMixin, ProviderMixin
+from ..mixins import CouponMixin, ProviderMixin, SearchableListMixin
 
 #pylint: disable=no-init
 #pylint: disable=old-style-class
@@ -117,6 +117,7 @@ class CouponListAPIView(SmartCouponListMixin, CouponQuerysetMixin,
             ]
         }
     """
+    query_budget = 10
     serializer_class = CouponSerializer
 
     def post(self, request, *args, **kwargs):
@@ -168,6 +169,7 @@ class CouponDetailAPIView(CouponMixin, RetrieveUpdateDestroyAPIView):
             "description": null
        }
     """
+    query_budget = 9
     serializer_class = CouponSerializer
 
     def put(self, request, *args, **kwargs):
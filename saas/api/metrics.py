@@ -28,6 +28,7 @@ from rest_framework.generics import GenericAPIView, ListAPIView
 from rest_framework.response import Response
 
 from ..compat import reverse
+from ..instrumentation import instrumented
 from .. import settings
 from ..mixins import (BeforeMixin, CartItemSmartListMixin, CouponMixin,
     ProviderMixin)
@@ -36,7 +37,7 @@ from ..utils import datetime_or_now, convert_dates_to_utc
 from .serializers import (CartItemSerializer,
     OrganizationWithSubscriptionsSerializer)
 from ..managers.metrics import (abs_monthly_balances, active_subscribers,
-    aggregate_transactions_by_period, month_periods, churn_subscribers,
+    aggregate_amounts_by_period, month_periods, churn_subscribers,
     aggregate_transactions_change_by_period, get_different_units)
 from .serializers import MetricsSerializer
 
@@ -117,8 +118,10 @@ class BalancesAPIView(BeforeMixin, ProviderMixin, GenericAPIView):
             ]
         }
     """
+    query_budget = 101
     serializer_class = MetricsSerializer
 
+    @instrumented('metrics.balances')
     def get(self, request, *args, **kwargs): #pylint: disable=unused-argument
         result = []
         unit = settings.DEFAULT_UNIT
@@ -244,8 +247,10 @@ class RevenueMetricAPIView(BeforeMixin, ProviderMixin, GenericAPIView):
             ],
         }
     """
+    query_budget = 95
     serializer_class = MetricsSerializer
 
+    @instrumented('metrics.revenue')
     def get(self, request, *args, **kwargs):
         #pylint:disable=unused-argument
         dates = convert_dates_to_utc(
@@ -259,17 +264,11 @@ class RevenueMetricAPIView(BeforeMixin, ProviderMixin, GenericAPIView):
                 orig='orig', dest='dest',
                 date_periods=dates)
 
-        _, payment_amounts, payments_unit = aggregate_transactions_by_period(
-            self.provider, Transaction.RECEIVABLE,
-            orig='dest', dest='dest',
-            orig_account=Transaction.BACKLOG,
-            orig_organization=self.provider,
-            date_periods=dates)
+        payment_amounts, payments_unit = aggregate_amounts_by_period(
+            self.provider, 'payments', date_periods=dates)
 
-        _, refund_amounts, refund_unit = aggregate_transactions_by_period(
-            self.provider, Transaction.REFUND,
-            orig='dest', dest='dest',
-            date_periods=dates)
+        refund_amounts, refund_unit = aggregate_amounts_by_period(
+            self.provider, 'refunds', date_periods=dates)
 
         units = get_different_units(table_unit, payments_unit, refund_unit)
 
@@ -332,6 +331,7 @@ class CouponUsesAPIView(CartItemSmartListMixin, CouponUsesQuerysetMixin,
             ]
         }
     """
+    query_budget = 13
     clip = False
     serializer_class = CartItemSerializer
 
@@ -441,8 +441,10 @@ class CustomerMetricAPIView(BeforeMixin, ProviderMixin, GenericAPIView):
             ]
         }
     """
+    query_budget = 69
     serializer_class = MetricsSerializer
 
+    @instrumented('metrics.customers')
     def get(self, request, *args, **kwargs):
         #pylint:disable=unused-argument
         account_title = 'Payments'
@@ -560,8 +562,10 @@ class PlanMetricAPIView(BeforeMixin, ProviderMixin, GenericAPIView):
             ]
         }
     """
+    query_budget = 66
     serializer_class = MetricsSerializer
 
+    @instrumented('metrics.plans')
     def get(self, request, *args, **kwargs):
         #pylint:disable=unused-argument
         table = []
@@ -586,6 +590,7 @@ class PlanMetricAPIView(BeforeMixin, ProviderMixin, GenericAPIView):
 
 class OrganizationListAPIView(ProviderMixin, GenericAPIView):
 
+    query_budget = 7
     model = Organization
     serializer_class = OrganizationWithSubscriptionsSerializer
 
@@ -73,6 +73,7 @@ class OrganizationDetailAPIView(OrganizationMixin,
             ]
         }
     """
+    query_budget = 13
 
     queryset = get_organization_model().objects.all()
     serializer_class = OrganizationWithSubscriptionsSerializer
@@ -187,6 +188,7 @@ class OrganizationListAPIView(OrganizationSmartListMixin,
             }]
         }
     """
+    query_budget = 7
     serializer_class = OrganizationSerializer
 
     def get_queryset(self):
@@ -270,4 +272,5 @@ class SubscribersAPIView(OrganizationSmartListMixin,
             ]
         }
     """
+    query_budget = 10
     serializer_class = OrganizationSerializer
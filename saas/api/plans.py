@@ -64,9 +64,13 @@ class PlanCreateAPIView(ProviderMixin, CreateAPIView):
             "interval": 1
         }
     """
+    query_budget = 11
 
     serializer_class = PlanSerializer
 
+    def get_queryset(self):
+        return Plan.objects.filter(organization=self.provider)
+
     def perform_create(self, serializer):
         unit = serializer.validated_data.get('unit', None)
         if unit is None:
@@ -76,7 +80,7 @@ class PlanCreateAPIView(ProviderMixin, CreateAPIView):
             else:
                 unit = settings.DEFAULT_UNIT
         serializer.save(organization=self.provider,
-            slug=self.slugify(serializer.validated_data['title']),
+            slug=PlanMixin.slugify(serializer.validated_data['title']),
             unit=unit)
 
 
@@ -104,6 +108,7 @@ class PlanResourceView(PlanMixin, RetrieveUpdateDestroyAPIView):
             "interval": 1
         }
     """
+    query_budget = 11
     serializer_class = PlanSerializer
 
     def delete(self, request, *args, **kwargs):
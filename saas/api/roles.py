@@ -295,6 +295,7 @@ class AccessibleByListAPIView(RoleSmartListMixin,
             ]
         }
     """
+    query_budget = 9
     serializer_class = AccessibleSerializer
 
     def post(self, request, *args, **kwargs):
@@ -396,6 +397,7 @@ class RoleDescriptionListCreateView(RoleDescriptionQuerysetMixin,
             ]
         }
     """
+    query_budget = 15
     serializer_class = RoleDescriptionCRUDSerializer
 
     def post(self, request, *args, **kwargs):
@@ -497,6 +499,7 @@ class RoleDescriptionDetailView(RoleDescriptionQuerysetMixin,
         }
 
     """
+    query_budget = 11
     serializer_class = RoleDescriptionCRUDSerializer
     lookup_field = 'slug'
     lookup_url_kwarg = 'role'
@@ -622,6 +625,7 @@ class RoleListAPIView(RoleSmartListMixin, RoleQuerysetMixin, ListAPIView):
             ]
         }
     """
+    query_budget = 22
     serializer_class = RoleSerializer
 
 
@@ -678,6 +682,7 @@ class RoleFilteredListAPIView(RoleSmartListMixin, RoleByDescrQuerysetMixin,
             ]
         }
     """
+    query_budget = 20
     serializer_class = RoleSerializer
 
     def create(self, request, *args, **kwargs): #pylint:disable=unused-argument
@@ -767,6 +772,7 @@ class RoleDetailAPIView(RoleMixin, DestroyAPIView):
 
         DELETE /api/profile/cowork/roles/managers/xia/ HTTP/1.1
     """
+    query_budget = 16
 
     def destroy(self, request, *args, **kwargs):
         queryset = self.get_queryset()
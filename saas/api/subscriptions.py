@@ -34,7 +34,7 @@ from ..mixins import (ChurnedQuerysetMixin, PlanMixin, ProviderMixin,
     SubscriptionMixin, SubscriptionSmartListMixin, SubscribedQuerysetMixin)
 from .. import signals
 from ..models import Subscription
-from ..utils import generate_random_slug
+from ..utils import datetime_or_now, generate_random_slug
 from .roles import OptinBase
 from .serializers import OrganizationSerializer, SubscriptionSerializer
 
@@ -105,6 +105,7 @@ class SubscriptionListAPIView(SubscriptionSmartListMixin,
             ]
         }
     """
+    query_budget = 17
     serializer_class = SubscriptionSerializer
 
     def post(self, request, *args, **kwargs):
@@ -145,6 +146,7 @@ class SubscriptionDetailAPIView(SubscriptionMixin,
             ... XXX ...
         }
     """
+    query_budget = 16
     serializer_class = SubscriptionSerializer
 
     def delete(self, request, *args, **kwargs):
@@ -237,6 +239,7 @@ class PlanSubscriptionsAPIView(SubscriptionSmartListMixin,
             ]
         }
     """
+    query_budget = 25
     serializer_class = SubscriptionSerializer
 
     def add_relations(self, organizations, user):
@@ -334,6 +337,7 @@ class PlanSubscriptionDetailAPIView(ProviderMixin, SubscriptionDetailAPIView):
             ... XXX ...
         }
     """
+    query_budget = 14
     subscriber_url_kwarg = 'subscriber'
     serializer_class = SubscriptionSerializer
 
@@ -403,6 +407,7 @@ class ActiveSubscriptionAPIView(SubscriptionSmartListMixin,
             ]
         }
     """
+    query_budget = 20
     serializer_class = SubscriptionSerializer
     filter_backends = (SortableDateRangeSearchableFilterBackend(
         SubscriptionSmartListMixin.sort_fields_aliases,
@@ -465,17 +470,22 @@ class ChurnedSubscriptionAPIView(SubscriptionSmartListMixin,
             ]
         }
     """
+    query_budget = 25
     serializer_class = SubscriptionSerializer
 
 
 class SubscriptionRequestAcceptAPIView(UpdateAPIView):
 
+    query_budget = 12
     provider_url_kwarg = 'organization'
     serializer_class = SubscriptionSerializer
 
     def get_queryset(self):
-        return Subscription.objects.active_with(
-            self.kwargs.get(self.provider_url_kwarg))
+        # ``active_with`` only returns subscriptions which were opted-in,
+        # that is without a ``request_key``.
+        return Subscription.objects.filter(
+            plan__organization__slug=self.kwargs.get(self.provider_url_kwarg),
+            ends_at__gte=datetime_or_now())
 
     @property
     def subscription(self):
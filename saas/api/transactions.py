@@ -28,7 +28,7 @@ from collections import OrderedDict
 import dateutil
 from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
-from extra_views.contrib.mixins import SearchableListMixin, SortableListMixin
+from extra_views.contrib.mixins import SortableListMixin
 from rest_framework import status, serializers
 from rest_framework.exceptions import ValidationError
 from rest_framework.generics import ListAPIView, DestroyAPIView, CreateAPIView
@@ -38,7 +38,8 @@ from rest_framework.views import APIView
 
 from .serializers import NoModelSerializer, TransactionSerializer
 from ..filters import SortableDateRangeSearchableFilterBackend
-from ..mixins import DateRangeMixin, OrganizationMixin, ProviderMixin
+from ..mixins import (DateRangeMixin, OrganizationMixin, ProviderMixin,
+    SearchableListMixin)
 from ..models import (Transaction, sum_orig_amount, Subscription,
     Organization, Plan)
 from ..backends import ProcessorError
@@ -133,9 +134,9 @@ class TransactionQuerysetMixin(object):
     def get_queryset(self):
         self.selector = self.request.GET.get('selector', None)
         if self.selector is not None:
+            accounts = Transaction.objects.get_accounts_like(self.selector)
             return Transaction.objects.filter(
-                Q(dest_account__icontains=self.selector)
-                | Q(orig_account__icontains=self.selector))
+                Q(dest_account__in=accounts) | Q(orig_account__in=accounts))
         return Transaction.objects.all()
 
 
@@ -188,6 +189,7 @@ class TransactionListAPIView(SmartTransactionListMixin,
             ]
         }
     """
+    query_budget = 22
     pagination_class = BalancePagination
     serializer_class = TransactionSerializer
 
@@ -250,6 +252,7 @@ class BillingsAPIView(SmartTransactionListMixin,
             ]
         }
     """
+    query_budget = 14
     serializer_class = TransactionSerializer
     pagination_class = StatementBalancePagination
 
@@ -315,6 +318,7 @@ class ReceivablesListAPIView(SortableListMixin, TotalAnnotateMixin,
             ]
         }
     """
+    query_budget = 10
     sort_fields_aliases = [('descr', 'description'),
                            ('dest_amount', 'amount'),
                            ('dest_organization__slug', 'dest_organization'),
@@ -390,6 +394,7 @@ class TransferListAPIView(SmartTransactionListMixin, TransferQuerysetMixin,
             ]
         }
     """
+    query_budget = 13
     serializer_class = TransactionSerializer
 
     def list(self, request, *args, **kwargs):
@@ -406,7 +411,7 @@ class OfflineTransactionSerializer(NoModelSerializer):
 
     subscription = serializers.CharField(
         help_text="The subscription the offline transaction refers to.")
-    created_at = serializers.DateTimeField(read_only=True,
+    created_at = serializers.DateTimeField(required=False,
         help_text=_("Date/time of creation (in ISO format)"))
     # XXX Shouldn't this be same format as TransactionSerializer.amount?
     amount = serializers.DecimalField(None, 2)
@@ -436,6 +441,7 @@ class ImportTransactionsAPIView(ProviderMixin, CreateAPIView):
             "descr": "Paid by check"
         }
     """
+    query_budget = 36
     serializer_class = OfflineTransactionSerializer
 
     def perform_create(self, serializer):
@@ -461,8 +467,9 @@ class ImportTransactionsAPIView(ProviderMixin, CreateAPIView):
 " or the subscription is no longer active.")})
         Transaction.objects.offline_payment(
             subscription, serializer.validated_data['amount'],
-            descr=serializer.validated_data['descr'], user=self.request.user,
-            created_at=serializer.validated_data['created_at'])
+            descr=serializer.validated_data.get('descr'),
+            user=self.request.user,
+            created_at=serializer.validated_data.get('created_at'))
 
 
 class StatementBalanceAPIView(OrganizationMixin, APIView):
@@ -508,6 +515,7 @@ class CancelStatementBalanceAPIView(OrganizationMixin, DestroyAPIView):
 
          DELETE /api/billing/cowork/balance/ HTTP/1.1
     """
+    query_budget = 12
 
     def destroy(self, request, *args, **kwargs): #pylint:disable=unused-argument
         self.organization.create_cancel_transactions(user=request.user)
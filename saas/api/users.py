@@ -23,8 +23,10 @@
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from django.contrib.auth import get_user_model
+from django.db.models import Exists, OuterRef, Q
 from rest_framework.generics import ListAPIView
 
+from .. import settings
 from .serializers import UserSerializer
 from ..mixins import ProviderMixin, UserSmartListMixin
 from ..utils import get_role_model
@@ -43,20 +45,27 @@ class RegisteredQuerysetMixin(ProviderMixin):
     model = get_user_model()
 
     def get_queryset(self):
-        # We would really like to generate this SQL but Django
-        # and LEFT OUTER JOIN is a "complicated" relationship ...
-        #   SELECT DISTINCT * FROM User LEFT OUTER JOIN (
-        #     SELECT user_id FROM Role INNER JOIN Subscription
-        #       ON Role.organization_id = Subscription.organization_id
-        #       WHERE created_at < ends_at) AS RoleSubSet
-        #     ON User.id = RoleSubSet.user_id
-        #     WHERE user_id IS NULL;
-        return self.model.objects.exclude(
+        # XXX `self.ends_at` is coming from `UserSmartListMixin`
+        if settings.SUBSCRIBER_FLAGS:
+            #   SELECT * FROM User LEFT OUTER JOIN SubscriberFlag
+            #     ON User.id = SubscriberFlag.user_id
+            #     WHERE SubscriberFlag.user_id IS NULL
+            #       OR SubscriberFlag.subscribed_at >= ends_at;
+            queryset = self.model.objects.filter(
+                Q(subscriber_flag__isnull=True)
+                | Q(subscriber_flag__subscribed_at__gte=self.ends_at))
+        else:
+            #   SELECT * FROM User WHERE NOT EXISTS (
+            #     SELECT 1 FROM Role INNER JOIN Subscription
+            #       ON Role.organization_id = Subscription.organization_id
+            #       WHERE Role.user_id = User.id AND created_at < ends_at);
             # OK to use filter because we want to see all users here.
-            # XXX `self.ends_at` is coming from `UserSmartListMixin`
-            pk__in=get_role_model().objects.filter(
-            organization__subscription__created_at__lt=self.ends_at).values(
-            'user')).order_by('-date_joined', 'last_name').distinct()
+            queryset = self.model.objects.annotate(
+                has_subscription=Exists(get_role_model().objects.filter(
+                user=OuterRef('pk'),
+                organization__subscription__created_at__lt=self.ends_at))
+            ).filter(has_subscription=False)
+        return queryset.order_by('-date_joined', 'last_name')
 
 
 class RegisteredBaseAPIView(RegisteredQuerysetMixin, ListAPIView):
@@ -100,6 +109,7 @@ class RegisteredAPIView(UserSmartListMixin, RegisteredBaseAPIView):
             ]
         }
     """
+    query_budget = 7
     serializer_class = UserSerializer
 
 
@@ -148,4 +158,5 @@ class UserListAPIView(UserSmartListMixin, UserQuerysetMixin, ListAPIView):
             ]
         }
     """
+    query_budget = 7
     serializer_class = UserSerializer
@@ -92,4 +92,7 @@ def get_processor_backend(provider):
         processor_backend = func(provider)
     else:
         processor_backend = load_backend(settings.PROCESSOR['BACKEND'])
+    if settings.INSTRUMENTATION.get('PROCESSOR_TELEMETRY', False):
+        from .telemetry import TelemetryBackendProxy
+        processor_backend = TelemetryBackendProxy(processor_backend)
     return processor_backend
@@ -67,7 +67,8 @@ class FakeProcessorBackend(object):
 
     @staticmethod
     def create_charge(customer, amount, unit,
-                    broker=None, descr=None, stmt_descr=None, created_at=None):
+                    broker=None, descr=None, stmt_descr=None, created_at=None,
+                    idempotency_key=None):
         #pylint: disable=too-many-arguments,unused-argument
         created_at = datetime_or_now(created_at)
         receipt_info = {
@@ -81,11 +82,13 @@ class FakeProcessorBackend(object):
         return (charge_key, created_at, receipt_info)
 
     def create_charge_on_card(self, card, amount, unit,
-                    broker=None, descr=None, stmt_descr=None, created_at=None):
+                    broker=None, descr=None, stmt_descr=None, created_at=None,
+                    idempotency_key=None):
         #pylint: disable=too-many-arguments,unused-argument
         return self.create_charge(card, amount, unit,
                     broker=broker, descr=descr,
-                    stmt_descr=descr, created_at=created_at)
+                    stmt_descr=descr, created_at=created_at,
+                    idempotency_key=idempotency_key)
 
     @staticmethod
     def create_transfer(provider, amount, unit, descr=None):
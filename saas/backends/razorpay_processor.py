@@ -83,7 +83,8 @@ class RazorpayBackend(object):
         return distribute_amount, distribute_unit, fee_amount, fee_unit
 
     def create_charge(self, customer, amount, unit,
-                    broker=None, descr=None, stmt_descr=None, created_at=None):
+                    broker=None, descr=None, stmt_descr=None, created_at=None,
+                    idempotency_key=None):
         #pylint: disable=too-many-arguments,unused-argument
         """
         Create a charge on the default card associated to the customer.
@@ -94,7 +95,8 @@ class RazorpayBackend(object):
         raise NotImplementedError()
 
     def create_charge_on_card(self, card, amount, unit,
-                    broker=None, descr=None, stmt_descr=None, created_at=None):
+                    broker=None, descr=None, stmt_descr=None, created_at=None,
+                    idempotency_key=None):
         #pylint: disable=too-many-arguments,unused-argument
         LOGGER.debug('create_charge_on_card(amount=%s, unit=%s, descr=%s)',
             amount, unit, descr)
@@ -62,10 +62,11 @@ Edit the redirect_url and copy/paste the keys into your project settings.py
 """
 from __future__ import unicode_literals
 
-import datetime, logging, re
+import datetime, json, logging, re
 from hashlib import sha512
 from base64 import b64encode
 
+from django.db import transaction
 from django.utils import six
 from django.utils.translation import ugettext_lazy as _
 import requests, stripe
@@ -78,6 +79,9 @@ from ...utils import (datetime_to_utctimestamp, utctimestamp_to_datetime,
 
 LOGGER = logging.getLogger(__name__)
 
+# Number of objects requested from Stripe per page (Stripe maximum is 100).
+PAGE_SIZE = 100
+
 
 class StripeBackend(object):
 
@@ -143,27 +147,47 @@ class StripeBackend(object):
         return kwargs
 
 
+    @staticmethod
+    def _list_pages(list_func, starting_after=None, prefetch=False,
+                    **kwargs):
+        """
+        Generates the pages of Stripe objects returned by *list_func*,
+        following the ``starting_after`` cursor.
+
+        When *prefetch* is ``True``, the next page is requested before
+        the current one is returned, such that the caller can delete
+        the objects it is handed (Stripe rejects a deleted object
+        as a cursor).
+        """
+        if starting_after:
+            kwargs.update({'starting_after': starting_after})
+        response = list_func(limit=PAGE_SIZE, **kwargs)
+        while response.data:
+            next_response = None
+            if prefetch and response.has_more:
+                kwargs.update({'starting_after': response.data[-1].id})
+                next_response = list_func(limit=PAGE_SIZE, **kwargs)
+            yield response.data
+            if not response.has_more:
+                break
+            if next_response is None:
+                kwargs.update({'starting_after': response.data[-1].id})
+                next_response = list_func(limit=PAGE_SIZE, **kwargs)
+            response = next_response
+
     def list_customers(self, org_pat=r'.*', broker=None):
         """
-        Returns a list of Stripe.Customer objects whose description field
+        Generates the Stripe.Customer objects whose description field
         matches *org_pat*.
         """
         kwargs = self._prepare_charge_request(broker)
-        customers = []
-        nb_customers_listed = 0
-        response = stripe.Customer.list(**kwargs)
-        all_custs = response['data']
-        while all_custs:
-            for cust in all_custs:
+        for customers in self._list_pages(
+                stripe.Customer.list, prefetch=True, **kwargs):
+            for cust in customers:
                 # We use the description field to store extra information
                 # that connects the Stripe customer back to our database.
-                if re.match(org_pat, cust.description):
-                    customers.append(cust)
-            nb_customers_listed = nb_customers_listed + len(all_custs)
-            response = stripe.Customer.list(
-                offset=nb_customers_listed, **kwargs)
-            all_custs = response['data']
-        return customers
+                if re.match(org_pat, cust.description or ""):
+                    yield cust
 
     def charge_distribution(self, charge,
                             refunded=0, unit=settings.DEFAULT_UNIT):
@@ -251,7 +275,7 @@ class StripeBackend(object):
 
     def _create_charge(self, amount, unit,
             broker=None, descr=None, stmt_descr=None,
-            customer=None, card=None, created_at=None):
+            customer=None, card=None, created_at=None, idempotency_key=None):
         #pylint: disable=too-many-arguments
         assert customer is not None or card is not None
         kwargs = self._prepare_charge_request(broker)
@@ -269,9 +293,11 @@ class StripeBackend(object):
         if stmt_descr is None and broker is not None:
             stmt_descr = broker.printable_name
 
-        key = self.generate_idempotent_key(amount,
-            unit, broker, descr, stmt_descr, created_at,
-            customer, card)
+        key = idempotency_key
+        if not key:
+            key = self.generate_idempotent_key(amount,
+                unit, broker, descr, stmt_descr, created_at,
+                customer, card)
         if key:
             kwargs.update({'idempotency_key': key})
         try:
@@ -308,19 +334,24 @@ class StripeBackend(object):
         return (processor_key, created_at, receipt_info)
 
     def create_charge(self, customer, amount, unit,
-                    broker=None, descr=None, stmt_descr=None, created_at=None):
+                    broker=None, descr=None, stmt_descr=None, created_at=None,
+                    idempotency_key=None):
         #pylint: disable=too-many-arguments
         """
         Create a charge on the default card associated to the customer.
 
-        *stmt_descr* can only be 15 characters maximum.
+        *stmt_descr* can only be 15 characters maximum. *idempotency_key*
+        is passed to Stripe such that a retried request does not create
+        a second charge.
         """
         return self._create_charge(amount, unit,
             broker=broker, descr=descr, stmt_descr=stmt_descr,
-            customer=customer.processor_card_key, created_at=created_at)
+            customer=customer.processor_card_key, created_at=created_at,
+            idempotency_key=idempotency_key)
 
     def create_charge_on_card(self, card, amount, unit,
-                    broker=None, descr=None, stmt_descr=None, created_at=None):
+                    broker=None, descr=None, stmt_descr=None, created_at=None,
+                    idempotency_key=None):
         #pylint: disable=too-many-arguments
         """
         Create a charge on a specified card.
@@ -329,7 +360,8 @@ class StripeBackend(object):
         """
         return self._create_charge(amount, unit,
             broker=broker, descr=descr, stmt_descr=stmt_descr,
-            card=card, created_at=created_at)
+            card=card, created_at=created_at,
+            idempotency_key=idempotency_key)
 
     def create_transfer(self, provider, amount, currency, descr=None):
         """
@@ -555,33 +587,91 @@ class StripeBackend(object):
 
         return charge
 
+    def process_webhook_event(self, webhook_event):
+        """
+        Updates the database according to a ``WebhookEvent`` recorded
+        by the ``StripeWebhook`` view.
+        """
+        from ...models import Charge, get_broker
+        from ...utils import get_organization_model
+        event = stripe.Event.construct_from(
+            json.loads(webhook_event.payload), self.priv_key)
+        event_type = event.type
+        if event_type in ['charge.succeeded', 'charge.failed',
+                          'charge.refunded', 'charge.captured']:
+            # ``Charge.DoesNotExist`` will be retried later on. Stripe might
+            # have posted the event before the charge was committed.
+            charge = Charge.objects.get(processor_key=event.data.object.id)
+            self._update_charge_state(charge,
+                stripe_charge=event.data.object, event_type=event_type)
+        elif event_type in ['charge.dispute.created',
+                'charge.dispute.updated', 'charge.dispute.closed']:
+            if event_type == 'charge.dispute.closed':
+                if event.data.object.status == 'won':
+                    event_type = 'charge.dispute.closed.won'
+                elif event.data.object.status == 'lost':
+                    event_type = 'charge.dispute.closed.lost'
+            charge = Charge.objects.get(processor_key=event.data.object.charge)
+            self._update_charge_state(charge, event_type=event_type)
+        elif event_type.startswith('customer.'):
+            # Card information cached by ``Organization.retrieve_card``
+            # might be stale.
+            for organization in get_organization_model().objects.filter(
+                    processor_card_key=get_event_object_key(event)):
+                organization.invalidate_processor_cache()
+        elif (event_type.startswith('account.')
+              or event_type.startswith('balance.')
+              or event_type.startswith('payout.')):
+            # Bank information cached by ``Organization.retrieve_bank``
+            # might be stale.
+            account_key = event.get('account')
+            if account_key:
+                organizations = get_organization_model().objects.filter(
+                    processor_deposit_key=account_key)
+            else:
+                organizations = [get_broker()]
+            for organization in organizations:
+                organization.invalidate_processor_cache()
+
     def reconcile_transfers(self, provider, created_at,
                             limit_to_one_request=False, dry_run=False):
+        """
+        Creates the withdrawal ``Transaction`` for payouts to *provider*
+        created after *created_at*.
+
+        Transactions are committed one page of payouts at a time. Payouts
+        already recorded are skipped, so an interrupted reconciliation
+        can safely be run again from the same *created_at*.
+
+        Returns the date/time of the most recent payout reconciled,
+        or ``None`` if there were none.
+        """
         kwargs = self._prepare_transfer_request(provider)
         timestamp = datetime_to_utctimestamp(created_at)
         LOGGER.info("reconcile transfers from Stripe at %s", created_at)
+        reconciled_at = None
         try:
-            offset = 0
-            transfers = stripe.Payout.list(
-                created={'gt': timestamp}, status='paid',
-                offset=offset, **kwargs)
-            while transfers.data:
-                for transfer in transfers.data:
-                    created_at = utctimestamp_to_datetime(transfer.created)
-                    descr = (transfer.description if transfer.description
-                        else "STRIPE TRANSFER %s" % str(transfer.id))
-                    provider.create_withdraw_transactions(
-                        transfer.id, transfer.amount, transfer.currency,
-                        descr, created_at=created_at, dry_run=dry_run)
+            for transfers in self._list_pages(stripe.Payout.list,
+                    created={'gt': timestamp}, status='paid', **kwargs):
+                with transaction.atomic():
+                    for transfer in transfers:
+                        created_at = utctimestamp_to_datetime(
+                            transfer.created)
+                        descr = (transfer.description if transfer.description
+                            else "STRIPE TRANSFER %s" % str(transfer.id))
+                        provider.create_withdraw_transactions(
+                            transfer.id, transfer.amount, transfer.currency,
+                            descr, created_at=created_at, dry_run=dry_run)
+                        if not reconciled_at or created_at > reconciled_at:
+                            reconciled_at = created_at
+                LOGGER.info("reconciled transfers for %s up to %s",
+                    provider, transfers[-1].id)
                 if limit_to_one_request:
                     break
-                offset = offset + len(transfers.data)
-                transfers = stripe.Payout.list(
-                    created={'gt': timestamp}, status='paid',
-                    offset=offset, **kwargs)
         except stripe.error.StripeError as err:
             LOGGER.exception(err)
             raise ProcessorError(str(err), backend_except=err)
+        return reconciled_at
 
     @staticmethod
     def dispute_fee(amount): #pylint: disable=unused-argument
@@ -617,3 +707,22 @@ class StripeBackend(object):
             hsh.update('|'.join(items).encode())
             key = b64encode(hsh.digest()).decode()
         return key
+
+
+def get_event_object_key(event):
+    """
+    Returns the key of the Stripe object (charge or customer) *event*
+    refers to, such that events for the same object are processed in order.
+    """
+    event_type = event.type
+    obj = event.data.object
+    if event_type.startswith('charge.dispute.'):
+        return obj.get('charge')
+    if event_type.startswith('charge.'):
+        return obj.get('id')
+    if event_type in ('customer.created', 'customer.updated',
+                      'customer.deleted'):
+        return obj.get('id')
+    if event_type.startswith('customer.'):
+        return obj.get('customer')
+    return None
@@ -24,15 +24,16 @@
 
 import logging
 
-from django.shortcuts import get_object_or_404
 from django.views.generic import RedirectView
 from rest_framework.response import Response
 from rest_framework.views import APIView
 import stripe
 
 from ... import settings
-from ...models import get_broker
+from ...models import WebhookEvent, get_broker
+from ...utils import utctimestamp_to_datetime
 from .. import get_processor_backend
+from .base import get_event_object_key
 
 
 LOGGER = logging.getLogger(__name__)
@@ -71,13 +72,14 @@ class StripeProcessorRedirectView(RedirectView):
 class StripeWebhook(APIView):
     """
     Answers callback from Stripe.
+
+    Events are verified and stored in the ``WebhookEvent`` inbox, deduplicated
+    on their Stripe id, then acknowledged right away.
     """
     swagger_schema = None
 
     def post(self, request, *args, **kwargs):
         #pylint:disable=unused-argument,no-self-use
-        from saas.models import Charge
-
         processor_backend = get_processor_backend(get_broker())
         stripe.api_key = processor_backend.priv_key
 
@@ -100,25 +102,12 @@ class StripeWebhook(APIView):
                 'event_id': event.id,
                 'request': request})
 
-        event_type = event.type
-        if event_type in ['charge.succeeded', 'charge.failed',
-                          'charge.refunded', 'charge.captured']:
-            charge = get_object_or_404(Charge,
-                processor_key=event.data.object.id)
-            #pylint:disable=protected-access
-            processor_backend._update_charge_state(charge,
-                stripe_charge=event.data.object, event_type=event_type)
-        elif event_type in ['charge.dispute.created',
-                'charge.dispute.updated', 'charge.dispute.closed']:
-            if event_type == 'charge.dispute.closed':
-                if event.data.object.status == 'won':
-                    event_type = 'charge.dispute.closed.won'
-                elif event.data.object.status == 'lost':
-                    event_type = 'charge.dispute.closed.lost'
-            charge = get_object_or_404(Charge,
-                processor_key=event.data.object.charge)
-            #pylint:disable=protected-access
-            processor_backend._update_charge_state(
-                charge, event_type=event_type)
+        # The event is processed by the ``process_webhook_events`` command.
+        _, created = WebhookEvent.objects.record(event.id, event.type,
+            payload.decode('utf-8') if isinstance(payload, bytes) else payload,
+            object_key=get_event_object_key(event),
+            created_at=utctimestamp_to_datetime(event.created))
+        if not created:
+            LOGGER.info("Stripe event %s was already received", event.id)
 
         return Response("OK")
@@ -0,0 +1,242 @@
+# Copyright (c) 2018, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Latency and error telemetry for processor backends.
+
+``get_processor_backend`` wraps the backend in a ``TelemetryBackendProxy``
+which records, for each call to a processor API method, a latency
+histogram, error counts by exception class and the number of calls
+in flight.
+
+Telemetry is off by default. Set ``INSTRUMENTATION['PROCESSOR_TELEMETRY']``
+to ``True`` to turn it on.
+
+Counters are kept in the Django cache named by ``INSTRUMENTATION['CACHE']``.
+That cache must be shared by all processes serving the site (ex: memcached
+or redis). With a per-process cache such as ``LocMemCache``, each worker
+only reports the calls it made itself.
+
+A call still in flight is counted in a time-windowed key. If the process
+making the call dies before it returns, the count expires after at most
+two ``IN_FLIGHT_TIMEOUT`` windows instead of staying in flight forever.
+"""
+from __future__ import unicode_literals
+
+import inspect, time
+from functools import wraps
+
+from django.core.cache import caches
+
+from .. import settings
+from ..instrumentation import timed
+
+
+# Methods which issue requests to the processor API.
+TRACKED_METHODS = (
+    'connect_auth',
+    'create_charge',
+    'create_charge_on_card',
+    'create_or_update_card',
+    'create_transfer',
+    'get_processor_charge',
+    'list_customers',
+    'reconcile_transfers',
+    'refund_charge',
+    'retrieve_bank',
+    'retrieve_card',
+    'retrieve_charge',
+    'update_bank',
+)
+
+# Upper bounds (in milliseconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+KEY_PREFIX = 'saas.processor_telemetry'
+
+# Width (in seconds) of the windows calls in flight are counted in.
+IN_FLIGHT_TIMEOUT = 300
+
+
+def _get_cache():
+    return caches[settings.INSTRUMENTATION.get('CACHE', 'default')]
+
+
+def _incr(cache, key, delta=1, timeout=None):
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # The key does not exist yet.
+        if not cache.add(key, delta, timeout=timeout):
+            cache.incr(key, delta)
+
+
+def _key(method, *parts):
+    return '.'.join((KEY_PREFIX, method) + parts)
+
+
+def _bucket(duration_ms):
+    for upper in LATENCY_BUCKETS:
+        if duration_ms <= upper:
+            return str(upper)
+    return 'inf'
+
+
+def _in_flight_key(method, at_time):
+    return _key(method, 'in_flight', str(int(at_time // IN_FLIGHT_TIMEOUT)))
+
+
+def _in_flight_keys(method, at_time=None):
+    """
+    Returns the keys for the current and the previous in-flight windows.
+    """
+    if at_time is None:
+        at_time = time.time()
+    return [_in_flight_key(method, at_time - IN_FLIGHT_TIMEOUT),
+        _in_flight_key(method, at_time)]
+
+
+def record_call_started(method, start):
+    _incr(_get_cache(), _in_flight_key(method, start),
+        timeout=2 * IN_FLIGHT_TIMEOUT)
+
+
+def record_call_ended(method, start, error=None):
+    cache = _get_cache()
+    duration_ms = int((time.time() - start) * 1000)
+    try:
+        cache.decr(_in_flight_key(method, start))
+    except ValueError:
+        # The in-flight window has already expired.
+        pass
+    _incr(cache, _key(method, 'calls'))
+    _incr(cache, _key(method, 'total_ms'), duration_ms)
+    _incr(cache, _key(method, 'latency', _bucket(duration_ms)))
+    if error is not None:
+        error_class = error.__class__.__name__
+        errors_key = _key(method, 'error_classes')
+        error_classes = cache.get(errors_key, [])
+        if error_class not in error_classes:
+            cache.set(errors_key, error_classes + [error_class], None)
+        _incr(cache, _key(method, 'errors', error_class))
+
+
+def get_telemetry():
+    """
+    Returns the counters recorded for each processor API method.
+    """
+    cache = _get_cache()
+    buckets = [str(upper) for upper in LATENCY_BUCKETS] + ['inf']
+    results = {}
+    for method in TRACKED_METHODS:
+        error_classes = cache.get(_key(method, 'error_classes'), [])
+        in_flight_keys = _in_flight_keys(method)
+        keys = ([_key(method, name) for name in ('calls', 'total_ms')]
+            + in_flight_keys
+            + [_key(method, 'latency', bucket) for bucket in buckets]
+            + [_key(method, 'errors', error_class)
+               for error_class in error_classes])
+        values = cache.get_many(keys)
+        calls = values.get(_key(method, 'calls'), 0)
+        in_flight = sum([values.get(key, 0) for key in in_flight_keys])
+        if not calls and not in_flight:
+            continue
+        total_ms = values.get(_key(method, 'total_ms'), 0)
+        results[method] = {
+            'calls': calls,
+            'in_flight': in_flight,
+            'avg_ms': total_ms // calls if calls else 0,
+            'latency': [{'le': bucket,
+                'count': values.get(_key(method, 'latency', bucket), 0)}
+                for bucket in buckets],
+            'errors': {error_class: values.get(
+                _key(method, 'errors', error_class), 0)
+                for error_class in error_classes}
+        }
+    return results
+
+
+def reset_telemetry():
+    cache = _get_cache()
+    buckets = [str(upper) for upper in LATENCY_BUCKETS] + ['inf']
+    keys = []
+    for method in TRACKED_METHODS:
+        keys += [_key(method, name) for name in (
+            'calls', 'total_ms', 'error_classes')]
+        keys += _in_flight_keys(method)
+        keys += [_key(method, 'latency', bucket) for bucket in buckets]
+        keys += [_key(method, 'errors', error_class) for error_class
+            in cache.get(_key(method, 'error_classes'), [])]
+    cache.delete_many(keys)
+
+
+def _track_generator(method, generator, start, processor):
+    error = None
+    try:
+        with timed('processor.%s' % method, processor=processor):
+            for item in generator:
+                yield item
+    except Exception as err:
+        error = err
+        raise
+    finally:
+        record_call_ended(method, start, error=error)
+
+
+class TelemetryBackendProxy(object):
+    """
+    Forwards attribute access to the wrapped processor *backend*, recording
+    telemetry for the methods in ``TRACKED_METHODS``.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if name not in TRACKED_METHODS or not callable(attr):
+            return attr
+        processor = self.backend.__class__.__name__
+
+        @wraps(attr)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            record_call_started(name, start)
+            result = None
+            error = None
+            try:
+                with timed('processor.%s' % name, processor=processor):
+                    result = attr(*args, **kwargs)
+            except Exception as err:
+                error = err
+                raise
+            finally:
+                if error is not None or not inspect.isgenerator(result):
+                    record_call_ended(name, start, error=error)
+            if inspect.isgenerator(result):
+                # The requests to the processor happen while iterating.
+                return _track_generator(name, result, start, processor)
+            return result
+        return wrapper
@@ -0,0 +1,231 @@
+# Copyright (c) 2018, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Lightweight instrumentation of hot paths.
+
+``timed`` (context manager) and ``instrumented`` (decorator) measure
+the wall time of a block of code, and optionally the number of SQL queries
+it issued, then emit an event to the sink configured
+in ``settings.SAAS['INSTRUMENTATION']['SINK']``. When no sink is configured
+(the default) both are no-ops.
+
+Example::
+
+    with timed('processor.create_charge', processor='stripe'):
+        processor_backend.create_charge(...)
+
+Events are dictionaries with the following keys: ``event`` (the name),
+``duration`` (in seconds), ``queries`` (``None`` unless
+``COUNT_QUERIES`` is set), ``error`` (the exception class name
+when the block raised) and any extra tags passed to ``timed``.
+"""
+from __future__ import unicode_literals
+
+import logging, socket, time
+from functools import wraps
+
+from django.db import connection
+from django.utils import six
+
+from . import settings
+from .compat import import_string
+
+
+LOGGER = logging.getLogger(__name__)
+
+_SINK = None
+_SINK_LOADED = False
+
+
+class LoggingSink(object):
+    """
+    Emits events as structured log records on the ``saas.instrumentation``
+    logger.
+    """
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def emit(self, event):
+        LOGGER.log(self.level, "%s in %.3fs (%s queries)", event['event'],
+            event['duration'], event['queries'], extra=event)
+
+
+class StatsdSink(object):
+    """
+    Sends events as StatsD timers (``|ms``) over UDP. The number of queries
+    is sent as a separate ``.queries`` timer and errors increment
+    an ``.errors`` counter.
+    """
+
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (
+            host or settings.INSTRUMENTATION.get('STATSD_HOST', 'localhost'),
+            int(port or settings.INSTRUMENTATION.get('STATSD_PORT', 8125)))
+        if prefix is None:
+            prefix = settings.INSTRUMENTATION.get('PREFIX', 'saas')
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, event):
+        name = event['event'].replace('-', '_')
+        if self.prefix:
+            name = '%s.%s' % (self.prefix, name)
+        packets = ["%s:%d|ms" % (name, int(event['duration'] * 1000))]
+        if event['queries'] is not None:
+            packets += ["%s.queries:%d|ms" % (name, event['queries'])]
+        if event['error']:
+            packets += ["%s.errors:1|c" % name]
+        try:
+            self.sock.sendto('\n'.join(packets).encode('utf-8'), self.address)
+        except socket.error as err:
+            # Metrics are best effort. They should never break the site.
+            LOGGER.debug("cannot send metrics to %s: %s", self.address, err)
+
+
+class MemorySink(object):
+    """
+    Keeps events in memory (useful in tests).
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events += [event]
+
+    def clear(self):
+        self.events = []
+
+
+def get_sink():
+    """
+    Returns the sink configured in the settings or ``None``
+    when instrumentation is disabled.
+    """
+    global _SINK, _SINK_LOADED #pylint:disable=global-statement
+    if not _SINK_LOADED:
+        sink = settings.INSTRUMENTATION.get('SINK')
+        if sink is not None:
+            if isinstance(sink, six.string_types):
+                sink = import_string(sink)
+            if isinstance(sink, type):
+                sink = sink()
+        _SINK = sink
+        _SINK_LOADED = True
+    return _SINK
+
+
+def set_sink(sink):
+    """
+    Replaces the sink events are emitted to. ``None`` disables
+    instrumentation.
+    """
+    global _SINK, _SINK_LOADED #pylint:disable=global-statement
+    _SINK = sink
+    _SINK_LOADED = True
+
+
+class _NoopTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+class _Timer(object):
+
+    def __init__(self, sink, name, tags):
+        self.sink = sink
+        self.name = name
+        self.tags = tags
+        self.count_queries = settings.INSTRUMENTATION.get(
+            'COUNT_QUERIES', False)
+        self.start = None
+        self.start_queries = None
+        self.force_debug_cursor = None
+
+    def __enter__(self):
+        if self.count_queries:
+            self.force_debug_cursor = connection.force_debug_cursor
+            connection.force_debug_cursor = True
+            if (len(connection.queries_log)
+                == connection.queries_log.maxlen):
+                # Once full, the length of the log does not change anymore.
+                connection.queries_log.clear()
+            self.start_queries = len(connection.queries_log)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        duration = time.time() - self.start
+        nb_queries = None
+        if self.count_queries:
+            nb_queries = len(connection.queries_log) - self.start_queries
+            connection.force_debug_cursor = self.force_debug_cursor
+        event = {'event': self.name, 'duration': duration,
+            'queries': nb_queries,
+            'error': exc_type.__name__ if exc_type is not None else None}
+        event.update(self.tags)
+        try:
+            self.sink.emit(event)
+        except Exception as err: #pylint:disable=broad-except
+            LOGGER.debug("cannot emit %s: %s", self.name, err)
+        return False
+
+
+def timed(name, **tags):
+    """
+    Context manager that emits a timing event named *name* when the block
+    exits.
+    """
+    sink = get_sink()
+    if sink is None:
+        return _NOOP_TIMER
+    return _Timer(sink, name, tags)
+
+
+def instrumented(name=None):
+    """
+    Decorator that emits a timing event for each call of the decorated
+    function. *name* defaults to the module and name of the function.
+    """
+    def decorator(func):
+        event_name = name or '%s.%s' % (func.__module__, func.__name__)
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            sink = get_sink()
+            if sink is None:
+                return func(*args, **kwargs)
+            with _Timer(sink, event_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -22,12 +22,23 @@
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import datetime
+import bisect, calendar, datetime, logging
+from array import array
 
 from django.db import connection
+from django.utils import six
+from django.utils.translation import ugettext_lazy as _
 
 from .humanize import as_money
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+LOGGER = logging.getLogger(__name__)
+
 
 def read_balances(account, until=datetime.datetime.now()):
     """Balances associated to customer accounts.
@@ -84,3 +95,248 @@ def export(output, transactions):
         'description': transaction.descr,
         'dest': dest, 'dest_amount': dest_amount,
         'orig': orig, 'orig_amount': orig_amount})
+
+
+def _to_timestamp(dtime):
+    return calendar.timegm(dtime.utctimetuple())
+
+
+class LedgerSnapshot(object):
+    """
+    Compact columnar copy of the ``Transaction`` ledger for analytics.
+
+    Columns are stored in ``array.array`` (8 bytes per amount or timestamp,
+    4 bytes per dictionary-encoded account, organization or unit) instead
+    of ``Transaction`` instances. Group-by sums use numpy when it is
+    installed.
+
+    Example::
+
+        snapshot = LedgerSnapshot.load()
+        snapshot.sum_by(('month', 'account'), side='dest')
+        snapshot.monthly_balances(organization=provider, account='Funds')
+    """
+    FIELDS = ('pk', 'created_at',
+        'orig_account', 'orig_organization_id', 'orig_amount', 'orig_unit',
+        'dest_account', 'dest_organization_id', 'dest_amount', 'dest_unit')
+
+    def __init__(self):
+        self.created_at = array('q')  # seconds since Epoch (UTC)
+        self.month = array('i')       # year * 12 + month - 1 (UTC)
+        self.accounts = []
+        self.organizations = []
+        self.units = []
+        self._codes = {'accounts': {}, 'organizations': {}, 'units': {}}
+        for side in ('orig', 'dest'):
+            setattr(self, '%s_account' % side, array('i'))
+            setattr(self, '%s_organization' % side, array('i'))
+            setattr(self, '%s_amount' % side, array('q'))
+            setattr(self, '%s_unit' % side, array('i'))
+
+    def __len__(self):
+        return len(self.created_at)
+
+    def _encode(self, dictionary, value):
+        codes = self._codes[dictionary]
+        code = codes.get(value)
+        if code is None:
+            code = len(codes)
+            codes[value] = code
+            getattr(self, dictionary).append(value)
+        return code
+
+    def append(self, row):
+        """
+        Appends a row of ``LedgerSnapshot.FIELDS`` values.
+        """
+        (_, created_at, orig_account, orig_organization_id, orig_amount,
+         orig_unit, dest_account, dest_organization_id, dest_amount,
+         dest_unit) = row
+        self.created_at.append(_to_timestamp(created_at))
+        self.month.append(created_at.year * 12 + created_at.month - 1)
+        self.orig_account.append(self._encode('accounts', orig_account))
+        self.orig_organization.append(
+            self._encode('organizations', orig_organization_id))
+        self.orig_amount.append(orig_amount)
+        self.orig_unit.append(self._encode('units', orig_unit))
+        self.dest_account.append(self._encode('accounts', dest_account))
+        self.dest_organization.append(
+            self._encode('organizations', dest_organization_id))
+        self.dest_amount.append(dest_amount)
+        self.dest_unit.append(self._encode('units', dest_unit))
+
+    @classmethod
+    def load(cls, queryset=None, chunk_size=10000):
+        """
+        Loads the ledger columns of the transactions in *queryset*
+        (all transactions by default) in chunks of *chunk_size* rows.
+        """
+        if queryset is None:
+            from .models import Transaction
+            queryset = Transaction.objects.all()
+        snapshot = cls()
+        last_pk = None
+        while True:
+            chunk = queryset.order_by('pk')
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            rows = list(chunk.values_list(*cls.FIELDS)[:chunk_size])
+            for row in rows:
+                snapshot.append(row)
+            if len(rows) < chunk_size:
+                break
+            last_pk = rows[-1][0]
+        LOGGER.debug("loaded %d transactions in ledger snapshot", len(snapshot))
+        return snapshot
+
+    def _mask(self, side, organization=None, account=None):
+        """
+        Returns the indices of rows matching *organization*
+        and *account* on *side*, or ``None`` for all rows.
+        """
+        tests = []
+        if organization is not None:
+            code = self._codes['organizations'].get(
+                getattr(organization, 'pk', organization), -1)
+            tests += [(getattr(self, '%s_organization' % side), code)]
+        if account is not None:
+            code = self._codes['accounts'].get(account, -1)
+            tests += [(getattr(self, '%s_account' % side), code)]
+        if not tests:
+            return None
+        if numpy is not None:
+            mask = numpy.ones(len(self), dtype=bool)
+            for column, code in tests:
+                mask &= numpy.frombuffer(column, dtype=column.typecode) == code
+            return numpy.flatnonzero(mask)
+        return [idx for idx in six.moves.range(len(self))
+            if all([column[idx] == code for column, code in tests])]
+
+    def sum_by(self, keys, side='dest', organization=None, account=None):
+        """
+        Returns a dictionary of the sum of *side* amounts grouped by
+        *keys*, a tuple made of 'month', 'account', 'organization'
+        and 'unit'. Months are returned as (year, month) and accounts,
+        organizations (as pk) and units decoded.
+        """
+        columns = []
+        for key in keys:
+            if key == 'month':
+                columns += [self.month]
+            else:
+                columns += [getattr(self, '%s_%s' % (side, key))]
+        amounts = getattr(self, '%s_amount' % side)
+        indices = self._mask(side, organization=organization, account=account)
+        results = {}
+        if numpy is not None:
+            if indices is None:
+                indices = numpy.arange(len(self))
+            codes = [numpy.frombuffer(column, dtype=column.typecode)[indices]
+                for column in columns]
+            weights = numpy.frombuffer(amounts, dtype=amounts.typecode)[indices]
+            if not codes:
+                return {(): int(weights.sum())}
+            groups, inverse = numpy.unique(
+                numpy.stack(codes, axis=1), axis=0, return_inverse=True)
+            totals = numpy.bincount(inverse.ravel(), weights=weights,
+                minlength=len(groups))
+            for group, total in zip(groups.tolist(), totals.tolist()):
+                results.update({tuple(group): int(total)})
+        else:
+            if indices is None:
+                indices = six.moves.range(len(self))
+            for idx in indices:
+                group = tuple([column[idx] for column in columns])
+                results[group] = results.get(group, 0) + amounts[idx]
+        return {self._decode(keys, group): total
+            for group, total in six.iteritems(results)}
+
+    def _decode(self, keys, group):
+        decoded = []
+        for key, code in zip(keys, group):
+            if key == 'month':
+                decoded += [(code // 12, code % 12 + 1)]
+            else:
+                decoded += [getattr(self, '%ss' % key)[code]]
+        return tuple(decoded)
+
+    def _sum_by_period(self, side, dates, organization=None, account=None):
+        """
+        Returns the sum of *side* amounts by unit for the periods
+        ending at each of *dates*.
+        """
+        bounds = [_to_timestamp(end_period) for end_period in dates]
+        created_at = self.created_at
+        amounts = getattr(self, '%s_amount' % side)
+        units = getattr(self, '%s_unit' % side)
+        indices = self._mask(side, organization=organization, account=account)
+        results = {}
+        if numpy is not None:
+            if indices is None:
+                indices = numpy.arange(len(self))
+            periods = numpy.searchsorted(bounds, numpy.frombuffer(
+                created_at, dtype=created_at.typecode)[indices], side='right')
+            unit_codes = numpy.frombuffer(units, dtype=units.typecode)[indices]
+            weights = numpy.frombuffer(amounts, dtype=amounts.typecode)[indices]
+            in_range = periods < len(bounds)
+            for code in numpy.unique(unit_codes[in_range]).tolist():
+                selected = in_range & (unit_codes == code)
+                results.update({self.units[code]: [int(total)
+                    for total in numpy.bincount(periods[selected],
+                        weights=weights[selected],
+                        minlength=len(bounds)).tolist()]})
+        else:
+            if indices is None:
+                indices = six.moves.range(len(self))
+            for idx in indices:
+                period = bisect.bisect_right(bounds, created_at[idx])
+                if period < len(bounds):
+                    unit = self.units[units[idx]]
+                    if unit not in results:
+                        results[unit] = [0] * len(bounds)
+                    results[unit][period] += amounts[idx]
+        return results
+
+    def monthly_balances(self, organization=None, account=None,
+                         until=None, step_months=1, tz=None):
+        """
+        Returns the same ([end_period, balance], unit) list as
+        ``saas.managers.metrics.monthly_balances`` computed
+        from the snapshot.
+
+        Raises ``ValueError`` when a balance is in multiple units.
+        """
+        #pylint:disable=too-many-arguments,too-many-locals
+        from .managers.metrics import month_periods
+        from .utils import convert_dates_to_utc
+        dates = convert_dates_to_utc(month_periods(
+            from_date=until, step_months=step_months, tz=tz))
+        by_unit = {}
+        for side, sign in (('dest', 1), ('orig', -1)):
+            for unit, period_amounts in six.iteritems(self._sum_by_period(
+                    side, dates, organization=organization, account=account)):
+                if unit not in by_unit:
+                    by_unit[unit] = [0] * len(dates)
+                for idx, amount in enumerate(period_amounts):
+                    by_unit[unit][idx] += sign * amount
+        balances = {}
+        for unit, period_amounts in six.iteritems(by_unit):
+            balance = 0
+            balances[unit] = []
+            for amount in period_amounts:
+                balance += amount
+                balances[unit] += [balance]
+        values = []
+        unit = sorted(balances.keys())[0] if balances else None
+        for idx, end_period in enumerate(dates):
+            period_balances = [(_unit, unit_balances[idx])
+                for _unit, unit_balances in six.iteritems(balances)
+                if unit_balances[idx] != 0]
+            if len(period_balances) > 1:
+                raise ValueError(_("balances with multiple currency units"\
+                    " (%s)") % str(period_balances))
+            balance = 0
+            if period_balances:
+                unit, balance = period_balances[0]
+            values.append([end_period, balance])
+        return values, unit
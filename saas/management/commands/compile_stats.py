@@ -22,30 +22,68 @@
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-"""Command for the cron job. Daily statistics"""
+"""
+The compile_stats command is intended to be run as part of an automated
+script run once a day, after the ``renewals`` command. For each provider,
+it rolls up daily and monthly ``MetricFact`` (active, new and churned
+subscribers per plan, receivables, payments, refunds and income)
+which are then used by the metrics APIs instead of querying the ledger.
 
-import datetime
+The command is incremental and idempotent. Only the periods that ended
+since the last run are rolled up and calling the command multiple times
+for the same timestamp (i.e. with the ``--at-time`` command line argument)
+will create each ``MetricFact`` only once.
+
+**Example cron setup**:
+
+.. code-block:: bash
+
+    $ cat /etc/cron.daily/compile_stats
+    #!/bin/sh
+
+    cd /var/*mysite* && python manage.py compile_stats
+"""
+
+import logging
 
 from django.core.management.base import BaseCommand
-from django.contrib.auth import get_user_model
 
+from ...managers.metrics import rollup_metrics
 from ...models import Organization
+from ...utils import datetime_or_now
+
+
+LOGGER = logging.getLogger(__name__)
+
 
 class Command(BaseCommand):
-    """Daily usage for the service"""
-    help = 'Print daily usage'
+    """Rolls up daily and monthly metrics"""
+    help = 'Rolls up daily and monthly metrics for each provider'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+            dest='dry_run', default=False,
+            help='Do not commit the rolled up metrics')
+        parser.add_argument('--at-time', action='store',
+            dest='at_time', default=None,
+            help='Specifies the time at which the command runs')
+        parser.add_argument('--provider', action='append',
+            dest='providers', default=None,
+            help='Specifies provider to roll up metrics for.')
 
     def handle(self, *args, **options):
-        end_period = datetime.datetime.now()
-        start_period = end_period - datetime.timedelta(days=30)
-        self.stdout.write('from %s to %s\n' % (start_period, end_period))
-        for user in get_user_model().objects.filter(
-            date_joined__gt=start_period):
-            self.stdout.write('%s %s %s\n' % (str(user.date_joined),
-                user.username, user.email))
-
-        self.stdout.write('\n')
-        for organization in Organization.objects.filter(
-            created_at__gt=start_period):
-            self.stdout.write('%s %s\n'
-                % (organization.created_at, organization))
+        #pylint:disable=broad-except
+        dry_run = options['dry_run']
+        end_period = datetime_or_now(options['at_time'])
+        if dry_run:
+            LOGGER.warning("dry_run: no changes will be committed.")
+        self.stdout.write("running compile_stats at %s" % end_period)
+        providers = Organization.objects.filter(is_provider=True)
+        provider_slugs = options.get('providers')
+        if provider_slugs:
+            providers = providers.filter(slug__in=provider_slugs)
+        for provider in providers:
+            try:
+                rollup_metrics(provider, until=end_period, dry_run=dry_run)
+            except Exception as err:
+                LOGGER.exception("rollup_metrics(%s): %s", provider, err)
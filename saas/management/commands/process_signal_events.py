@@ -0,0 +1,77 @@
+# Copyright (c) 2018, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+The process_signal_events command delivers to receivers the signals
+recorded while the ``SIGNALS_OUTBOX`` setting is enabled.
+
+Signals are delivered in the order they were recorded. A signal whose
+receivers fail (ex: the e-mail server is unavailable) is retried with
+an exponential backoff, and later signals for the same organization wait
+until it is delivered.
+
+**Example cron setup**:
+
+.. code-block:: bash
+
+    $ cat /etc/cron.d/process_signal_events
+    * * * * * cd /var/*mysite* && python manage.py process_signal_events
+"""
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from ...models import SignalEvent
+from ...signals import deliver_signal_event
+from ...utils import datetime_or_now
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = """Deliver signals recorded in the outbox to their receivers"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--at-time', action='store',
+            dest='at_time', default=None,
+            help='Specifies the time at which the command runs')
+        parser.add_argument('--batch-size', action='store', type=int,
+            dest='batch_size', default=100,
+            help='Number of signals delivered per batch')
+
+    def handle(self, *args, **options):
+        at_time = datetime_or_now(options['at_time'])
+        batch_size = options['batch_size']
+        nb_processed = 0
+        while True:
+            nb_batch = SignalEvent.objects.process_pending(
+                deliver_signal_event, at_time=at_time, batch_size=batch_size)
+            nb_processed += nb_batch
+            if nb_batch < batch_size:
+                break
+        LOGGER.info("processed %d signal events at %s",
+            nb_processed, at_time)
@@ -0,0 +1,80 @@
+# Copyright (c) 2018, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+The process_webhook_events command updates the database according to
+the events posted by the processor on its webhook (see ``StripeWebhook``).
+
+Events are recorded and acknowledged as soon as they are received. This
+command then applies them in the order the processor created them. An event
+that fails (ex: the charge it refers to was not yet committed) is retried
+with an exponential backoff, and later events for the same object wait
+until it is processed.
+
+**Example cron setup**:
+
+.. code-block:: bash
+
+    $ cat /etc/cron.d/process_webhook_events
+    * * * * * cd /var/*mysite* && python manage.py process_webhook_events
+"""
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from ...backends import get_processor_backend
+from ...models import WebhookEvent, get_broker
+from ...utils import datetime_or_now
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = """Process events received on the processor webhook"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--at-time', action='store',
+            dest='at_time', default=None,
+            help='Specifies the time at which the command runs')
+        parser.add_argument('--batch-size', action='store', type=int,
+            dest='batch_size', default=100,
+            help='Number of events processed per batch')
+
+    def handle(self, *args, **options):
+        at_time = datetime_or_now(options['at_time'])
+        batch_size = options['batch_size']
+        processor_backend = get_processor_backend(get_broker())
+        nb_processed = 0
+        while True:
+            nb_batch = WebhookEvent.objects.process_pending(
+                processor_backend.process_webhook_event,
+                at_time=at_time, batch_size=batch_size)
+            nb_processed += nb_batch
+            if nb_batch < batch_size:
+                break
+        LOGGER.info("processed %d webhook events at %s",
+            nb_processed, at_time)
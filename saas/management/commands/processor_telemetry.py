@@ -0,0 +1,66 @@
+# Copyright (c) 2018, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+The processor_telemetry command prints the latency histograms, error counts
+and in-flight counts recorded for calls to the processor backend.
+"""
+
+import json
+
+from django.core.management.base import BaseCommand
+
+from ...backends.telemetry import get_telemetry, reset_telemetry
+
+
+class Command(BaseCommand):
+    help = """Print latency and error telemetry for calls
+ to the processor backend"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true',
+            dest='json', default=False,
+            help='Print the telemetry as JSON')
+        parser.add_argument('--reset', action='store_true',
+            dest='reset', default=False,
+            help='Reset all counters after printing them')
+
+    def handle(self, *args, **options):
+        telemetry = get_telemetry()
+        if options['json']:
+            self.stdout.write(json.dumps(telemetry, indent=2, sort_keys=True))
+        else:
+            self.stdout.write("%-24s %8s %9s %8s %s" % (
+                "method", "calls", "in-flight", "avg(ms)", "errors"))
+            for method, counters in sorted(telemetry.items()):
+                self.stdout.write("%-24s %8d %9d %8d %s" % (method,
+                    counters['calls'], counters['in_flight'],
+                    counters['avg_ms'], ', '.join(["%s: %d" % item
+                    for item in sorted(counters['errors'].items())])))
+                self.stdout.write("    latency: %s" % ' '.join([
+                    "<=%s: %d" % (bucket['le'], bucket['count'])
+                    for bucket in counters['latency']]))
+        if options['reset']:
+            reset_telemetry()
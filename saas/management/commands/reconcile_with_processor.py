@@ -25,12 +25,19 @@
 """
 The reconcile_with_processor command is will check all payouts on the processor
 have been accounted for in the local database.
+
+Providers are reconciled from the last payout recorded by a previous
+successful run (or their creation date) unless ``--after`` is specified.
+With ``--workers``, providers are reconciled concurrently, each on its own
+database connection.
 """
 
 import logging
+from multiprocessing.pool import ThreadPool
 
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.db import connection
+from django.db.models import Q
 
 from ...models import Organization
 from ...utils import datetime_or_now
@@ -54,6 +61,9 @@ class Command(BaseCommand):
         parser.add_argument('--at-time', action='store',
             dest='at_time', default=None,
             help='Specifies the time at which the command runs')
+        parser.add_argument('--workers', action='store', type=int,
+            dest='workers', default=1,
+            help='Number of providers reconciled concurrently')
 
     def handle(self, *args, **options):
         dry_run = options['dry_run']
@@ -64,17 +74,53 @@ class Command(BaseCommand):
         # end_period = datetime_or_now(options['at_time'])
         if dry_run:
             LOGGER.warning("dry_run: no changes will be committed.")
-        self.run_reconcile(created_at=created_at, dry_run=dry_run)
+        self.run_reconcile(created_at=created_at, dry_run=dry_run,
+            workers=options['workers'])
+
+    def run_reconcile(self, created_at=None, dry_run=False, workers=1):
+        providers = Organization.objects.filter(is_provider=True)
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                pool.map(lambda provider: self._reconcile_in_thread(
+                    provider, created_at=created_at, dry_run=dry_run),
+                    providers)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for provider in providers:
+                self.reconcile_provider(
+                    provider, created_at=created_at, dry_run=dry_run)
 
-    def run_reconcile(self, created_at=None, dry_run=False):
-        for provider in Organization.objects.filter(is_provider=True):
-            self.stdout.write("reconcile payouts for %s ..." % str(provider))
+    def reconcile_provider(self, provider, created_at=None, dry_run=False):
+        self.stdout.write("reconcile payouts for %s ..." % str(provider))
+        try:
             backend = get_processor_backend(provider)
             if not created_at:
-                created_at = provider.created_at
-            try:
-                with transaction.atomic():
-                    backend.reconcile_transfers(provider, created_at,
-                        dry_run=dry_run)
-            except ProcessorError as err:
-                self.stderr.write("error: %s" % str(err))
+                created_at = (provider.processor_reconciled_at
+                    or provider.created_at)
+            # Transactions are committed one page of payouts at a time.
+            reconciled_at = backend.reconcile_transfers(provider, created_at,
+                dry_run=dry_run)
+            if reconciled_at and not dry_run:
+                Organization.objects.filter(
+                    Q(processor_reconciled_at__isnull=True)
+                    | Q(processor_reconciled_at__lt=reconciled_at),
+                    pk=provider.pk).update(
+                    processor_reconciled_at=reconciled_at)
+        except ProcessorError as err:
+            self.stderr.write("error: %s" % str(err))
+
+    def _reconcile_in_thread(self, provider, created_at=None, dry_run=False):
+        try:
+            self.reconcile_provider(
+                provider, created_at=created_at, dry_run=dry_run)
+        except Exception as err: #pylint:disable=broad-except
+            # An exception escaping a worker would make ``pool.map`` raise
+            # and the remaining providers would not be reported.
+            LOGGER.exception("error reconciling %s: %s", provider, err)
+            self.stderr.write("error: %s" % str(err))
+        finally:
+            # Each worker thread opens its own database connection.
+            connection.close()
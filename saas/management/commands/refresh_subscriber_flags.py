@@ -0,0 +1,52 @@
+# Copyright (c) 2018, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+The refresh_subscriber_flags command recomputes ``SubscriberFlag`` for all
+users. ``SubscriberFlag`` is only maintained while ``SUBSCRIBER_FLAGS``
+is on, so run it after turning the setting on.
+"""
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from ...models import SubscriberFlag
+
+
+class Command(BaseCommand):
+    help = "Recompute the subscriber flags of all users"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', action='store', type=int,
+            dest='batch_size', default=1000,
+            help='Number of users refreshed at a time')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        user_ids = list(get_user_model().objects.order_by(
+            'pk').values_list('pk', flat=True))
+        for start in range(0, len(user_ids), batch_size):
+            SubscriberFlag.objects.refresh(user_ids[start:start + batch_size])
+        self.stdout.write("refreshed subscriber flags for %d users"
+            % len(user_ids))
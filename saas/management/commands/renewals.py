@@ -29,7 +29,8 @@ run at least once a day. It will
 - recognize revenue for past periods (see :doc:`ledger <ledger>`).
 - extends active subscriptions
 - create charges for new periods
-- trigger expiration notices
+- record expiration notices (sent by the ``send_expiration_notices``
+  command)
 
 Every functions part of the renewals script are explicitly written to be
 idempotent. Calling the scripts multiple times for the same timestamp
@@ -102,8 +103,10 @@ on credit cards"""
             time.sleep(30)
             complete_charges()
 
-        # Trigger 'expires soon' notifications
-        expiration_periods = settings.EXPIRE_NOTICE_DAYS
-        for period in expiration_periods:
-            trigger_expiration_notices(
-                end_period, nb_days=period, dry_run=dry_run)
+        # Record 'expires soon' notifications. They are sent
+        # by the send_expiration_notices command.
+        try:
+            trigger_expiration_notices(end_period,
+                nb_days=settings.EXPIRE_NOTICE_DAYS, dry_run=dry_run)
+        except Exception as err:
+            LOGGER.exception("trigger_expiration_notices: %s", err)
@@ -22,15 +22,27 @@
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-"""Command for the cron job. Send revenue report for the last week"""
+"""
+Command for the cron job. Send revenue report for the last week
 
-import logging
+Aggregates are computed for all providers at once. With ``--jobs``,
+reports are generated by a pool of processes while the
+``weekly_sales_report_created`` signals are still sent from the command
+process.
+"""
 
+import logging, multiprocessing
+from collections import OrderedDict
+
+import django
 from dateutil.relativedelta import relativedelta, SU
 from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import F
+from django.utils import six
 
-from ...managers.metrics import (aggregate_transactions_by_period,
-    aggregate_transactions_change_by_period)
+from ...managers.metrics import (bulk_aggregate_transactions_by_period,
+    bulk_aggregate_transactions_change_by_period)
 from ...models import Organization, Transaction
 from ...utils import datetime_or_now, parse_tz
 from ...humanize import as_money
@@ -53,6 +65,9 @@ class Command(BaseCommand):
         parser.add_argument('--provider', action='append',
             dest='providers', default=None,
             help='Specifies provider to generate reports for.')
+        parser.add_argument('--jobs', action='store', type=int,
+            dest='jobs', default=1,
+            help='Number of processes generating reports concurrently.')
 
     @staticmethod
     def construct_date_periods(at_time, timezone=None):
@@ -107,88 +122,126 @@ class Command(BaseCommand):
 
     @staticmethod
     def get_weekly_perf_data(provider, prev_week, prev_year):
+        return Command.get_bulk_weekly_perf_data(
+            [provider], prev_week, prev_year)[provider.pk]
+
+    @staticmethod
+    def get_bulk_weekly_perf_data(providers, prev_week, prev_year):
+        """
+        Returns the ``(table, unit)`` of each provider in *providers*
+        keyed by provider pk. Aggregates are computed with the same
+        queries for all providers.
+        """
         #pylint:disable=too-many-locals
-        account_table, _, _, table_unit = \
-            aggregate_transactions_change_by_period(provider,
-                Transaction.RECEIVABLE, account_title='Sales',
-                orig='orig', dest='dest',
-                date_periods=prev_week)
-        account_table_prev_year, _, _, _ = \
-            aggregate_transactions_change_by_period(provider,
-                Transaction.RECEIVABLE, account_title='Sales',
-                orig='orig', dest='dest',
-                date_periods=prev_year)
-
-        _, payment_amounts, payments_unit = \
-            aggregate_transactions_by_period(
-                provider, Transaction.RECEIVABLE,
-                orig='dest', dest='dest',
-                orig_account=Transaction.BACKLOG,
-                orig_organization=provider,
-                date_periods=prev_week)
-        _, payment_amounts_prev_year, _ = \
-            aggregate_transactions_by_period(
-                provider, Transaction.RECEIVABLE,
-                orig='dest', dest='dest',
-                orig_account=Transaction.BACKLOG,
-                orig_organization=provider,
-                date_periods=prev_year)
-
-        _, refund_amounts, refund_unit = \
-            aggregate_transactions_by_period(
-                provider, Transaction.REFUND,
-                orig='dest', dest='dest',
-                date_periods=prev_week)
-        _, refund_amounts_prev_year, _ = \
-            aggregate_transactions_by_period(
-                provider, Transaction.REFUND,
-                orig='dest', dest='dest',
-                date_periods=prev_year)
-
-        unit = settings.DEFAULT_UNIT
-
-        units = get_different_units(table_unit, payments_unit, refund_unit)
-
-        if len(units) > 1:
-            LOGGER.error("different units: %s", units)
-
-        if units:
-            unit = units[0]
-
-        table = [
-            {'key': "Total Sales",
-             'values': {
-                'last': account_table[0]['values'][1][1],
-                'prev': account_table[0]['values'][0][1],
-                'prev_year': account_table_prev_year[0]['values'][0][1]
-            }},
-            {'key': "New Sales",
-             'values': {
-                'last': account_table[1]['values'][1][1],
-                'prev': account_table[1]['values'][0][1],
-                'prev_year': account_table_prev_year[1]['values'][0][1]
-            }},
-            {'key': "Churned Sales",
-             'values': {
-                 'last': account_table[2]['values'][1][1],
-                'prev': account_table[2]['values'][0][1],
-                'prev_year': account_table_prev_year[2]['values'][0][1]
-            }},
-            {'key': "Payments",
-             'values': {
-                 'last': payment_amounts[1][1],
-                 'prev': payment_amounts[0][1],
-                 'prev_year': payment_amounts_prev_year[0][1]
-            }},
-            {'key': "Refunds",
-             'values': {
-                'last': refund_amounts[1][1],
-                'prev': refund_amounts[0][1],
-                'prev_year': refund_amounts_prev_year[0][1]
-            }}
-        ]
+        account_tables = bulk_aggregate_transactions_change_by_period(
+            providers, Transaction.RECEIVABLE, account_title='Sales',
+            orig='orig', dest='dest', date_periods=prev_week)
+        account_tables_prev_year = \
+            bulk_aggregate_transactions_change_by_period(
+                providers, Transaction.RECEIVABLE, account_title='Sales',
+                orig='orig', dest='dest', date_periods=prev_year)
+
+        payments = bulk_aggregate_transactions_by_period(
+            providers, Transaction.RECEIVABLE,
+            orig='dest', dest='dest',
+            orig_account=Transaction.BACKLOG,
+            orig_organization=F('dest_organization'),
+            date_periods=prev_week)
+        payments_prev_year = bulk_aggregate_transactions_by_period(
+            providers, Transaction.RECEIVABLE,
+            orig='dest', dest='dest',
+            orig_account=Transaction.BACKLOG,
+            orig_organization=F('dest_organization'),
+            date_periods=prev_year)
+
+        refunds = bulk_aggregate_transactions_by_period(
+            providers, Transaction.REFUND,
+            orig='dest', dest='dest',
+            date_periods=prev_week)
+        refunds_prev_year = bulk_aggregate_transactions_by_period(
+            providers, Transaction.REFUND,
+            orig='dest', dest='dest',
+            date_periods=prev_year)
+
+        results = {}
+        for provider in providers:
+            account_table, _, _, table_unit = account_tables[provider.pk]
+            account_table_prev_year, _, _, _ = account_tables_prev_year[
+                provider.pk]
+            _, payment_amounts, payments_unit = payments[provider.pk]
+            _, payment_amounts_prev_year, _ = payments_prev_year[provider.pk]
+            _, refund_amounts, refund_unit = refunds[provider.pk]
+            _, refund_amounts_prev_year, _ = refunds_prev_year[provider.pk]
+
+            unit = settings.DEFAULT_UNIT
+
+            units = get_different_units(table_unit, payments_unit, refund_unit)
+
+            if len(units) > 1:
+                LOGGER.error("different units: %s", units)
+
+            if units:
+                unit = units[0]
 
-        return (table, unit)
+            table = [
+                {'key': "Total Sales",
+                 'values': {
+                    'last': account_table[0]['values'][1][1],
+                    'prev': account_table[0]['values'][0][1],
+                    'prev_year': account_table_prev_year[0]['values'][0][1]
+                }},
+                {'key': "New Sales",
+                 'values': {
+                    'last': account_table[1]['values'][1][1],
+                    'prev': account_table[1]['values'][0][1],
+                    'prev_year': account_table_prev_year[1]['values'][0][1]
+                }},
+                {'key': "Churned Sales",
+                 'values': {
+                     'last': account_table[2]['values'][1][1],
+                    'prev': account_table[2]['values'][0][1],
+                    'prev_year': account_table_prev_year[2]['values'][0][1]
+                }},
+                {'key': "Payments",
+                 'values': {
+                     'last': payment_amounts[1][1],
+                     'prev': payment_amounts[0][1],
+                     'prev_year': payment_amounts_prev_year[0][1]
+                }},
+                {'key': "Refunds",
+                 'values': {
+                    'last': refund_amounts[1][1],
+                    'prev': refund_amounts[0][1],
+                    'prev_year': refund_amounts_prev_year[0][1]
+                }}
+            ]
+            results[provider.pk] = (table, unit)
+
+        return results
+
+    @staticmethod
+    def generate_reports(at_time, provider_ids):
+        """
+        Returns the ``(dates, table)`` report of each provider
+        in *provider_ids* keyed by provider pk.
+        """
+        # Providers in the same timezone share the same dates.
+        by_dates = OrderedDict()
+        for provider in Organization.objects.filter(
+                pk__in=provider_ids).order_by('pk'):
+            prev_week, prev_year = Command.construct_date_periods(
+                at_time, timezone=provider.default_timezone)
+            by_dates.setdefault(
+                (tuple(prev_week), tuple(prev_year)), []).append(provider)
+        results = {}
+        for (prev_week, prev_year), providers in six.iteritems(by_dates):
+            prev_week, prev_year = list(prev_week), list(prev_year)
+            for provider_id, (data, unit) in six.iteritems(
+                    Command.get_bulk_weekly_perf_data(
+                        providers, prev_week, prev_year)):
+                results[provider_id] = ((prev_week, prev_year),
+                    Command.construct_table(data, unit))
+        return results
 
     def handle(self, *args, **options):
         # aware utc datetime object
@@ -199,9 +252,31 @@ class Command(BaseCommand):
         provider_slugs = options.get('providers')
         if provider_slugs:
             providers = providers.filter(slug__in=provider_slugs)
+        providers = list(providers)
+        provider_ids = [provider.pk for provider in providers]
+        nb_jobs = min(options.get('jobs') or 1, len(provider_ids))
+        if nb_jobs > 1:
+            # Child processes must open their own database connections.
+            connections.close_all()
+            chunk_size = (len(provider_ids) + nb_jobs - 1) // nb_jobs
+            pool = multiprocessing.Pool(nb_jobs, initializer=_init_worker)
+            try:
+                reports = {}
+                for chunk in pool.map(_generate_reports, [
+                        (at_time, provider_ids[idx:idx + chunk_size])
+                        for idx in six.moves.range(
+                            0, len(provider_ids), chunk_size)]):
+                    reports.update(chunk)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            reports = self.generate_reports(at_time, provider_ids)
+
+        # Signals are sent from this process such that receivers
+        # (ex: e-mail notifications) run once, in order.
         for provider in providers:
-            dates = self.construct_date_periods(
-                at_time, timezone=provider.default_timezone)
+            dates, table = reports[provider.pk]
             prev_week, prev_year = dates
             self.stdout.write("Two last consecutive weeks:\n  %s %s %s" % (
                 prev_week[0].isoformat(), prev_week[1].isoformat(),
@@ -209,8 +284,18 @@ class Command(BaseCommand):
             self.stdout.write("Same week last year:\n"\
                 "                            %s %s" % (
                 prev_year[0].isoformat(), prev_year[1].isoformat()))
-            data, unit = self.get_weekly_perf_data(
-                provider, prev_week, prev_year)
-            table = self.construct_table(data, unit)
             signals.weekly_sales_report_created.send(sender=__name__,
                 provider=provider, dates=dates, data=table)
+
+
+def _init_worker():
+    django.setup()
+    connections.close_all()
+
+
+def _generate_reports(args):
+    at_time, provider_ids = args
+    try:
+        return Command.generate_reports(at_time, provider_ids)
+    finally:
+        connections.close_all()
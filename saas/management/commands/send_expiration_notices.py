@@ -0,0 +1,69 @@
+# Copyright (c) 2018, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+The send_expiration_notices command triggers the ``expires_soon``,
+``card_expires_soon``, ``subscription_upgrade`` and ``payment_method_absent``
+signals for the notices recorded by the renewals command.
+
+Receivers usually send e-mails. A notice that fails (ex: the e-mail server
+is unavailable) is retried with an exponential backoff.
+
+**Example cron setup**:
+
+.. code-block:: bash
+
+    $ cat /etc/cron.d/send_expiration_notices
+    */10 * * * * cd /var/*mysite* && python manage.py send_expiration_notices
+"""
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from ...renewals import send_expiration_notices
+from ...utils import datetime_or_now
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = """Send expiration notices recorded by the renewals command"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--at-time', action='store',
+            dest='at_time', default=None,
+            help='Specifies the time at which the command runs')
+        parser.add_argument('--batch-size', action='store', type=int,
+            dest='batch_size', default=100,
+            help='Number of notices sent per batch')
+
+    def handle(self, *args, **options):
+        at_time = datetime_or_now(options['at_time'])
+        nb_processed = send_expiration_notices(
+            at_time=at_time, batch_size=options['batch_size'])
+        LOGGER.info("processed %d expiration notices at %s",
+            nb_processed, at_time)
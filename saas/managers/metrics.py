@@ -26,12 +26,15 @@ from datetime import datetime
 import logging
 
 from dateutil.relativedelta import relativedelta
-from django.db import router
-from django.db.models import Count, Sum
+from django.db import connections, router, transaction
+from django.db.models import (Case, Count, IntegerField, Max, Min, Q, Sum,
+    Value, When)
 from django.db.models.sql.query import RawQuery
 from django.utils import six
+from django.utils.timezone import utc
+from django.utils.translation import ugettext_lazy as _
 
-from ..models import Plan, Subscription, Transaction
+from ..models import MetricFact, Plan, Subscription, Transaction
 from ..utils import datetime_or_now, parse_tz, convert_dates_to_utc
 
 LOGGER = logging.getLogger(__name__)
@@ -140,6 +143,51 @@ def aggregate_transactions_by_period(organization, account, date_periods,
     return (counts, amounts, unit)
 
 
+def bulk_aggregate_transactions_by_period(organizations, account,
+                    date_periods, orig='orig', dest='dest', **kwargs):
+    """
+    Returns ``aggregate_transactions_by_period`` for each organization
+    in *organizations* as a dictionary keyed by organization pk,
+    using one query per period for all organizations.
+
+    *kwargs* referring to the organization itself are passed
+    as ``F`` expressions (ex: ``orig_organization=F('dest_organization')``).
+    """
+    # pylint: disable=too-many-locals,too-many-arguments,invalid-name
+    results = {organization.pk: ([], [], None)
+        for organization in organizations}
+    kwargs.update({'%s_organization__in' % orig: list(results.keys()),
+        '%s_account' % orig: account})
+    period_start = date_periods[0]
+    for period_end in date_periods[1:]:
+        query_results = {}
+        for row in Transaction.objects.filter(
+                created_at__gte=period_start,
+                created_at__lt=period_end, **kwargs).values(
+                '%s_organization' % orig, '%s_unit' % dest).annotate(
+                    count=Count('%s_organization' % dest, distinct=True),
+                    sum=Sum('%s_amount' % dest)).order_by(
+                '%s_organization' % orig, '%s_unit' % dest):
+            # Like ``aggregate_transactions_by_period``, we only
+            # keep the first unit.
+            query_results.setdefault(row['%s_organization' % orig], row)
+        period = period_end
+        for organization_id, (counts, amounts, unit) in six.iteritems(
+                results):
+            count, amount = 0, 0
+            row = query_results.get(organization_id)
+            if row:
+                count = row['count']
+                amount = row['sum']
+                if row['%s_unit' % dest]:
+                    unit = row['%s_unit' % dest]
+            counts += [(period, count)]
+            amounts += [(period, int(amount or 0))]
+            results[organization_id] = (counts, amounts, unit)
+        period_start = period_end
+    return results
+
+
 def _aggregate_transactions_change_by_period(organization, account,
                             date_periods, orig='orig', dest='dest'):
     """
@@ -154,8 +202,30 @@ def _aggregate_transactions_change_by_period(organization, account,
     churn_customers = []
     churn_receivables = []
     unit = None
+    # Dates are passed as query parameters such that they are compared
+    # as datetimes, whatever the timezone of the organization.
+    database = router.db_for_read(Transaction)
+    adapt = connections[database].ops.adapt_datetimefield_value
+    facts = {}
+    if account == Transaction.RECEIVABLE and orig == 'orig' and dest == 'dest':
+        # Sales figures are rolled up by the ``compile_stats`` command.
+        facts = get_facts_by_period(organization, date_periods)
     period_start = date_periods[0]
     for period_end in date_periods[1:]:
+        fact = facts.get((period_start, period_end))
+        if fact:
+            if (fact.receivables or fact.new_receivables
+                or fact.churned_receivables):
+                unit = fact.unit
+            period = period_end
+            churn_customers += [(period, fact.churned_customers)]
+            churn_receivables += [(period, fact.churned_receivables)]
+            customers += [(period, fact.customers)]
+            receivables += [(period, fact.receivables)]
+            new_customers += [(period, fact.new_customers)]
+            new_receivables += [(period, fact.new_receivables)]
+            period_start = period_end
+            continue
         delta = Plan.get_natural_period(1, organization.natural_interval)
         prev_period_end = period_end - delta
         prev_period_start = prev_period_end - relativedelta(
@@ -173,26 +243,22 @@ def _aggregate_transactions_change_by_period(organization, account,
            LEFT OUTER JOIN (
              SELECT distinct(%(dest)s_organization_id), %(orig)s_unit
                FROM saas_transaction
-               WHERE created_at >= '%(period_start)s'
-             AND created_at < '%(period_end)s'
-             AND %(orig)s_organization_id = '%(organization_id)s'
-             AND %(orig)s_account = '%(account)s'
+               WHERE created_at >= %%s
+             AND created_at < %%s
+             AND %(orig)s_organization_id = %%s
+             AND %(orig)s_account = %%s
              ) curr
              ON prev.%(dest)s_organization_id = curr.%(dest)s_organization_id
-           WHERE prev.created_at >= '%(prev_period_start)s'
-             AND prev.created_at < '%(prev_period_end)s'
-             AND prev.%(orig)s_organization_id = '%(organization_id)s'
-             AND prev.%(orig)s_account = '%(account)s'
+           WHERE prev.created_at >= %%s
+             AND prev.created_at < %%s
+             AND prev.%(orig)s_organization_id = %%s
+             AND prev.%(orig)s_account = %%s
              AND curr.%(dest)s_organization_id IS NULL
              GROUP BY prev.%(dest)s_unit
-             """ % {
-                    "orig": orig, "dest": dest,
-                    "prev_period_start": prev_period_start,
-                    "prev_period_end": prev_period_end,
-                    "period_start": period_start,
-                    "period_end": period_end,
-                    "organization_id": organization.id,
-                    "account": account}, router.db_for_read(Transaction))
+             """ % {"orig": orig, "dest": dest}, database,
+                params=(adapt(period_start), adapt(period_end),
+                    organization.id, account, adapt(prev_period_start),
+                    adapt(prev_period_end), organization.id, account))
             churn_customer, churn_receivable, churn_receivable_unit = next(
                 iter(churn_query))
             if churn_receivable_unit:
@@ -233,24 +299,21 @@ def _aggregate_transactions_change_by_period(organization, account,
            LEFT OUTER JOIN (
              SELECT distinct(%(dest)s_organization_id)
                FROM saas_transaction
-               WHERE created_at >= '%(prev_period_start)s'
-             AND created_at < '%(prev_period_end)s'
-             AND %(orig)s_organization_id = '%(organization_id)s'
-             AND %(orig)s_account = '%(account)s') prev
+               WHERE created_at >= %%s
+             AND created_at < %%s
+             AND %(orig)s_organization_id = %%s
+             AND %(orig)s_account = %%s) prev
              ON curr.%(dest)s_organization_id = prev.%(dest)s_organization_id
-           WHERE curr.created_at >= '%(period_start)s'
-             AND curr.created_at < '%(period_end)s'
-             AND curr.%(orig)s_organization_id = '%(organization_id)s'
-             AND curr.%(orig)s_account = '%(account)s'
+           WHERE curr.created_at >= %%s
+             AND curr.created_at < %%s
+             AND curr.%(orig)s_organization_id = %%s
+             AND curr.%(orig)s_account = %%s
              AND prev.%(dest)s_organization_id IS NULL
-             GROUP BY curr.%(dest)s_unit""" % {
-                    "orig": orig, "dest": dest,
-                    "prev_period_start": prev_period_start,
-                    "prev_period_end": prev_period_end,
-                    "period_start": period_start,
-                    "period_end": period_end,
-                    "organization_id": organization.id,
-                    "account": account}, router.db_for_read(Transaction))
+             GROUP BY curr.%(dest)s_unit""" % {"orig": orig, "dest": dest},
+                database, params=(adapt(prev_period_start),
+                    adapt(prev_period_end), organization.id, account,
+                    adapt(period_start), adapt(period_end),
+                    organization.id, account))
             new_customer, new_receivable, new_receivable_unit = next(
                 iter(new_query))
             if new_receivable_unit:
@@ -276,17 +339,202 @@ def _aggregate_transactions_change_by_period(organization, account,
             (churn_receivables, receivables, new_receivables), unit)
 
 
+def _bulk_change_query(organization_ids, account, period_start, period_end,
+                       prev_period_start, prev_period_end,
+                       orig='orig', dest='dest', churned=False):
+    """
+    Returns a dictionary keyed by organization id of the first
+    (count, amount, unit) of customers of each organization
+    in [*period_start*, *period_end*[ which were not customers
+    in [*prev_period_start*, *prev_period_end*[ (or the reverse
+    when *churned* is True).
+    """
+    #pylint:disable=too-many-arguments,too-many-locals
+    if churned:
+        period_start, prev_period_start = prev_period_start, period_start
+        period_end, prev_period_end = prev_period_end, period_end
+    database = router.db_for_read(Transaction)
+    adapt = connections[database].ops.adapt_datetimefield_value
+    in_organizations = ', '.join(['%s'] * len(organization_ids))
+    prev_columns = ', '.join(sorted(set([
+        '%s_organization_id' % orig, '%s_organization_id' % dest])))
+    query = RawQuery(
+    """SELECT curr.%(orig)s_organization_id,
+              COUNT(DISTINCT(curr.%(dest)s_organization_id)),
+              SUM(curr.%(dest)s_amount),
+              curr.%(dest)s_unit
+       FROM saas_transaction curr
+           LEFT OUTER JOIN (
+             SELECT DISTINCT %(prev_columns)s
+               FROM saas_transaction
+               WHERE created_at >= %%s
+             AND created_at < %%s
+             AND %(orig)s_organization_id IN (%(in_organizations)s)
+             AND %(orig)s_account = %%s) prev
+             ON curr.%(dest)s_organization_id = prev.%(dest)s_organization_id
+             AND curr.%(orig)s_organization_id = prev.%(orig)s_organization_id
+           WHERE curr.created_at >= %%s
+             AND curr.created_at < %%s
+             AND curr.%(orig)s_organization_id IN (%(in_organizations)s)
+             AND curr.%(orig)s_account = %%s
+             AND prev.%(dest)s_organization_id IS NULL
+             GROUP BY curr.%(orig)s_organization_id, curr.%(dest)s_unit
+             ORDER BY curr.%(orig)s_organization_id, curr.%(dest)s_unit""" % {
+        "orig": orig, "dest": dest, "prev_columns": prev_columns,
+        "in_organizations": in_organizations}, database,
+        params=([adapt(prev_period_start), adapt(prev_period_end)]
+            + organization_ids + [account, adapt(period_start),
+            adapt(period_end)] + organization_ids + [account]))
+    results = {}
+    for organization_id, count, amount, unit in query:
+        results.setdefault(organization_id, (count, amount, unit))
+    return results
+
+
+def _bulk_aggregate_transactions_change_by_period(organizations, account,
+                            date_periods, orig='orig', dest='dest'):
+    """
+    Returns ``_aggregate_transactions_change_by_period`` for each
+    organization in *organizations* as a dictionary keyed by organization pk.
+    """
+    #pylint:disable=too-many-locals,too-many-arguments,invalid-name
+    results = {organization.pk: ([], [], [], [], [], [], None)
+        for organization in organizations}
+    date_periods = [datetime_or_now(date_period)
+        for date_period in date_periods]
+    facts = {}
+    if account == Transaction.RECEIVABLE and orig == 'orig' and dest == 'dest':
+        # Sales figures are rolled up by the ``compile_stats`` command.
+        for fact in MetricFact.objects.filter(
+                organization__in=list(results.keys()), plan=None,
+                interval=Plan.MONTHLY, ends_at__in=date_periods[1:]):
+            facts.update({
+                (fact.organization_id, fact.starts_at, fact.ends_at): fact})
+    intervals = get_natural_intervals(list(results.keys()))
+    period_start = date_periods[0]
+    for period_end in date_periods[1:]:
+        period = period_end
+        # Organizations are grouped by the previous period
+        # their customers are compared against.
+        by_intervals = {}
+        for organization_id in results:
+            fact = facts.get((organization_id, period_start, period_end))
+            if fact:
+                (churn_customers, customers, new_customers, churn_receivables,
+                 receivables, new_receivables, unit) = results[organization_id]
+                if (fact.receivables or fact.new_receivables
+                    or fact.churned_receivables):
+                    unit = fact.unit
+                churn_customers += [(period, fact.churned_customers)]
+                churn_receivables += [(period, fact.churned_receivables)]
+                customers += [(period, fact.customers)]
+                receivables += [(period, fact.receivables)]
+                new_customers += [(period, fact.new_customers)]
+                new_receivables += [(period, fact.new_receivables)]
+                results[organization_id] = (churn_customers, customers,
+                    new_customers, churn_receivables, receivables,
+                    new_receivables, unit)
+                continue
+            by_intervals.setdefault(
+                intervals[organization_id], []).append(organization_id)
+
+        for interval, organization_ids in six.iteritems(by_intervals):
+            delta = Plan.get_natural_period(1, interval)
+            prev_period_end = period_end - delta
+            prev_period_start = prev_period_end - relativedelta(
+                period_end, period_start)
+            LOGGER.debug(
+            "computes churn between periods ['%s', '%s'] and ['%s', '%s']",
+                prev_period_start.isoformat(), prev_period_end.isoformat(),
+                period_start.isoformat(), period_end.isoformat())
+            churn_rows = _bulk_change_query(organization_ids, account,
+                period_start, period_end, prev_period_start, prev_period_end,
+                orig=orig, dest=dest, churned=True)
+            new_rows = _bulk_change_query(organization_ids, account,
+                period_start, period_end, prev_period_start, prev_period_end,
+                orig=orig, dest=dest)
+            receivable_rows = {}
+            for row in Transaction.objects.filter(
+                    created_at__gte=period_start, created_at__lt=period_end,
+                    **{'%s_organization__in' % orig: organization_ids,
+                    '%s_account' % orig: account}).values(
+                    '%s_organization' % orig, '%s_unit' % dest).annotate(
+                        count=Count('%s_organization' % dest, distinct=True),
+                        sum=Sum('%s_amount' % dest)).order_by(
+                    '%s_organization' % orig, '%s_unit' % dest):
+                receivable_rows.setdefault(row['%s_organization' % orig], (
+                    row['count'], row['sum'], row['%s_unit' % dest]))
+
+            for organization_id in organization_ids:
+                (churn_customers, customers, new_customers, churn_receivables,
+                 receivables, new_receivables, unit) = results[organization_id]
+                churn_customer, churn_receivable, churn_receivable_unit = \
+                    churn_rows.get(organization_id, (0, 0, None))
+                customer, receivable, receivable_unit = \
+                    receivable_rows.get(organization_id, (0, 0, None))
+                new_customer, new_receivable, new_receivable_unit = \
+                    new_rows.get(organization_id, (0, 0, None))
+                for _unit in (churn_receivable_unit, receivable_unit,
+                              new_receivable_unit):
+                    if _unit:
+                        unit = _unit
+                units = get_different_units(churn_receivable_unit,
+                    receivable_unit, new_receivable_unit)
+                if len(units) > 1:
+                    LOGGER.error("different units: %s", units)
+                churn_customers += [(period, churn_customer)]
+                churn_receivables += [(period, int(churn_receivable or 0))]
+                customers += [(period, customer)]
+                receivables += [(period, int(receivable or 0))]
+                new_customers += [(period, new_customer)]
+                new_receivables += [(period, int(new_receivable or 0))]
+                results[organization_id] = (churn_customers, customers,
+                    new_customers, churn_receivables, receivables,
+                    new_receivables, unit)
+        period_start = period_end
+
+    return {organization_id: ((churn_customers, customers, new_customers),
+            (churn_receivables, receivables, new_receivables), unit)
+        for organization_id, (churn_customers, customers, new_customers,
+            churn_receivables, receivables, new_receivables, unit)
+        in six.iteritems(results)}
+
+
 def aggregate_transactions_change_by_period(organization, account, date_periods,
     account_title=None, orig='orig', dest='dest'):
     """
     12 months of total/new/churn into or out of (see *reverse*) *account*
     and associated distinct customers as extracted from Transactions.
     """
+    #pylint: disable=too-many-arguments
+    customers, account_totals, unit = _aggregate_transactions_change_by_period(
+        organization, account, date_periods=date_periods, orig=orig, dest=dest)
+    return _as_change_tables(account, date_periods, customers, account_totals,
+        unit, account_title=account_title)
+
+
+def bulk_aggregate_transactions_change_by_period(organizations, account,
+    date_periods, account_title=None, orig='orig', dest='dest'):
+    """
+    Returns ``aggregate_transactions_change_by_period`` for each
+    organization in *organizations* as a dictionary keyed by
+    organization pk, using the same queries for all organizations.
+    """
+    #pylint: disable=too-many-arguments
+    results = {}
+    for organization_id, (customers, account_totals, unit) in six.iteritems(
+            _bulk_aggregate_transactions_change_by_period(organizations,
+            account, date_periods=date_periods, orig=orig, dest=dest)):
+        results[organization_id] = _as_change_tables(account, date_periods,
+            customers, account_totals, unit, account_title=account_title)
+    return results
+
+
+def _as_change_tables(account, date_periods, customers, account_totals, unit,
+                      account_title=None):
     #pylint: disable=too-many-locals,too-many-arguments,invalid-name
     if not account_title:
         account_title = str(account)
-    customers, account_totals, unit = _aggregate_transactions_change_by_period(
-        organization, account, date_periods=date_periods, orig=orig, dest=dest)
     churned_custs, total_custs, new_custs = customers
     churned_account, total_account, new_account = account_totals
     net_new_custs = []
@@ -339,10 +587,15 @@ def active_subscribers(plan, from_date=None, tz=None):
     """
     #pylint:disable=invalid-name
     values = []
-    for end_period in convert_dates_to_utc(month_periods(
-                            from_date=from_date, tz=tz)):
-        values.append([end_period,
-            Subscription.objects.active_at(end_period, plan=plan).count()])
+    dates = convert_dates_to_utc(month_periods(from_date=from_date, tz=tz))
+    facts = dict(MetricFact.objects.filter(plan=plan, interval=Plan.DAILY,
+        ends_at__in=dates).values_list('ends_at', 'active_subscribers'))
+    for end_period in dates:
+        if end_period in facts:
+            values.append([end_period, facts[end_period]])
+        else:
+            values.append([end_period,
+                Subscription.objects.active_at(end_period, plan=plan).count()])
     return values
 
 
@@ -378,6 +631,83 @@ def quaterly_balances(organization=None, account=None, like_account=None,
         until=until, step_months=3)
 
 
+def monthly_balances_by_selector(selectors, until=None, step_months=1,
+                                 tz=None):
+    """
+    Returns the monthly balances (and unit) of all accounts matching
+    each selector in *selectors*, keyed by selector, as
+    ``monthly_balances(like_account=selector)`` would.
+
+    Instead of scanning the ledger for each selector and each month,
+    selectors are resolved to concrete account names first. Amounts are
+    then aggregated once per (account, unit, month) in the database
+    and summed into the cumulative balance of each selector.
+    """
+    #pylint:disable=invalid-name,too-many-locals
+    dates = convert_dates_to_utc(month_periods(
+        from_date=until, step_months=step_months, tz=tz))
+    accounts_by_selector = {}
+    for selector in selectors:
+        if selector not in accounts_by_selector:
+            accounts_by_selector.update({selector: set(
+                Transaction.objects.get_accounts_like(selector))})
+    matched_accounts = set([])
+    for selector_accounts in six.itervalues(accounts_by_selector):
+        matched_accounts |= selector_accounts
+
+    # ``period`` is the index of the first date in ``dates`` the transaction
+    # was created before, such that the balance at ``dates[idx]`` is the sum
+    # of all amounts for periods up to ``idx``.
+    period = Case(*[When(created_at__lt=end_period, then=Value(idx))
+        for idx, end_period in enumerate(dates)],
+        output_field=IntegerField())
+    amounts = {}
+    for side, sign in (('dest', 1), ('orig', -1)):
+        kwargs = {'created_at__lt': dates[-1],
+            '%s_account__in' % side: matched_accounts}
+        for row in Transaction.objects.filter(**kwargs).annotate(
+                period=period).values('%s_account' % side, '%s_unit' % side,
+                'period').annotate(amount=Sum('%s_amount' % side)):
+            key = (row['%s_account' % side], row['%s_unit' % side])
+            if key not in amounts:
+                amounts[key] = [0] * len(dates)
+            amounts[key][row['period']] += sign * row['amount']
+
+    results = {}
+    for selector, selector_accounts in six.iteritems(accounts_by_selector):
+        balances_by_unit = {}
+        for key, period_amounts in six.iteritems(amounts):
+            account, unit = key
+            if account not in selector_accounts:
+                continue
+            if unit not in balances_by_unit:
+                balances_by_unit[unit] = [0] * len(dates)
+            balance = 0
+            for idx, amount in enumerate(period_amounts):
+                balance += amount
+                balances_by_unit[unit][idx] += balance
+        values = []
+        # The unit is the one of the matched transactions, or `None` when
+        # there are none, such that an empty line does not override
+        # the unit of the whole sheet.
+        unit = None
+        if balances_by_unit:
+            unit = sorted(balances_by_unit.keys())[0]
+        for idx, end_period in enumerate(dates):
+            balances = [(_unit, unit_balances[idx])
+                for _unit, unit_balances in six.iteritems(balances_by_unit)
+                if unit_balances[idx] != 0]
+            if len(balances) > 1:
+                raise ValueError(_("balances with multiple currency units"\
+                    " (%s)") % str(balances))
+            balance = 0
+            if balances:
+                unit, balance = balances[0]
+            values.append([end_period, balance])
+        results.update({selector: (values, unit)})
+    return results
+
+
 def churn_subscribers(plan=None, from_date=None, tz=None):
     """
     List of churn subscribers from the previous period for a *plan*.
@@ -389,13 +719,235 @@ def churn_subscribers(plan=None, from_date=None, tz=None):
     kwargs = {}
     if plan:
         kwargs = {'plan': plan}
+    facts = {}
+    for fact in MetricFact.objects.filter(plan=plan, interval=Plan.MONTHLY,
+            ends_at__in=dates[1:]).values('organization', 'starts_at',
+            'ends_at', 'churned_subscribers'):
+        facts.setdefault((fact['starts_at'], fact['ends_at']), {}).update({
+            fact['organization']: fact['churned_subscribers']})
+    # Providers which had subscribers at some point are expected to have
+    # been rolled up by ``compile_stats``. When totaling across all plans,
+    # we only rely on the facts if none of those providers is missing.
+    firsts = {}
+    if not plan:
+        firsts = dict(Subscription.objects.values_list(
+            'plan__organization').annotate(Min('created_at')))
     for end_period in dates[1:]:
-        values.append([end_period, Subscription.objects.churn_in_period(
-            start_period, end_period, **kwargs).count()])
+        churned = facts.get((start_period, end_period), {})
+        expected = set([provider_id
+            for provider_id, first in six.iteritems(firsts)
+            if first < end_period])
+        if churned and expected.issubset(set(churned.keys())):
+            values.append([end_period, sum(churned.values())])
+        else:
+            values.append([end_period, Subscription.objects.churn_in_period(
+                start_period, end_period, **kwargs).count()])
         start_period = end_period
     return values
 
+def get_natural_intervals(organization_ids):
+    """
+    Returns ``Organization.natural_interval`` for each organization
+    in *organization_ids* as a dictionary keyed by organization id.
+    """
+    results = {organization_id: Plan.MONTHLY
+        for organization_id in organization_ids}
+    with_plans = set([])
+    for organization_id, interval in Plan.objects.filter(
+            organization__in=organization_ids).values_list(
+            'organization', 'interval').distinct():
+        if organization_id not in with_plans:
+            with_plans.add(organization_id)
+            results[organization_id] = Plan.YEARLY
+        results[organization_id] = min(results[organization_id], interval)
+    return results
+
+
 def get_different_units(*args):
     # removing None and duplicate values
     units = {_unit for _unit in args if _unit is not None}
     return list(units)
+
+
+def get_facts_by_period(organization, date_periods, plan=None,
+                        interval=Plan.MONTHLY):
+    """
+    Returns the ``MetricFact`` rolled up for *organization* (and *plan*)
+    which exactly match a period in *date_periods*, keyed by the tuple
+    (starts_at, ends_at).
+    """
+    facts = {}
+    for fact in MetricFact.objects.filter(organization=organization,
+            plan=plan, interval=interval, ends_at__in=date_periods[1:]):
+        facts.update({(fact.starts_at, fact.ends_at): fact})
+    return facts
+
+
+def _aggregate_amounts_by_period(organization, field, date_periods):
+    """
+    Returns counts, amounts and unit of *field* (i.e. receivables, payments,
+    refunds or income) for *organization* as computed from the ledger.
+    """
+    if field == 'receivables':
+        return aggregate_transactions_by_period(
+            organization, Transaction.RECEIVABLE,
+            orig='orig', dest='dest',
+            date_periods=date_periods)
+    if field == 'payments':
+        return aggregate_transactions_by_period(
+            organization, Transaction.RECEIVABLE,
+            orig='dest', dest='dest',
+            orig_account=Transaction.BACKLOG,
+            orig_organization=organization,
+            date_periods=date_periods)
+    if field == 'refunds':
+        return aggregate_transactions_by_period(
+            organization, Transaction.REFUND,
+            orig='dest', dest='dest',
+            date_periods=date_periods)
+    if field == 'income':
+        return aggregate_transactions_by_period(
+            organization, Transaction.INCOME,
+            orig='orig', dest='orig',
+            date_periods=date_periods)
+    raise ValueError("unknown field '%s'" % field)
+
+
+def aggregate_amounts_by_period(organization, field, date_periods):
+    """
+    Returns the amounts of *field* (i.e. receivables, payments, refunds
+    or income) for *organization* over each period in *date_periods*
+    and the currency unit.
+
+    Periods which were rolled up by the ``compile_stats`` command are read
+    from ``MetricFact``. Other periods (typically the period in progress)
+    are computed from the ledger.
+    """
+    amounts = []
+    unit = None
+    facts = get_facts_by_period(organization, date_periods)
+    period_start = date_periods[0]
+    for period_end in date_periods[1:]:
+        fact = facts.get((period_start, period_end))
+        if fact:
+            amount = getattr(fact, field)
+            _unit = fact.unit if amount else None
+        else:
+            _, period_amounts, _unit = _aggregate_amounts_by_period(
+                organization, field, [period_start, period_end])
+            amount = period_amounts[0][1]
+        if _unit:
+            unit = _unit
+        amounts += [(period_end, amount)]
+        period_start = period_end
+    return amounts, unit
+
+
+def _rollup_period(provider, plans, interval, starts_at, ends_at):
+    """
+    Returns the ``MetricFact`` for *provider* and each of its *plans*
+    over [*starts_at*, *ends_at*[.
+    """
+    #pylint:disable=too-many-arguments,too-many-locals
+    facts = {}
+    for plan in plans:
+        facts.update({plan.pk: MetricFact(organization=provider, plan=plan,
+            interval=interval, starts_at=starts_at, ends_at=ends_at,
+            active_subscribers=Subscription.objects.active_at(
+                ends_at, plan=plan).count(),
+            new_subscribers=Subscription.objects.valid_for(plan=plan,
+                created_at__gte=starts_at, created_at__lt=ends_at).count(),
+            churned_subscribers=Subscription.objects.churn_in_period(
+                starts_at, ends_at, plan=plan).count(),
+            unit=plan.unit)})
+
+    # Receivables and income we can trace back to a plan through
+    # ``Transaction.subscription``.
+    for row in Transaction.objects.filter(
+            created_at__gte=starts_at, created_at__lt=ends_at,
+            orig_organization=provider,
+            orig_account__in=[Transaction.RECEIVABLE, Transaction.INCOME],
+            subscription__isnull=False).values(
+            'orig_account', 'subscription__plan').annotate(
+            dest_total=Sum('dest_amount'), orig_total=Sum('orig_amount')):
+        fact = facts.get(row['subscription__plan'])
+        if fact is None:
+            continue
+        if row['orig_account'] == Transaction.RECEIVABLE:
+            fact.receivables += row['dest_total']
+        else:
+            fact.income += row['orig_total']
+
+    total = MetricFact(organization=provider, plan=None,
+        interval=interval, starts_at=starts_at, ends_at=ends_at)
+    for fact in six.itervalues(facts):
+        total.active_subscribers += fact.active_subscribers
+        total.new_subscribers += fact.new_subscribers
+        total.churned_subscribers += fact.churned_subscribers
+    for field in ('receivables', 'payments', 'refunds', 'income'):
+        counts, amounts, unit = _aggregate_amounts_by_period(
+            provider, field, [starts_at, ends_at])
+        setattr(total, field, amounts[0][1])
+        if unit:
+            total.unit = unit
+        if field == 'receivables':
+            total.customers = counts[0][1]
+    if interval == Plan.MONTHLY:
+        # New and churned customers are defined in comparison
+        # to the previous natural period, hence cannot be summed
+        # from daily facts.
+        customers, receivables, _ = _aggregate_transactions_change_by_period(
+            provider, Transaction.RECEIVABLE, [starts_at, ends_at])
+        churned_custs, _, new_custs = customers
+        churned_receivables, _, new_receivables = receivables
+        total.churned_customers = churned_custs[0][1]
+        total.new_customers = new_custs[0][1]
+        total.churned_receivables = churned_receivables[0][1]
+        total.new_receivables = new_receivables[0][1]
+    return [total] + list(six.itervalues(facts))
+
+
+def rollup_metrics(provider, until=None, dry_run=False):
+    """
+    Rolls up the daily and monthly ``MetricFact`` for *provider* over
+    all full periods (in UTC) ending before *until* that were not
+    previously rolled up.
+
+    The function is idempotent. Calling it multiple times with the same
+    *until* will only roll up each period once.
+    """
+    until = datetime_or_now(until).astimezone(utc)
+    until = datetime(until.year, until.month, until.day, tzinfo=utc)
+    # We start rolling up metrics at the first activity for the provider.
+    firsts = [first for first in [
+        Transaction.objects.filter(
+            Q(orig_organization=provider) | Q(dest_organization=provider)
+        ).aggregate(Min('created_at'))['created_at__min'],
+        Subscription.objects.filter(plan__organization=provider).aggregate(
+            Min('created_at'))['created_at__min']] if first]
+    if not firsts:
+        return
+    first = min(firsts).astimezone(utc)
+    first = datetime(first.year, first.month, first.day, tzinfo=utc)
+    plans = list(Plan.objects.filter(organization=provider))
+    for interval, delta, starts_at in [
+            (Plan.DAILY, relativedelta(days=1), first),
+            (Plan.MONTHLY, relativedelta(months=1), first.replace(day=1))]:
+        last = MetricFact.objects.filter(organization=provider,
+            plan=None, interval=interval).aggregate(
+            Max('ends_at'))['ends_at__max']
+        if last:
+            starts_at = last
+        while starts_at + delta <= until:
+            ends_at = starts_at + delta
+            LOGGER.info("rollup %s metrics for %s over [%s, %s[",
+                dict(MetricFact.INTERVAL_CHOICES)[interval], provider,
+                starts_at.isoformat(), ends_at.isoformat())
+            facts = _rollup_period(provider, plans,
+                interval, starts_at, ends_at)
+            if not dry_run:
+                with transaction.atomic():
+                    MetricFact.objects.filter(organization=provider,
+                        interval=interval, starts_at=starts_at).delete()
+                    MetricFact.objects.bulk_create(facts)
+            starts_at = ends_at
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0008_0_3_4'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricFact',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('interval', models.PositiveSmallIntegerField(choices=[(2, 'DAILY'), (4, 'MONTHLY')])),
+                ('starts_at', models.DateTimeField()),
+                ('ends_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('active_subscribers', models.PositiveIntegerField(default=0, help_text='Number of active subscriptions at ends_at')),
+                ('new_subscribers', models.PositiveIntegerField(default=0, help_text='Number of subscriptions created in the period')),
+                ('churned_subscribers', models.PositiveIntegerField(default=0, help_text='Number of subscriptions which ended in the period')),
+                ('customers', models.PositiveIntegerField(default=0, help_text='Number of distinct customers invoiced in the period')),
+                ('new_customers', models.PositiveIntegerField(default=0)),
+                ('churned_customers', models.PositiveIntegerField(default=0)),
+                ('receivables', models.BigIntegerField(default=0, help_text='Amount invoiced in the period in currency unit')),
+                ('new_receivables', models.BigIntegerField(default=0)),
+                ('churned_receivables', models.BigIntegerField(default=0)),
+                ('payments', models.BigIntegerField(default=0, help_text='Amount paid in the period in currency unit')),
+                ('refunds', models.BigIntegerField(default=0, help_text='Amount refunded in the period in currency unit')),
+                ('income', models.BigIntegerField(default=0, help_text='Income recognized in the period in currency unit')),
+                ('unit', models.CharField(default='usd', max_length=3)),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='metric_facts', to='saas.Organization')),
+                ('plan', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='metric_facts', to='saas.Plan')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='metricfact',
+            unique_together=set([('organization', 'plan', 'interval', 'starts_at')]),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_ledger_accounts(apps, schema_editor):
+    #pylint:disable=unused-argument
+    Transaction = apps.get_model('saas', 'Transaction')
+    LedgerAccount = apps.get_model('saas', 'LedgerAccount')
+    accounts = (set(Transaction.objects.values_list(
+        'orig_account', flat=True).distinct())
+        | set(Transaction.objects.values_list(
+        'dest_account', flat=True).distinct()))
+    LedgerAccount.objects.bulk_create([
+        LedgerAccount(name=account) for account in accounts])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0009_metricfact'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerAccount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='transaction',
+            index_together=set([('dest_account', 'created_at'), ('orig_account', 'created_at')]),
+        ),
+        migrations.RunPython(populate_ledger_accounts,
+            migrations.RunPython.noop),
+    ]
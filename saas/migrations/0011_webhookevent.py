@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 23:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0010_ledgeraccount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(help_text='Unique identifier of the event on the processor', max_length=255, unique=True)),
+                ('event_type', models.CharField(max_length=255)),
+                ('object_key', models.CharField(help_text='Processor key of the object (ex: charge) the event refers to', max_length=255, null=True)),
+                ('payload', models.TextField()),
+                ('created_at', models.DateTimeField(help_text='Date/time the event was created by the processor')),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('state', models.PositiveSmallIntegerField(choices=[(0, 'pending'), (1, 'done'), (2, 'failed')], default=0)),
+                ('nb_attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(null=True)),
+                ('last_error', models.TextField(null=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='webhookevent',
+            index_together=set([('state', 'next_attempt_at')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0011_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='processor_reconciled_at',
+            field=models.DateTimeField(blank=True, help_text='Date/time of the last payout reconciled with the processor', null=True),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 23:05
+from __future__ import unicode_literals
+
+import re
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_event_references(apps, schema_editor):
+    #pylint:disable=unused-argument
+    Transaction = apps.get_model('saas', 'Transaction')
+    Subscription = apps.get_model('saas', 'Subscription')
+    UseCharge = apps.get_model('saas', 'UseCharge')
+    Charge = apps.get_model('saas', 'Charge')
+    subscription_ids = set(Subscription.objects.values_list('pk', flat=True))
+    use_charge_ids = set(UseCharge.objects.values_list('pk', flat=True))
+    charge_ids = set(Charge.objects.values_list('pk', flat=True))
+    # There are far less distinct event_id than transactions so we issue
+    # one update per event_id.
+    for event_id in Transaction.objects.filter(
+            models.Q(event_id__startswith='sub_')
+            | models.Q(event_id__startswith='cha_')).values_list(
+            'event_id', flat=True).distinct().iterator():
+        kwargs = {}
+        look = re.match(r'sub_(\d+)/((\d+)/)?', event_id)
+        if look:
+            subscription_id = int(look.group(1))
+            if subscription_id in subscription_ids:
+                kwargs.update({'subscription_id': subscription_id})
+            use_charge_id = int(look.group(3)) if look.group(3) else None
+            if use_charge_id in use_charge_ids:
+                kwargs.update({'use_charge_id': use_charge_id})
+        look = re.match(r'cha_(\d+)/', event_id)
+        if look:
+            charge_id = int(look.group(1))
+            if charge_id in charge_ids:
+                kwargs.update({'charge_id': charge_id})
+        if kwargs:
+            Transaction.objects.filter(event_id=event_id).update(**kwargs)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0013_chargeidempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='charge',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='saas.Charge'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='subscription',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='saas.Subscription'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='use_charge',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='saas.UseCharge'),
+        ),
+        migrations.RunPython(populate_event_references,
+            migrations.RunPython.noop),
+    ]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 23:20
+from __future__ import unicode_literals
+
+import logging
+
+from django.conf import settings
+from django.db import DatabaseError, migrations, models, transaction
+from django.utils import six
+
+
+LOGGER = logging.getLogger(__name__)
+
+SEARCH_DOCUMENT_FIELDS = ('slug', 'full_name', 'email', 'phone',
+    'street_address', 'locality', 'region', 'postal_code', 'country')
+
+
+def get_search_document(instance, fields):
+    # Frozen copy of ``saas.search.get_search_document`` at the time
+    # of this migration.
+    return '\n'.join([six.text_type(getattr(instance, field) or "")
+        for field in fields]).lower()
+
+
+def populate_search_documents(apps, schema_editor):
+    #pylint:disable=unused-argument
+    Organization = apps.get_model('saas', 'Organization')
+    for organization in Organization.objects.all().iterator():
+        Organization.objects.filter(pk=organization.pk).update(
+            search_document=get_search_document(
+                organization, SEARCH_DOCUMENT_FIELDS))
+
+
+def get_trigram_indexes(apps):
+    """
+    Returns (table, column, expression) searched with ``contains``
+    or ``icontains`` (i.e. ``UPPER(column) LIKE``) by the list views.
+    """
+    user_table = apps.get_model(settings.AUTH_USER_MODEL)._meta.db_table
+    return ([('saas_organization', 'search_document', 'search_document')]
+        + [('saas_organization', column, 'UPPER(%s)' % column)
+        for column in ('slug', 'full_name', 'email')]
+        + [(user_table, column, 'UPPER(%s)' % column)
+        for column in ('username', 'email', 'first_name', 'last_name')])
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            for table, column, expr in get_trigram_indexes(apps):
+                schema_editor.execute("CREATE INDEX %s_%s_trgm ON %s"\
+                    " USING gin (%s gin_trgm_ops)" % (
+                    table, column, table, expr))
+    except DatabaseError as err:
+        # The extension requires privileges the database user might
+        # not have. Searches still work, only slower.
+        LOGGER.warning("cannot create trigram indexes: %s", err)
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for table, column, _ in get_trigram_indexes(apps):
+            schema_editor.execute(
+                "DROP INDEX IF EXISTS %s_%s_trgm" % (table, column))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('saas', '0014_transaction_event_references'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='search_document',
+            field=models.TextField(default='', editable=False, help_text='Lowercase text of the fields matched by the search backend'),
+        ),
+        migrations.RunPython(populate_search_documents,
+            migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
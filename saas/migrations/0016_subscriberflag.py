@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 23:40
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Min
+import django.db.models.deletion
+
+
+def populate_subscriber_flags(apps, schema_editor):
+    #pylint:disable=unused-argument
+    Subscription = apps.get_model('saas', 'Subscription')
+    SubscriberFlag = apps.get_model('saas', 'SubscriberFlag')
+    SubscriberFlag.objects.bulk_create([
+        SubscriberFlag(user_id=user_id, subscribed_at=subscribed_at)
+        for user_id, subscribed_at in Subscription.objects.filter(
+            organization__role__isnull=False).values_list(
+            'organization__role__user').annotate(Min('created_at'))])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('saas', '0015_organization_search_document'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriberFlag',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='subscriber_flag', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('subscribed_at', models.DateTimeField(db_index=True, help_text='Date/time the earliest subscription was created')),
+            ],
+        ),
+        migrations.RunPython(populate_subscriber_flags,
+            migrations.RunPython.noop),
+    ]
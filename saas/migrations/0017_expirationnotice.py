@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0016_subscriberflag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='card_exp_date',
+            field=models.DateField(blank=True, help_text='Expiration date of the card on file as last retrieved from the processor', null=True),
+        ),
+        migrations.CreateModel(
+            name='ExpirationNotice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('expires_soon', 'expires soon'), ('card_expires_soon', 'card expires soon'), ('subscription_upgrade', 'subscription upgrade'), ('payment_method_absent', 'payment method absent')], max_length=32)),
+                ('nb_days', models.PositiveSmallIntegerField(help_text='Number of days before the expiration')),
+                ('notice_date', models.DateField(help_text='Day the renewals job recorded the notice')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('state', models.PositiveSmallIntegerField(choices=[(0, 'pending'), (1, 'done'), (2, 'failed')], default=0)),
+                ('nb_attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField()),
+                ('last_error', models.TextField(null=True)),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='saas.Organization')),
+                ('subscription', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='saas.Subscription')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='expirationnotice',
+            index_together=set([('state', 'next_attempt_at')]),
+        ),
+    ]
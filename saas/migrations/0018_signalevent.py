@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 23:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0017_expirationnotice'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SignalEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('signal_name', models.CharField(max_length=100)),
+                ('sender', models.CharField(max_length=255)),
+                ('object_key', models.CharField(help_text='Organization the signal refers to. Signals for the same organization are delivered in order', max_length=255, null=True)),
+                ('payload', models.TextField()),
+                ('created_at', models.DateTimeField()),
+                ('state', models.PositiveSmallIntegerField(choices=[(0, 'pending'), (1, 'done'), (2, 'failed')], default=0)),
+                ('nb_attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(null=True)),
+                ('last_error', models.TextField(null=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='signalevent',
+            index_together=set([('state', 'next_attempt_at')]),
+        ),
+    ]
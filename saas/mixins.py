@@ -24,15 +24,21 @@
 from __future__ import unicode_literals
 
 import re
+from hashlib import sha256
 
 import dateutil
 from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
 from django.db.models import Q
+from django.db.models.functions import Lower
+from django.utils import six
 from django.http import Http404
 from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic.detail import SingleObjectMixin
-from extra_views.contrib.mixins import SearchableListMixin, SortableListMixin
+from extra_views.contrib.mixins import (
+    SearchableListMixin as BaseSearchableListMixin, SortableListMixin)
 from rest_framework.generics import get_object_or_404
 
 from . import settings
@@ -41,9 +47,10 @@ from .filters import (SortableSearchableFilterBackend,
     SortableDateRangeSearchableFilterBackend)
 from .humanize import (as_money, DESCRIBE_BUY_PERIODS, DESCRIBE_BUY_USE,
     DESCRIBE_UNLOCK_NOW, DESCRIBE_UNLOCK_LATER, DESCRIBE_BALANCE)
-from .models import (CartItem, Charge, Coupon, Organization, Plan,
+from .models import (CartItem, Charge, Coupon, Organization, Plan, Price,
     RoleDescription, Subscription, Transaction, UseCharge,
-    get_broker, is_broker)
+    get_broker, get_sub_event_id, is_broker)
+from .search import get_search_backend
 from .utils import (datetime_or_now, get_role_model, start_of_day,
     update_context_urls)
 from .extras import OrganizationMixinBase
@@ -178,15 +185,112 @@ class CartMixin(object):
             request.session['cart_items'] = cart_items
         return inserted_item, created
 
+    @staticmethod
+    def insert_items(request, plan, items):
+        """
+        Bulk version of ``insert_item`` for a single *plan*.
+
+        *items* is an iterable of dictionaries with ``first_name``,
+        ``last_name``, ``sync_on`` and optionally ``option``
+        and ``invoice_key`` keys. Returns a list of (cart item, created)
+        pairs in the order of *items*.
+
+        The cart of an authenticated user is loaded once, then new items
+        are created in bulk. An item whose ``sync_on`` is already
+        in the cart is reported as updated.
+        """
+        #pylint: disable=too-many-locals
+        if not isinstance(plan, Plan):
+            plan = get_object_or_404(Plan.objects.all(), slug=plan)
+        if not is_authenticated(request):
+            return [CartMixin.insert_item(request, plan=plan, **item)
+                for item in items]
+
+        results = []
+        new_items = []
+        updated_items = []
+        redeemed = request.session.get('redeemed', None)
+        cart_items = list(CartItem.objects.get_cart(
+            request.user, plan=plan).order_by('-sync_on'))
+        template_item = cart_items[0] if cart_items else None
+        by_sync_on = {cart_item.sync_on: cart_item
+            for cart_item in cart_items if cart_item.sync_on}
+        for item in items:
+            sync_on = item.get('sync_on', "")
+            option = item.get('option', 0)
+            first_name = item.get('first_name', '')
+            last_name = item.get('last_name', '')
+            if sync_on and sync_on in by_sync_on:
+                results += [(by_sync_on[sync_on], False)]
+            elif template_item and (
+                    not sync_on or not template_item.sync_on):
+                # Use template CartItem
+                template_item.first_name = first_name
+                template_item.last_name = last_name
+                if sync_on:
+                    if option > 0:
+                        template_item.option = option
+                    template_item.sync_on = sync_on
+                    by_sync_on[sync_on] = template_item
+                else:
+                    template_item.option = option
+                if template_item not in updated_items:
+                    updated_items += [template_item]
+                results += [(template_item, False)]
+            else:
+                if template_item:
+                    # Copy/Replace in template CartItem
+                    inserted_item = CartItem(
+                        user=request.user,
+                        plan=template_item.plan,
+                        use=template_item.use,
+                        coupon=template_item.coupon,
+                        option=option if option > 0 else template_item.option,
+                        first_name=first_name,
+                        last_name=last_name,
+                        sync_on=sync_on,
+                        claim_code=item.get('invoice_key', None))
+                else:
+                    # New CartItem
+                    if redeemed and not isinstance(redeemed, Coupon):
+                        redeemed = Coupon.objects.active(
+                            plan.organization, redeemed).first()
+                    inserted_item = CartItem(
+                        plan=plan, coupon=redeemed,
+                        user=request.user,
+                        option=option,
+                        first_name=first_name,
+                        last_name=last_name,
+                        sync_on=sync_on,
+                        claim_code=item.get('invoice_key', None))
+                    template_item = inserted_item
+                if sync_on:
+                    by_sync_on[sync_on] = inserted_item
+                new_items += [inserted_item]
+                results += [(inserted_item, True)]
+
+        with transaction.atomic():
+            # Django has no ``bulk_update``. At most one template item,
+            # the one without ``sync_on``, is ever updated here.
+            for cart_item in updated_items:
+                if cart_item.pk:
+                    cart_item.save()
+            CartItem.objects.bulk_create(new_items)
+        return results
+
     @staticmethod
     def get_invoicable_options(subscription, created_at=None,
-                               prorate_to=None, cart_item=None):
+                               prorate_to=None, cart_item=None, pricing=None):
         """
         Return a set of lines that must charged Today and a set of choices
         based on current subscriptions that the user might be willing
         to charge Today.
+
+        When a *pricing* dictionary is passed, the amount and description
+        of each option are memoized per plan, period end and discount such
+        that subscriptions sharing those only differ by their subscriber.
         """
-        #pylint: disable=too-many-locals
+        #pylint: disable=too-many-locals,too-many-arguments
         created_at = datetime_or_now(created_at)
         option_items = []
         plan = subscription.plan
@@ -209,6 +313,18 @@ class CartMixin(object):
                 else:
                     descr_suffix = '(code: %s)' % coupon.code
 
+        pricing_key = (plan.pk, subscription.ends_at, prorated_amount,
+            discount_percent, descr_suffix)
+        if pricing is not None and pricing_key in pricing:
+            event_id = None
+            if subscription.id:
+                event_id = get_sub_event_id(subscription)
+            return [Transaction.objects.new_payable(
+                subscription.organization, Price(amount, plan.unit),
+                plan.organization, descr,
+                event_id=event_id, created_at=created_at)
+                for amount, descr in pricing[pricing_key]]
+
         first_periods_amount = plan.first_periods_amount(
             discount_percent=discount_percent,
             prorated_amount=prorated_amount)
@@ -250,11 +366,75 @@ class CartMixin(object):
                     discount_percent=discount_percent,
                     descr_suffix=descr_suffix)]
 
+        if pricing is not None:
+            pricing[pricing_key] = [(option_item.dest_amount,
+                option_item.descr) for option_item in option_items]
         return option_items
 
-    def as_invoicables(self, user, customer, at_time=None):
+    @staticmethod
+    def get_cart_items(user):
+        """
+        Returns the cart items of *user* with the related records
+        ``as_invoicables`` needs.
+        """
+        return CartItem.objects.get_cart(user=user).select_related(
+            'plan__organization', 'use', 'coupon')
+
+    @staticmethod
+    def get_cart_version(cart_items, customer):
+        """
+        Returns a digest of *cart_items* checked out as *customer*
+        which changes whenever a cart item is added, updated or removed,
+        or when the plans and coupons it refers to, or the billing cycle
+        of *customer*, change.
+        """
+        version = sha256(('%s' % ((customer.pk, customer.billing_start),)
+            ).encode('utf-8'))
+        for cart_item in cart_items:
+            plan = cart_item.plan
+            coupon = cart_item.coupon
+            version.update(('%s' % (((cart_item.pk, cart_item.plan_id,
+                cart_item.use_id, cart_item.coupon_id, cart_item.option,
+                cart_item.quantity, cart_item.first_name, cart_item.last_name,
+                cart_item.sync_on, cart_item.claim_code),
+                (plan.is_active, plan.discontinued_at, plan.unit,
+                plan.setup_amount, plan.period_amount, plan.transaction_fee,
+                plan.interval, plan.period_length, plan.advance_discount,
+                plan.length, plan.unlock_event),
+                (coupon.code, coupon.percent, coupon.plan_id, coupon.ends_at,
+                coupon.nb_attempts) if coupon else None),)).encode('utf-8'))
+        return version.hexdigest()
+
+    def as_cached_invoicables(self, request, customer):
+        """
+        Returns ``as_invoicables`` for ``request.user`` checking out
+        as *customer*.
+
+        The invoicables are cached per session and are reused for
+        ``CART['CACHE_TIMEOUT']`` seconds as long as the cart version
+        does not change, such that rendering the cart multiple times
+        does not compute them again. Placing an order must always call
+        ``as_invoicables`` so that the customer is charged current prices.
+        """
+        session_key = getattr(request.session, 'session_key', None)
+        if not (settings.CART_CACHE_TIMEOUT and session_key):
+            return self.as_invoicables(request.user, customer)
+        cart_items = list(self.get_cart_items(request.user))
+        version = self.get_cart_version(cart_items, customer)
+        cache = caches[settings.CART_CACHE]
+        key = 'saas.invoicables.%s.%s' % (session_key, customer.pk)
+        cached = cache.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+        invoicables = self.as_invoicables(request.user, customer,
+            cart_items=cart_items)
+        cache.set(key, (version, invoicables), settings.CART_CACHE_TIMEOUT)
+        return invoicables
+
+    def as_invoicables(self, user, customer, at_time=None, cart_items=None):
         """
-        Returns a list of invoicables from the cart of a request user.
+        Returns a list of invoicables from the cart of a request user
+        (or from *cart_items* when the cart was already loaded).
 
         invoicables = [
                 { "subscription": Subscription,
@@ -288,38 +468,89 @@ class CartMixin(object):
             # than created_at but no more than one period in the future.
             prorate_to = customer.billing_start
         invoicables = []
-        for cart_item in CartItem.objects.get_cart(user=user):
-            for_descr = ''
+        if cart_items is None:
+            cart_items = list(self.get_cart_items(user))
+
+        # Organizations and users the items are bought for, as well as
+        # subscriptions that could be extended, are looked up all at once.
+        sync_ons = set([cart_item.sync_on
+            for cart_item in cart_items if cart_item.sync_on])
+        emails = set([sync_on.lower() for sync_on in sync_ons])
+        organizations_by_slug = {}
+        organizations_by_email = {}
+        usernames = set([])
+        user_emails = set([])
+        if sync_ons:
+            for organization in Organization.objects.annotate(
+                    email_lower=Lower('email')).filter(
+                    Q(slug__in=sync_ons) | Q(email_lower__in=emails)):
+                organizations_by_slug.update({organization.slug: organization})
+                organizations_by_email.setdefault(
+                    organization.email_lower, []).append(organization)
+            for sync_user in get_user_model().objects.annotate(
+                    email_lower=Lower('email')).filter(
+                    Q(username__in=sync_ons) | Q(email_lower__in=emails)):
+                usernames |= set([sync_user.username])
+                user_emails |= set([sync_user.email_lower])
+        subscribers = {}
+        for cart_item in cart_items:
             organization = customer
+            if cart_item.sync_on:
+                found = {match.pk: match
+                    for match in organizations_by_email.get(
+                        cart_item.sync_on.lower(), [])}
+                if cart_item.sync_on in organizations_by_slug:
+                    match = organizations_by_slug[cart_item.sync_on]
+                    found.update({match.pk: match})
+                if len(found) > 1:
+                    raise Organization.MultipleObjectsReturned(
+                        "%d organizations match '%s'" % (
+                        len(found), cart_item.sync_on))
+                if found:
+                    organization = list(found.values())[0]
+                elif not (cart_item.sync_on in usernames
+                          or cart_item.sync_on.lower() in user_emails):
+                    # XXX Hacky way to determine GroupBuy vs. notify.
+                    organization = Organization(
+                        full_name='%s %s' % (
+                            cart_item.first_name, cart_item.last_name),
+                        email=cart_item.sync_on)
+            subscribers.update({cart_item.pk: organization})
+        subscriptions = {}
+        subscriber_ids = set([organization.pk
+            for organization in six.itervalues(subscribers)
+            if organization.pk])
+        if subscriber_ids:
+            # If we can extend a current ``Subscription`` we will.
+            # XXX For each (organization, plan) there should not
+            #     be overlapping timeframe [created_at, ends_at[,
+            #     None-the-less, it might be a good idea to catch
+            #     and throw a nice error message in case.
+            for subscription in Subscription.objects.filter(
+                    organization__in=subscriber_ids,
+                    plan__in=set([cart_item.plan_id
+                        for cart_item in cart_items]),
+                    ends_at__gt=datetime_or_now()):
+                key = (subscription.organization_id, subscription.plan_id)
+                if key in subscriptions:
+                    raise Subscription.MultipleObjectsReturned(
+                        "overlapping subscriptions of %s to %s" % key)
+                subscriptions.update({key: subscription})
+
+        pricing = {}
+        for cart_item in cart_items:
+            for_descr = ''
+            organization = subscribers[cart_item.pk]
             if cart_item.sync_on:
                 full_name = ' '.join([
                         cart_item.first_name, cart_item.last_name]).strip()
                 for_descr = ', for %s (%s)' % (full_name, cart_item.sync_on)
-                organization_queryset = Organization.objects.filter(
-                    Q(slug=cart_item.sync_on)
-                    | Q(email__iexact=cart_item.sync_on))
-                if organization_queryset.exists():
-                    organization = organization_queryset.get()
-                else:
-                    user_queryset = get_user_model().objects.filter(
-                        Q(username=cart_item.sync_on)
-                        | Q(email__iexact=cart_item.sync_on))
-                    if not user_queryset.exists():
-                        # XXX Hacky way to determine GroupBuy vs. notify.
-                        organization = Organization(
-                            full_name='%s %s' % (
-                                cart_item.first_name, cart_item.last_name),
-                            email=cart_item.sync_on)
-            try:
-                # If we can extend a current ``Subscription`` we will.
-                # XXX For each (organization, plan) there should not
-                #     be overlapping timeframe [created_at, ends_at[,
-                #     None-the-less, it might be a good idea to catch
-                #     and throw a nice error message in case.
-                subscription = Subscription.objects.get(
-                    organization=organization, plan=cart_item.plan,
-                    ends_at__gt=datetime_or_now())
-            except Subscription.DoesNotExist:
+            subscription = subscriptions.get(
+                (organization.pk, cart_item.plan_id))
+            if subscription:
+                subscription.organization = organization
+                subscription.plan = cart_item.plan
+            else:
                 ends_at = prorate_to
                 if not ends_at:
                     ends_at = created_at
@@ -335,7 +566,7 @@ class CartMixin(object):
             else:
                 options = self.get_invoicable_options(subscription,
                     created_at=created_at, prorate_to=prorate_to,
-                    cart_item=cart_item)
+                    cart_item=cart_item, pricing=pricing)
                 # option is selected
                 if (cart_item.option > 0 and
                     (cart_item.option - 1) < len(options)):
@@ -622,6 +853,31 @@ class SubscriptionMixin(object):
         return get_object_or_404(queryset, plan__slug=plan)
 
 
+class SearchableListMixin(BaseSearchableListMixin):
+    """
+    Filters the queryset on the words passed in the ``q`` parameter
+    through the search backend (see ``settings.SEARCH_BACKEND``).
+    """
+
+    def get_search_date_filters(self, word):
+        if self.search_date_fields:
+            at_date = self.try_convert_to_date(word)
+            if at_date:
+                return [Q(**{field_name: at_date})
+                    for field_name in self.search_date_fields]
+        return []
+
+    def get_queryset(self):
+        #pylint:disable=bad-super-call
+        queryset = super(BaseSearchableListMixin, self).get_queryset()
+        query = self.get_search_query()
+        if query:
+            queryset = get_search_backend().filter_queryset(
+                queryset, query, self.search_fields,
+                extra_filters=self.get_search_date_filters)
+        return queryset
+
+
 class CartItemSmartListMixin(SortableListMixin,
                              DateRangeMixin, SearchableListMixin):
     """
@@ -61,19 +61,23 @@ and contributors (for details see :doc:`Security <security>`).
 """
 from __future__ import unicode_literals
 
-import datetime, logging, re
+import calendar, datetime, logging, re
+from hashlib import sha256
 
 from dateutil.relativedelta import relativedelta
 from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.validators import MaxValueValidator
 from django.db import DatabaseError, IntegrityError, models, transaction
-from django.db.models import Max, Q, Sum
+from django.db.models import Max, Min, Q, Sum
 from django.db.models.query import QuerySet
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.template.defaultfilters import slugify
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.http import quote
+from django.utils.lru_cache import lru_cache
 from django.utils.safestring import mark_safe
 from django.utils import six
 from django.utils.translation import ugettext_lazy as _
@@ -81,8 +85,11 @@ from django_countries.fields import CountryField
 
 from . import humanize, settings, signals
 from .backends import get_processor_backend, ProcessorError, CardError
-from .utils import (SlugTitleMixin, datetime_or_now,
-    extract_full_exception_stack, generate_random_slug, get_role_model)
+from .instrumentation import instrumented
+from .search import get_search_document
+from .utils import (SlugTitleMixin, as_card_exp_date, bulk_update,
+    datetime_or_now, extract_full_exception_stack, generate_random_slug,
+    get_role_model, insert_many)
 
 
 LOGGER = logging.getLogger(__name__)
@@ -222,6 +229,10 @@ class Organization(models.Model):
     """
     #pylint:disable=too-many-instance-attributes
 
+    # Fields matched through ``search_document`` by the search backend.
+    SEARCH_DOCUMENT_FIELDS = ('slug', 'full_name', 'email', 'phone',
+        'street_address', 'locality', 'region', 'postal_code', 'country')
+
     objects = OrganizationManager()
     slug = models.SlugField(unique=True,
         help_text=_("Unique identifier shown in the URL bar"))
@@ -279,9 +290,18 @@ class Organization(models.Model):
     processor_pub_key = models.CharField(max_length=60, null=True, blank=True)
     processor_refresh_token = models.CharField(max_length=60, null=True,
         blank=True)
+    processor_reconciled_at = models.DateTimeField(null=True, blank=True,
+        help_text=_("Date/time of the last payout reconciled with"\
+        " the processor"))
+    card_exp_date = models.DateField(null=True, blank=True,
+        help_text=_("Expiration date of the card on file as last retrieved"\
+        " from the processor"))
 
     extra = settings.get_extra_field_class()(null=True, blank=True,
         help_text=_("Extra meta data (can be stringify JSON)"))
+    search_document = models.TextField(default="", editable=False,
+        help_text=_("Lowercase text of the fields matched by the search"\
+        " backend"))
 
     def __str__(self):
         return str(self.slug)
@@ -335,6 +355,11 @@ class Organization(models.Model):
         if not self.slug:
             self.slug = slugify(self.full_name)
         self.validate_processor()
+        self.search_document = get_search_document(
+            self, self.SEARCH_DOCUMENT_FIELDS)
+        if update_fields is not None and (
+                set(update_fields) & set(self.SEARCH_DOCUMENT_FIELDS)):
+            update_fields = list(update_fields) + ['search_document']
         with transaction.atomic():
             user = self.attached_user()
             if user:
@@ -541,6 +566,7 @@ class Organization(models.Model):
                 dest_account=Transaction.CANCELED)
 
     def update_bank(self, bank_token):
+        self.invalidate_processor_cache()
         if bank_token is None:
             self.processor_deposit_key = None
             self.processor_priv_key = None
@@ -556,6 +582,8 @@ class Organization(models.Model):
         signals.bank_updated.send(self)
 
     def update_card(self, card_token, user):
+        self.invalidate_processor_cache()
+        self.card_exp_date = None
         self.processor_backend.create_or_update_card(
             self, card_token, user=user, broker=get_broker())
         # The following ``save`` will be rolled back in ``checkout``
@@ -566,6 +594,7 @@ class Organization(models.Model):
             extra={'event': 'update-debit', 'organization': self.slug,
                 'processor_card_key': self.processor_card_key})
 
+    @instrumented('execute_order')
     def execute_order(self, invoicables, user):
         """
         From the list of *invoicables*, clear the user Cart, create
@@ -576,7 +605,15 @@ class Organization(models.Model):
         claim_carts = {}
         invoiced_items = []
         new_organizations = []
+        new_subscriptions = []
+        recorded_items = []
         coupon_providers = set([])
+        # The user cart is loaded once for all invoicables.
+        carts = {}
+        for cart_item in CartItem.objects.get_cart(user,
+                plan__in=set([invoicable['subscription'].plan_id
+                    for invoicable in invoicables])).select_related('plan'):
+            carts.setdefault(cart_item.plan_id, []).append(cart_item)
         for invoicable in invoicables:
             subscription = invoicable['subscription']
             # If the invoicable we are checking out is somehow related to
@@ -586,15 +623,18 @@ class Organization(models.Model):
             cart_item = None
             # XXX Two use charges, sync_on is username will raise a 500 error
             # because of multiple CartItem.
-            cart_items = CartItem.objects.get_cart(user, plan=subscription.plan)
-            if cart_items.exists():
+            cart_items = carts.get(subscription.plan_id, [])
+            if cart_items:
                 # We are doing a groupBuy for a specified email.
-                bulk_items = cart_items.filter(
-                    sync_on=subscription.organization.email)
-                if bulk_items.exists():
-                    cart_item = bulk_items.get()
-                else:
-                    cart_item = cart_items.get()
+                bulk_items = [item for item in cart_items
+                    if item.sync_on == subscription.organization.email]
+                if not bulk_items:
+                    bulk_items = cart_items
+                if len(bulk_items) > 1:
+                    raise CartItem.MultipleObjectsReturned(
+                        "%d cart items for plan %s" % (
+                        len(bulk_items), subscription.plan))
+                cart_item = bulk_items[0]
             # XXX We have the cart_item here for an invoicable,
             # or invoicable['lines'] which will end up as ChargeItems.
             if cart_item:
@@ -619,10 +659,24 @@ class Organization(models.Model):
                     extra={'event': 'upsert-subscription',
                         'organization': subscription.organization.slug,
                         'plan': subscription.plan.slug})
-                subscription.save()
+                # Subscriptions already in the database are extended
+                # (and saved) by ``record_order``.
+                if not subscription.id:
+                    new_subscriptions += [subscription]
                 if cart_item:
                     cart_item.recorded = True
-                    cart_item.save()
+                    recorded_items += [cart_item]
+                    cart_items.remove(cart_item)
+        if (insert_many(Subscription, new_subscriptions)
+            and settings.SUBSCRIBER_FLAGS):
+            SubscriberFlag.objects.refresh(get_role_model().objects.filter(
+                organization__in=[subscription.organization_id
+                    for subscription in new_subscriptions]).values_list(
+                'user_id', flat=True))
+        if recorded_items:
+            CartItem.objects.filter(pk__in=[
+                cart_item.pk for cart_item in recorded_items]).update(
+                recorded=True)
 
         # At this point we have gathered all the ``Organization``
         # which have yet to be registered. For these no ``Subscription``
@@ -632,18 +686,23 @@ class Organization(models.Model):
         coupons = {}
         claim_codes = {}
         for coupon_provider in coupon_providers:
-            coupon = Coupon.objects.create(
+            coupon = Coupon(
                 code='cpn_%s' % generate_random_slug(),
                 organization=coupon_provider,
                 percent=100, nb_attempts=0,
                 description=('Auto-generated after payment by %s'
                     % self.printable_name))
+            coupon.update_dates()
+            coupons.update({coupon_provider.id: coupon})
+        insert_many(Coupon, coupons.values())
+        for coupon_provider in coupon_providers:
+            coupon = coupons[coupon_provider.id]
             LOGGER.info('Auto-generated Coupon %s for %s',
                 coupon.code, coupon_provider,
                 extra={'event': 'create-coupon',
                     'coupon': coupon.code, 'auto': True,
                     'provider': coupon_provider.slug})
-            coupons.update({coupon_provider.id: coupon})
+        claimed_items = []
         for key, cart_items in six.iteritems(claim_carts):
             claim_code = None
             for cart_item in cart_items:
@@ -657,8 +716,8 @@ class Organization(models.Model):
                     if not claim_code:
                         claim_code = generate_random_slug()
                     cart_item.claim_code = claim_code
-                cart_item.coupon = coupons[cart_item.plan.organization.id]
-                cart_item.save()
+                cart_item.coupon = coupons[cart_item.plan.organization_id]
+                claimed_items += [cart_item]
             if claim_code:
                 nb_cart_items = len(cart_items)
                 LOGGER.info("Generated claim code '%s' for %d cart items",
@@ -667,6 +726,8 @@ class Organization(models.Model):
                         'claim_code': claim_code,
                         'nb_cart_items': nb_cart_items})
                 claim_codes.update({key: claim_code})
+        bulk_update(CartItem, claimed_items, ['sync_on', 'user',
+            'first_name', 'last_name', 'claim_code', 'coupon'])
 
         # We now either have a ``subscription.id`` (subscriber present
         # in the database) or a ``Coupon`` (subscriber absent from
@@ -690,6 +751,7 @@ class Organization(models.Model):
         Transaction.objects.record_order(invoiced_items, user)
         return new_organizations, claim_codes, invoiced_items
 
+    @instrumented('checkout')
     def checkout(self, invoicables, user, token=None, remember_card=True):
         """
         *invoiced_items* is a set of ``Transaction`` that will be recorded
@@ -729,11 +791,42 @@ class Organization(models.Model):
     def get_deposit_context(self):
         return self.processor_backend.get_deposit_context()
 
+    def _get_processor_cache_key(self, kind):
+        if kind == 'card':
+            return 'saas.processor_card.%d.%s' % (
+                self.pk, self.processor_card_key)
+        return 'saas.processor_bank.%d.%s' % (
+            self.pk, self.processor_deposit_key)
+
+    def _retrieve_cached(self, kind, retrieve):
+        """
+        Returns the result of *retrieve* cached for
+        ``PROCESSOR['CACHE_TIMEOUT']`` seconds.
+        """
+        if not settings.PROCESSOR_CACHE_TIMEOUT:
+            return retrieve()
+        cache = caches[settings.PROCESSOR_CACHE]
+        key = self._get_processor_cache_key(kind)
+        context = cache.get(key)
+        if context is None:
+            context = retrieve()
+            cache.set(key, context, settings.PROCESSOR_CACHE_TIMEOUT)
+        return dict(context)
+
+    def invalidate_processor_cache(self):
+        """
+        Forgets the card and bank information cached for this organization.
+        """
+        caches[settings.PROCESSOR_CACHE].delete_many([
+            self._get_processor_cache_key('card'),
+            self._get_processor_cache_key('bank')])
+
     def retrieve_bank(self):
         """
         Returns associated bank account as a dictionnary.
         """
-        context = self.processor_backend.retrieve_bank(self)
+        context = self._retrieve_cached('bank',
+            lambda: self.processor_backend.retrieve_bank(self))
         available_amount = context.get('balance_amount', 0)
         if isinstance(available_amount, six.integer_types):
             # The processor could return "N/A" if the organization is not
@@ -754,7 +847,19 @@ class Organization(models.Model):
         """
         Returns associated credit card.
         """
-        return self.processor_backend.retrieve_card(self, broker=get_broker())
+        return self._retrieve_cached('card', self._retrieve_processor_card)
+
+    def _retrieve_processor_card(self):
+        context = self.processor_backend.retrieve_card(
+            self, broker=get_broker())
+        # Keeps a local copy of the expiration date such that batch jobs
+        # do not have to query the processor for every organization.
+        card_exp_date = as_card_exp_date(context.get('exp_date'))
+        if self.pk and card_exp_date != self.card_exp_date:
+            self.card_exp_date = card_exp_date
+            Organization.objects.filter(pk=self.pk).update(
+                card_exp_date=card_exp_date)
+        return context
 
     def get_transfers(self, reconcile=True):
         """
@@ -1226,6 +1331,7 @@ class ChargeManager(models.Manager):
         for charge in self.in_progress_for_customer(organization):
             charge.retrieve()
 
+    @instrumented('create_charge')
     def create_charge(self, customer, transactions, amount, unit,
                       processor, processor_charge_id, receipt_info,
                       user=None, descr=None, created_at=None):
@@ -1284,6 +1390,10 @@ class ChargeManager(models.Manager):
         """
         Create a charge on a customer card.
 
+        When *transactions* were already charged, the ``Charge`` recorded
+        in ``ChargeIdempotencyKey`` is returned without contacting
+        the processor.
+
         Be careful, Stripe will not processed charges less than 50 cents.
         """
         #pylint: disable=too-many-arguments,too-many-locals
@@ -1297,6 +1407,27 @@ class ChargeManager(models.Manager):
         unit = balances[0]['unit']
         if amount == 0:
             return None
+        key = ChargeIdempotencyKey.objects.make_key(
+            customer, transactions, amount, unit)
+        processor_key = key
+        declined_key = None
+        if key:
+            prev = ChargeIdempotencyKey.objects.filter(
+                key=key).select_related('charge').first()
+            if prev:
+                if prev.charge.state != Charge.FAILED:
+                    LOGGER.info("charge %s of %d %s to %s was already created",
+                        prev.charge.processor_key, amount, unit, customer)
+                    return prev.charge
+                # The processor would return the failed charge again.
+                processor_key = '%s-%s' % (key, prev.charge.processor_key)
+            if token:
+                # A new card must not replay the response for the previous one.
+                processor_key = '%s-%s' % (processor_key, token)
+            declined_key = processor_key
+            declined = ChargeIdempotencyKey.objects.get_declined(declined_key)
+            if declined:
+                processor_key = '%s-%s' % (processor_key, declined)
         providers = Transaction.objects.providers(transactions)
         if len(providers) == 1:
             broker = providers[0]
@@ -1317,12 +1448,12 @@ class ChargeManager(models.Manager):
                 (processor_charge_id, created_at,
                  receipt_info) = processor_backend.create_charge(
                      customer, amount, unit, broker=broker, descr=descr,
-                     created_at=created_at)
+                     created_at=created_at, idempotency_key=processor_key)
             elif token:
                 (processor_charge_id, created_at,
                  receipt_info) = processor_backend.create_charge_on_card(
                      token, amount, unit, broker=broker, descr=descr,
-                     created_at=created_at)
+                     created_at=created_at, idempotency_key=processor_key)
             else:
                 raise ProcessorError(_("%(organization)s is not associated"\
                     " to an account on the processor and no token was passed."
@@ -1333,9 +1464,13 @@ class ChargeManager(models.Manager):
                 'organization': receipt_info['card_name']}
             if user:
                 descr += ' (%s)' % user.username
-            return self.create_charge(customer, transactions,
+            charge = self.create_charge(customer, transactions,
                 amount, unit, processor, processor_charge_id, receipt_info,
                 user=user, descr=descr, created_at=created_at)
+            if key:
+                ChargeIdempotencyKey.objects.update_or_create(
+                    key=key, defaults={'charge': charge})
+            return charge
 
         except CardError as err:
             # Implementation Note:
@@ -1348,6 +1483,10 @@ class ChargeManager(models.Manager):
             # We implement (2) because the UI feedback to a user looks strange
             # when the Card is persisted while an error message is displayed.
             customer.processor_card_key = prev_processor_card_key
+            if declined_key and err.charge_processor_key:
+                # The next attempt is a new charge, not a replay of the decline.
+                ChargeIdempotencyKey.objects.set_declined(
+                    declined_key, err.charge_processor_key)
             LOGGER.info('error: "%s" processing charge %s of %d %s to %s',
                 err.processor_details(), err.charge_processor_key,
                 amount, unit, customer,
@@ -1439,7 +1578,7 @@ class Charge(models.Model):
         are returned is not guarenteed by SQL.
         This is important when identifying line items by an index.
         """
-        return self.charge_items.order_by('id')
+        return self.charge_items.select_related('invoiced').order_by('id')
 
     @property
     def processor_backend(self):
@@ -1520,7 +1659,7 @@ class Charge(models.Model):
         """
         #pylint: disable=no-member
         providers = Transaction.objects.providers([charge_item.invoiced
-            for charge_item in self.charge_items.all()])
+            for charge_item in self.charge_items.select_related('invoiced')])
         nb_providers = len(providers)
         assert nb_providers <= 1
         if nb_providers:
@@ -1633,6 +1772,7 @@ class Charge(models.Model):
         self.state = self.FAILED
         signals.charge_updated.send(sender=__name__, charge=self, user=None)
 
+    @instrumented('payment_successful')
     def payment_successful(self):
         """
         When a charge through the payment processor is sucessful,
@@ -1723,7 +1863,11 @@ class Charge(models.Model):
                 orig_organization=self.customer)
             # Once we have created a transaction for the charge, let's
             # redistribute the funds to their rightful owners.
-            for charge_item in self.charge_items.all():
+            charge_items = list(
+                self.charge_items.select_related('invoiced'))
+            Transaction.objects.resolve_events([charge_item.invoiced
+                for charge_item in charge_items])
+            for charge_item in charge_items:
                 invoiced_item = charge_item.invoiced
 
                 # If there is still an amount on the ``Payable`` account,
@@ -2138,6 +2282,65 @@ class ChargeItem(models.Model):
             provider.save()
 
 
+class ChargeIdempotencyKeyManager(models.Manager):
+
+    @staticmethod
+    def make_key(customer, transactions, amount, unit):
+        """
+        Returns a key derived from the *customer*, the invoiced *transactions*
+        and the *amount* charged, or ``None`` if some of the records were
+        not saved yet.
+        """
+        invoiced_ids = [invoiced.pk for invoiced in transactions]
+        if not customer.pk or None in invoiced_ids:
+            return None
+        return sha256(('%d|%s|%d|%s' % (customer.pk,
+            ','.join([str(pk) for pk in sorted(invoiced_ids)]),
+            amount, unit)).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _get_declined_cache_key(processor_key):
+        return 'saas.charge_declined.%s' % processor_key
+
+    def get_declined(self, processor_key):
+        """
+        Returns the processor key of the last charge declined
+        for *processor_key*, if any.
+        """
+        return caches[settings.PROCESSOR_CACHE].get(
+            self._get_declined_cache_key(processor_key))
+
+    def set_declined(self, processor_key, charge_processor_key):
+        """
+        Remembers a charge for *processor_key* was declined.
+
+        Declined charges are rolled back with the order, so the decline
+        is kept in the processor cache instead of the database, for as long
+        as processors replay a response for the same key (24 hours).
+        """
+        caches[settings.PROCESSOR_CACHE].set(
+            self._get_declined_cache_key(processor_key),
+            charge_processor_key, 24 * 3600)
+
+
+@python_2_unicode_compatible
+class ChargeIdempotencyKey(models.Model):
+    """
+    Records the ``Charge`` created for a set of invoiced ``Transaction``
+    such that a retried request to charge them returns the ``Charge``
+    instead of contacting the processor again.
+    """
+    objects = ChargeIdempotencyKeyManager()
+
+    key = models.CharField(max_length=64, unique=True)
+    charge = models.ForeignKey(Charge, on_delete=models.CASCADE,
+        related_name='idempotency_keys')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '%s-%s' % (self.key, str(self.charge))
+
+
 class CouponManager(models.Manager):
 
     def active(self, organization, code, at_time=None):
@@ -2205,6 +2408,16 @@ class Coupon(models.Model):
 
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
+        self.update_dates()
+        super(Coupon, self).save(force_insert=force_insert,
+             force_update=force_update, using=using,
+             update_fields=update_fields)
+
+    def update_dates(self):
+        """
+        Sets ``created_at`` and the default ``ends_at``.
+        Call it before ``bulk_create``.
+        """
         if not self.created_at:
             self.created_at = datetime_or_now()
         # Implementation Note:
@@ -2218,9 +2431,6 @@ class Coupon(models.Model):
                 self.ends_at = None
         else:
             self.ends_at = self.created_at + datetime.timedelta(days=30)
-        super(Coupon, self).save(force_insert=force_insert,
-             force_update=force_update, using=using,
-             update_fields=update_fields)
 
 
 class PlanManager(models.Manager):
@@ -2726,6 +2936,85 @@ class CartItem(models.Model):
         return result
 
 
+class PeriodCalculator(object):
+    """
+    Closed-form arithmetic on the periods [lower, upper[ of a plan
+    *interval* starting at *created_at*.
+
+    The k-th period starts at ``created_at`` plus k plan periods with
+    month-end clamping done the same way as ``Plan.end_of_period``
+    (i.e. ``relativedelta``).
+    """
+
+    def __init__(self, created_at, interval):
+        if interval not in (Plan.HOURLY, Plan.DAILY, Plan.WEEKLY,
+                            Plan.MONTHLY, Plan.YEARLY):
+            raise ValueError(_("period type %d is not defined.") % interval)
+        self.created_at = created_at
+        self.interval = interval
+        self._bounds = {}
+
+    def bound(self, index):
+        """
+        Returns the start of the *index*-th period.
+        """
+        bound = self._bounds.get(index)
+        if bound is None:
+            created_at = self.created_at
+            if self.interval == Plan.HOURLY:
+                bound = created_at + datetime.timedelta(hours=index)
+            elif self.interval == Plan.DAILY:
+                bound = created_at + datetime.timedelta(days=index)
+            elif self.interval == Plan.WEEKLY:
+                bound = created_at + datetime.timedelta(days=7 * index)
+            else:
+                if self.interval == Plan.MONTHLY:
+                    year, month = divmod(created_at.month - 1 + index, 12)
+                    year += created_at.year
+                    month += 1
+                else:
+                    year = created_at.year + index
+                    month = created_at.month
+                bound = created_at.replace(year=year, month=month,
+                    day=min(created_at.day, calendar.monthrange(year, month)[1]))
+            self._bounds[index] = bound
+        return bound
+
+    def index(self, at_time):
+        """
+        Returns the index of the period which includes *at_time*.
+        """
+        delta = at_time - self.created_at
+        if self.interval == Plan.HOURLY:
+            return int(delta.total_seconds() // 3600)
+        if self.interval == Plan.DAILY:
+            return delta.days
+        if self.interval == Plan.WEEKLY:
+            return delta.days // 7
+        index = at_time.year - self.created_at.year
+        if self.interval == Plan.MONTHLY:
+            index = index * 12 + at_time.month - self.created_at.month
+        # Month-end clamping (and timezones) can put the estimate
+        # one period off.
+        while self.bound(index) > at_time:
+            index -= 1
+        while self.bound(index + 1) <= at_time:
+            index += 1
+        return index
+
+    def period_for(self, at_time):
+        """
+        Returns the period [beg,end[ which includes ``at_time``.
+        """
+        index = self.index(at_time)
+        return self.bound(index), self.bound(index + 1)
+
+
+@lru_cache(maxsize=1024)
+def get_period_calculator(created_at, interval):
+    return PeriodCalculator(created_at, interval)
+
+
 class SubscriptionManager(models.Manager):
     #pylint: disable=super-on-old-class
 
@@ -2860,46 +3149,15 @@ class Subscription(models.Model):
         lower, upper = self.period_for(at_time=at_time)
         return (min(lower, self.ends_at), min(upper, self.ends_at))
 
+    @property
+    def period_calculator(self):
+        return get_period_calculator(self.created_at, self.plan.interval)
+
     def period_for(self, at_time=None):
         """
         Returns the period [beg,end[ which includes ``at_time``.
         """
-        at_time = datetime_or_now(at_time)
-        delta = at_time - self.created_at
-        if self.plan.interval == Plan.HOURLY:
-            estimated = relativedelta(hours=delta.total_seconds() // 3600)
-            period = relativedelta(hours=1)
-        elif self.plan.interval == Plan.DAILY:
-            estimated = relativedelta(days=delta.days)
-            period = relativedelta(days=1)
-        elif self.plan.interval == Plan.WEEKLY:
-            # XXX integer division?
-            estimated = relativedelta(days=delta.days // 7)
-            period = relativedelta(days=7)
-        elif self.plan.interval == Plan.MONTHLY:
-            estimated = relativedelta(at_time, self.created_at)
-            estimated.normalized()
-            estimated = relativedelta(
-                months=estimated.years * 12 + estimated.months)
-            period = relativedelta(months=1)
-        elif self.plan.interval == Plan.YEARLY:
-            estimated = relativedelta(at_time, self.created_at)
-            estimated.normalized()
-            estimated = relativedelta(years=estimated.years)
-            period = relativedelta(years=1)
-        else:
-            raise ValueError(_("period type %d is not defined.")
-                % self.plan.interval)
-        lower = self.created_at + estimated # rough estimate to start
-        upper = self.created_at + (estimated + period)
-        while not (lower <= at_time and at_time < upper):
-            if at_time < lower:
-                upper = lower
-                lower = lower - period
-            elif at_time >= upper:
-                lower = upper
-                upper = upper + period
-        return lower, upper
+        return self.period_calculator.period_for(datetime_or_now(at_time))
 
     def _period_fraction(self, start, until, start_lower, start_upper):
         """
@@ -2911,7 +3169,7 @@ class Subscription(models.Model):
         if self.plan.interval == Plan.HOURLY:
             fraction = (until - start).total_seconds() / 3600.0
         elif self.plan.interval == Plan.DAILY:
-            fraction = delta.hours / 24.0
+            fraction = (until - start).total_seconds() / 86400.0
         elif self.plan.interval == Plan.WEEKLY:
             fraction = delta.days / 7.0
         elif self.plan.interval == Plan.MONTHLY:
@@ -2933,31 +3191,19 @@ class Subscription(models.Model):
             start = self.created_at
         until = datetime_or_now(until)
         assert start < until
-        start_lower, start_upper = self.period_for(start)
-        until_lower, until_upper = self.period_for(until)
+        calculator = self.period_calculator
+        start_index = calculator.index(start)
+        until_index = calculator.index(until)
+        start_lower = calculator.bound(start_index)
+        start_upper = calculator.bound(start_index + 1)
+        until_lower = calculator.bound(until_index)
+        until_upper = calculator.bound(until_index + 1)
         LOGGER.debug("[%s,%s[ starts in period [%s,%s[ and ends in period"\
 " [%s,%s[", start, until, start_lower, start_upper, until_lower, until_upper)
         partial_start_period = 0
         partial_end_period = 0
         if start_upper <= until_lower:
-            delta = relativedelta(start_upper, until_lower)
-            if self.plan.interval == Plan.HOURLY:
-                # Integer division?
-                estimated = (start_upper - until_lower).total_seconds() // 3600
-            elif self.plan.interval == Plan.DAILY:
-                estimated = delta.days
-            elif self.plan.interval == Plan.WEEKLY:
-                # Integer division?
-                estimated = delta.days // 7
-            elif self.plan.interval == Plan.MONTHLY:
-                estimated = delta.months
-            elif self.plan.interval == Plan.YEARLY:
-                estimated = delta.years
-            upper = self.plan.end_of_period(start_upper, nb_periods=estimated)
-            if upper < until_lower:
-                full_periods = estimated + 1
-            else:
-                full_periods = estimated
+            full_periods = until_index - start_index - 1
             # partial-at-start + full periods + partial-at-end
             partial_start_period_seconds = (start_upper - start).total_seconds()
             if partial_start_period_seconds > 0:
@@ -3074,9 +3320,7 @@ class TransactionManager(models.Manager):
         """
         Returns all transactions associated to a charge.
         """
-        return self.filter(event_id__in=[get_charge_event_id(charge)] + [
-            get_charge_event_id(charge, item)
-            for item in charge.charge_items.all()])
+        return self.filter(charge=charge)
 
     def by_customer(self, organization):
         """
@@ -3113,6 +3357,9 @@ class TransactionManager(models.Manager):
         Returns a ``QuerySet`` of all transactions related to a set
         of subscriptions.
         """
+        # ``use_charge`` is left NULL when the ``UseCharge`` does not exist
+        # anymore, so we match on the ``event_id`` of the subscription
+        # itself rather than on ``subscription`` and ``use_charge``.
         queryset = self.filter(
             dest_account=Transaction.PAYABLE,
             event_id__in=[get_sub_event_id(subscription)
@@ -3269,6 +3516,15 @@ class TransactionManager(models.Manager):
                 | set([val['dest_account']
                     for val in self.all().values('dest_account').distinct()]))
 
+    @staticmethod
+    def get_accounts_like(like_account):
+        """
+        Returns the list of account names in the ledger which contain
+        *like_account* (case-insensitive).
+        """
+        return list(LedgerAccount.objects.filter(
+            name__icontains=like_account).values_list('name', flat=True))
+
     @staticmethod
     def record_order(invoiced_items, user=None):
         """
@@ -3280,7 +3536,9 @@ class TransactionManager(models.Manager):
         Constraints: All invoiced_items to same customer
         """
         order_executed_items = []
-        for invoiced_item in invoiced_items:
+        subscriptions = {}
+        for invoiced_item in Transaction.objects.resolve_events(
+                invoiced_items):
             # When an customer pays on behalf of an organization
             # which does not exist in the database, we cannot create
             # a ``Subscription`` since we don't have an ``Organization`` yet.
@@ -3292,15 +3550,27 @@ class TransactionManager(models.Manager):
                     subscription.plan.period_number(invoiced_item.descr))
                 if subscription.plan.optin_on_request:
                     subscription.request_key = generate_random_slug()
-                subscription.save()
+                subscriptions.update({subscription.pk: subscription})
                 if (subscription.plan.unlock_event
                     and invoiced_item.dest_amount == 0):
                     # We are dealing with access now, pay later, orders.
                     invoiced_item.dest_amount = subscription.plan.period_amount
                     pay_now = False
             if pay_now:
-                invoiced_item.save()
                 order_executed_items += [invoiced_item]
+        bulk_update(Subscription, subscriptions.values(),
+            ['ends_at', 'request_key'])
+        new_items = []
+        for invoiced_item in order_executed_items:
+            if invoiced_item.pk:
+                invoiced_item.save()
+            else:
+                new_items += [invoiced_item]
+        Transaction.objects.update_event_references(new_items)
+        if insert_many(Transaction, new_items):
+            record_ledger_accounts(set([item.orig_account
+                for item in new_items]) | set([item.dest_account
+                for item in new_items]))
         if order_executed_items:
             signals.order_executed.send(
                 sender=__name__, invoiced_items=order_executed_items, user=user)
@@ -3364,8 +3634,9 @@ class TransactionManager(models.Manager):
             dest_params.update({'dest_account': account})
             orig_params.update({'orig_account': account})
         elif like_account is not None:
-            dest_params.update({'dest_account__icontains': like_account})
-            orig_params.update({'orig_account__icontains': like_account})
+            accounts = self.get_accounts_like(like_account)
+            dest_params.update({'dest_account__in': accounts})
+            orig_params.update({'orig_account__in': accounts})
         dest_balances = sum_dest_amount(self.filter(**dest_params))
         orig_balances = sum_orig_amount(self.filter(**orig_params))
         return sum_balance_amount(dest_balances, orig_balances)
@@ -3757,6 +4028,76 @@ class TransactionManager(models.Manager):
             amount, subscription.pk)
         return created_transactions
 
+    @staticmethod
+    def resolve_events(invoiced_items):
+        """
+        Attaches the 'event' (Subscription, Coupon, etc.) referenced
+        by each ``Transaction`` in *invoiced_items* such that later calls
+        to ``get_event`` do not hit the database.
+
+        Subscriptions and coupons are each fetched in a single query.
+        Returns *invoiced_items* as a list.
+        """
+        invoiced_items = list(invoiced_items)
+        subscription_ids = {}
+        coupon_codes = set([])
+        for invoiced_item in invoiced_items:
+            if invoiced_item.event_id:
+                look = re.match(r'sub_(\d+)(_(\d+))?', invoiced_item.event_id)
+                if look:
+                    subscription_ids.update({
+                        invoiced_item.event_id: int(look.group(1))})
+                else:
+                    coupon_codes |= set([invoiced_item.event_id])
+        subscriptions = {}
+        if subscription_ids:
+            subscriptions = Subscription.objects.select_related(
+                'plan__organization', 'organization').in_bulk(
+                set(subscription_ids.values()))
+        coupons = {}
+        if coupon_codes:
+            coupons = {coupon.code: coupon
+                for coupon in Coupon.objects.filter(
+                    code__in=coupon_codes).select_related('organization')}
+        for invoiced_item in invoiced_items:
+            event = None
+            if invoiced_item.event_id in subscription_ids:
+                event = subscriptions.get(
+                    subscription_ids[invoiced_item.event_id])
+                if event is None:
+                    # ``get_event`` will raise ``DoesNotExist``.
+                    continue
+            elif invoiced_item.event_id:
+                event = coupons.get(invoiced_item.event_id)
+            invoiced_item._event = event #pylint:disable=protected-access
+        return invoiced_items
+
+    @staticmethod
+    def update_event_references(invoiced_items):
+        """
+        Sets the ``subscription``, ``use_charge`` and ``charge`` references
+        encoded in the ``event_id`` of each ``Transaction``
+        in *invoiced_items*.
+
+        As in migration 0014, references to rows which do not exist
+        (ex: a deleted subscription) are left ``NULL``. Each referenced
+        table is queried at most once. Returns *invoiced_items* as a list.
+        """
+        invoiced_items = list(invoiced_items)
+        references = [parse_event_id(invoiced_item.event_id)
+            for invoiced_item in invoiced_items]
+        existing_ids = []
+        for idx, model in enumerate((Subscription, UseCharge, Charge)):
+            ids = set([reference[idx] for reference in references
+                if reference[idx] is not None])
+            existing_ids += [set(model.objects.filter(pk__in=ids).values_list(
+                'pk', flat=True)) if ids else set([])]
+        for invoiced_item, reference in zip(invoiced_items, references):
+            (invoiced_item.subscription_id, invoiced_item.use_charge_id,
+             invoiced_item.charge_id) = [ref_id if ref_id in existing_ids[idx]
+                else None for idx, ref_id in enumerate(reference)]
+        return invoiced_items
+
     @staticmethod
     def providers(invoiced_items):
         """
@@ -3764,7 +4105,8 @@ class TransactionManager(models.Manager):
         provider, return it otherwise return the site owner.
         """
         results = set([])
-        for invoiced_item in invoiced_items:
+        for invoiced_item in Transaction.objects.resolve_events(
+                invoiced_items):
             event = invoiced_item.get_event()
             if event:
                 results |= set([event.provider])
@@ -3778,7 +4120,8 @@ class TransactionManager(models.Manager):
         """
         results = {}
         default_processor_key = get_broker().processor_backend.pub_key
-        for invoiced_item in invoiced_items:
+        for invoiced_item in Transaction.objects.resolve_events(
+                invoiced_items):
             event = invoiced_item.get_event()
             if event:
                 processor_key = event.provider.processor_backend.pub_key
@@ -3864,10 +4207,43 @@ class Transaction(models.Model):
     event_id = models.SlugField(null=True,
         help_text=_("Event at the origin of this transaction"\
         " (ex. subscription, charge, etc.)"))
+    # References parsed out of ``event_id`` when the ``Transaction`` is saved
+    # such that the ledger joins with subscriptions and charges on integers.
+    subscription = models.ForeignKey('Subscription', null=True, blank=True,
+        on_delete=models.SET_NULL, related_name='+')
+    use_charge = models.ForeignKey('UseCharge', null=True, blank=True,
+        on_delete=models.SET_NULL, related_name='+')
+    charge = models.ForeignKey('Charge', null=True, blank=True,
+        on_delete=models.SET_NULL, related_name='+')
+
+    class Meta:
+        index_together = [
+            ('orig_account', 'created_at'),
+            ('dest_account', 'created_at')]
 
     def __str__(self):
         return str(self.id)
 
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        self.update_event_references()
+        super(Transaction, self).save(force_insert=force_insert,
+            force_update=force_update, using=using,
+            update_fields=update_fields)
+
+    def update_event_references(self):
+        """
+        Sets the ``subscription``, ``use_charge`` and ``charge`` references
+        encoded in ``event_id``.
+
+        Ledger entries are saved by code which holds the event they refer
+        to, so the ids are taken as-is without querying the database.
+        Use ``Transaction.objects.update_event_references`` when the events
+        might not exist anymore (ex: before ``bulk_create``).
+        """
+        (self.subscription_id, self.use_charge_id,
+         self.charge_id) = parse_event_id(self.event_id)
+
     @property
     def dest_price(self):
         return Price(self.dest_amount, self.dest_unit)
@@ -3889,7 +4265,12 @@ class Transaction(models.Model):
         """
         Returns the associated 'event' (Subscription, Coupon, etc)
         if available.
+
+        Use ``Transaction.objects.resolve_events`` when looping over
+        many transactions.
         """
+        if hasattr(self, '_event'):
+            return self._event
         if self.event_id:
             look = re.match(r'sub_(\d+)(_(\d+))?', self.event_id)
             if look:
@@ -3901,6 +4282,56 @@ class Transaction(models.Model):
         return None
 
 
+@receiver(signals.bank_updated)
+@receiver(signals.card_updated)
+def on_processor_info_updated(sender, organization=None, **kwargs):
+    #pylint:disable=unused-argument
+    # ``bank_updated`` is sent with the organization as sender.
+    if organization is None and hasattr(sender, 'invalidate_processor_cache'):
+        organization = sender
+    if organization is not None:
+        organization.invalidate_processor_cache()
+
+
+# Account names known to be recorded in ``LedgerAccount``, such that
+# we only hit the database the first time a process sees a name.
+_LEDGER_ACCOUNTS = set([])
+
+
+def record_ledger_accounts(accounts):
+    """
+    Records *accounts* names in ``LedgerAccount``.
+    """
+    for account in accounts:
+        if account not in _LEDGER_ACCOUNTS:
+            LedgerAccount.objects.get_or_create(name=account)
+            # If the enclosing transaction is rolled back, so is
+            # the ``LedgerAccount``.
+            transaction.on_commit(
+                lambda account=account: _LEDGER_ACCOUNTS.add(account))
+
+
+@receiver(post_save, sender=Transaction)
+def on_transaction_post_save(sender, instance, created, raw, **kwargs):
+    #pylint:disable=unused-argument
+    record_ledger_accounts((instance.orig_account, instance.dest_account))
+
+
+@python_2_unicode_compatible
+class LedgerAccount(models.Model):
+    """
+    Account names recorded in the ``Transaction`` ledger.
+
+    Account selectors (i.e. ``like_account``) are matched against this small
+    table first such that queries on the ledger itself are exact matches
+    on ``orig_account`` and ``dest_account``.
+    """
+    name = models.CharField(max_length=255, unique=True)
+
+    def __str__(self):
+        return self.name
+
+
 @python_2_unicode_compatible
 class BalanceLine(models.Model):
     """
@@ -3927,6 +4358,445 @@ class BalanceLine(models.Model):
         return '%s/%d' % (self.report, self.rank)
 
 
+@python_2_unicode_compatible
+class MetricFact(models.Model):
+    """
+    Metrics for a provider over the period [``starts_at``, ``ends_at``[
+    as rolled up by the ``compile_stats`` command.
+
+    When ``plan`` is ``None``, the fact aggregates the metrics for all plans
+    of the provider. Otherwise subscribers metrics are specific to ``plan``,
+    and only receivables and income which can be traced back to
+    a ``Subscription`` through ``Transaction.event_id`` are reported.
+    """
+    INTERVAL_CHOICES = [
+        (Plan.DAILY, "DAILY"),
+        (Plan.MONTHLY, "MONTHLY"),
+        ]
+
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE,
+        related_name='metric_facts')
+    plan = models.ForeignKey(Plan, null=True, on_delete=models.CASCADE,
+        related_name='metric_facts')
+    interval = models.PositiveSmallIntegerField(choices=INTERVAL_CHOICES)
+    starts_at = models.DateTimeField()
+    ends_at = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+    active_subscribers = models.PositiveIntegerField(default=0,
+        help_text=_("Number of active subscriptions at ends_at"))
+    new_subscribers = models.PositiveIntegerField(default=0,
+        help_text=_("Number of subscriptions created in the period"))
+    churned_subscribers = models.PositiveIntegerField(default=0,
+        help_text=_("Number of subscriptions which ended in the period"))
+    customers = models.PositiveIntegerField(default=0,
+        help_text=_("Number of distinct customers invoiced in the period"))
+    new_customers = models.PositiveIntegerField(default=0)
+    churned_customers = models.PositiveIntegerField(default=0)
+    receivables = models.BigIntegerField(default=0,
+        help_text=_("Amount invoiced in the period in currency unit"))
+    new_receivables = models.BigIntegerField(default=0)
+    churned_receivables = models.BigIntegerField(default=0)
+    payments = models.BigIntegerField(default=0,
+        help_text=_("Amount paid in the period in currency unit"))
+    refunds = models.BigIntegerField(default=0,
+        help_text=_("Amount refunded in the period in currency unit"))
+    income = models.BigIntegerField(default=0,
+        help_text=_("Income recognized in the period in currency unit"))
+    unit = models.CharField(max_length=3, default=settings.DEFAULT_UNIT)
+
+    class Meta:
+        unique_together = ('organization', 'plan', 'interval', 'starts_at')
+
+    def __str__(self):
+        return '%s/%s/%s' % (self.organization, self.plan or '',
+            self.starts_at.isoformat())
+
+
+class PendingEventManager(models.Manager):
+    """
+    Processes events waiting in a queue table (i.e. with ``state``,
+    ``nb_attempts``, ``next_attempt_at`` and ``last_error`` fields, and
+    optionally an ``object_key`` field to process events in order per object).
+
+    Exceptions listed in the model ``PERMANENT_ERRORS`` attribute fail
+    the event right away instead of retrying it.
+    """
+
+    def get_pending(self, at_time):
+        """
+        Returns the events due at *at_time*.
+        """
+        return self.filter(state=self.model.PENDING,
+            next_attempt_at__lte=at_time)
+
+    def process_pending(self, handler, at_time=None, batch_size=100):
+        """
+        Calls *handler* with each pending event due at *at_time*, in the order
+        they were created, skipping events which come after a failed event
+        for the same object (ex: a charge).
+
+        Each event is claimed by pushing its ``next_attempt_at``
+        ``CLAIM_SECONDS`` in the future before it is handled such that
+        concurrent workers do not process it twice. Claims of a worker
+        which dies expire on their own.
+
+        Failed events are retried with an exponential backoff until
+        ``MAX_ATTEMPTS`` is reached. Returns the number of events processed.
+        """
+        model = self.model
+        at_time = datetime_or_now(at_time)
+        claim_until = at_time + datetime.timedelta(
+            seconds=model.CLAIM_SECONDS)
+        queryset = self.get_pending(at_time).order_by('created_at', 'pk')
+        if any([field.name == 'object_key' for field in model._meta.fields]):
+            # Objects with an event waiting for a retry, or claimed by
+            # another worker, are skipped in the query itself so they do not
+            # take up room in the batch.
+            queryset = queryset.exclude(
+                object_key__in=self.filter(state=model.PENDING,
+                    next_attempt_at__gt=at_time,
+                    object_key__isnull=False).values('object_key'))
+        blocked = set([])
+        nb_processed = 0
+        for event in list(queryset[:batch_size]):
+            object_key = getattr(event, 'object_key', None)
+            if object_key and object_key in blocked:
+                continue
+            if not self.filter(pk=event.pk, state=model.PENDING,
+                    next_attempt_at__lte=at_time).update(
+                    next_attempt_at=claim_until):
+                # Another worker claimed the event first.
+                if object_key:
+                    blocked.add(object_key)
+                continue
+            try:
+                with transaction.atomic():
+                    handler(event)
+                    event.state = model.DONE
+                    event.last_error = None
+                    event.nb_attempts += 1
+                    event.save()
+            except Exception as err: #pylint:disable=broad-except
+                LOGGER.exception("processing %s", event)
+                event.nb_attempts += 1
+                event.last_error = str(err)
+                permanent_errors = getattr(model, 'PERMANENT_ERRORS', ())
+                if (event.nb_attempts >= model.MAX_ATTEMPTS
+                    or isinstance(err, permanent_errors)):
+                    event.state = model.FAILED
+                event.next_attempt_at = at_time + datetime.timedelta(
+                    seconds=min(model.BACKOFF_SECONDS
+                        * 2 ** (event.nb_attempts - 1),
+                        model.MAX_BACKOFF_SECONDS))
+                event.save()
+                if object_key:
+                    blocked.add(object_key)
+            nb_processed += 1
+        return nb_processed
+
+
+class WebhookEventManager(PendingEventManager):
+
+    def record(self, event_id, event_type, payload,
+               object_key=None, created_at=None):
+        """
+        Stores an event posted by the processor unless an event with
+        the same *event_id* was already received. Returns a tuple
+        ``(webhook_event, created)``.
+        """
+        created_at = datetime_or_now(created_at)
+        try:
+            with transaction.atomic():
+                return self.create(event_id=event_id, event_type=event_type,
+                    payload=payload, object_key=object_key,
+                    created_at=created_at, next_attempt_at=created_at), True
+        except IntegrityError:
+            # Processors will post the same event again when they
+            # do not get a timely response.
+            return self.get(event_id=event_id), False
+
+
+@python_2_unicode_compatible
+class WebhookEvent(models.Model):
+    """
+    Event posted by the processor on its webhook, recorded
+    as-is such that it can be processed out of the HTTP request.
+    """
+    PENDING = 0
+    DONE = 1
+    FAILED = 2
+    STATES = [
+        (PENDING, "pending"),
+        (DONE, "done"),
+        (FAILED, "failed"),
+        ]
+
+    MAX_ATTEMPTS = 10
+    BACKOFF_SECONDS = 30
+    MAX_BACKOFF_SECONDS = 6 * 3600
+    CLAIM_SECONDS = 15 * 60
+
+    objects = WebhookEventManager()
+
+    event_id = models.CharField(max_length=255, unique=True,
+        help_text=_("Unique identifier of the event on the processor"))
+    event_type = models.CharField(max_length=255)
+    object_key = models.CharField(max_length=255, null=True,
+        help_text=_("Processor key of the object (ex: charge) the event"\
+        " refers to"))
+    payload = models.TextField()
+    created_at = models.DateTimeField(
+        help_text=_("Date/time the event was created by the processor"))
+    received_at = models.DateTimeField(auto_now_add=True)
+    state = models.PositiveSmallIntegerField(choices=STATES, default=PENDING)
+    nb_attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True)
+    last_error = models.TextField(null=True)
+
+    class Meta:
+        index_together = [('state', 'next_attempt_at')]
+
+    def __str__(self):
+        return '%s/%s' % (self.event_id, self.event_type)
+
+
+class SignalEventManager(PendingEventManager):
+
+    def record(self, signal_name, sender, payload, object_key=None):
+        """
+        Stores a signal to be delivered to receivers later on.
+        """
+        at_time = datetime_or_now()
+        return self.create(signal_name=signal_name, sender=sender,
+            payload=payload, object_key=object_key,
+            created_at=at_time, next_attempt_at=at_time)
+
+
+@python_2_unicode_compatible
+class SignalEvent(models.Model):
+    """
+    Signal recorded when ``SIGNALS_OUTBOX`` is enabled, waiting
+    to be delivered to its receivers by ``process_signal_events``.
+    """
+    PENDING = 0
+    DONE = 1
+    FAILED = 2
+    STATES = [
+        (PENDING, "pending"),
+        (DONE, "done"),
+        (FAILED, "failed"),
+        ]
+
+    MAX_ATTEMPTS = 10
+    BACKOFF_SECONDS = 30
+    MAX_BACKOFF_SECONDS = 6 * 3600
+    CLAIM_SECONDS = 15 * 60
+    # Retrying will not bring back an object deleted since the signal
+    # was sent.
+    PERMANENT_ERRORS = (ObjectDoesNotExist,)
+
+    objects = SignalEventManager()
+
+    signal_name = models.CharField(max_length=100)
+    sender = models.CharField(max_length=255)
+    object_key = models.CharField(max_length=255, null=True,
+        help_text=_("Organization the signal refers to. Signals for"\
+        " the same organization are delivered in order"))
+    payload = models.TextField()
+    created_at = models.DateTimeField()
+    state = models.PositiveSmallIntegerField(choices=STATES, default=PENDING)
+    nb_attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True)
+    last_error = models.TextField(null=True)
+
+    class Meta:
+        index_together = [('state', 'next_attempt_at')]
+
+    def __str__(self):
+        return '%d/%s' % (self.pk, self.signal_name)
+
+
+class ExpirationNoticeManager(PendingEventManager):
+
+    def enqueue(self, notices):
+        """
+        Records *notices* (unsaved ``ExpirationNotice``) except the ones
+        already recorded for the same day, such that the renewals job
+        can be run multiple times. Returns the notices recorded.
+        """
+        notice_dates = set([notice.notice_date for notice in notices])
+        recorded = set(self.filter(notice_date__in=notice_dates).values_list(
+            'kind', 'organization_id', 'subscription_id', 'nb_days',
+            'notice_date'))
+        new_notices = []
+        for notice in notices:
+            key = (notice.kind, notice.organization_id,
+                notice.subscription_id, notice.nb_days, notice.notice_date)
+            if key not in recorded:
+                recorded.add(key)
+                new_notices += [notice]
+        self.bulk_create(new_notices)
+        return new_notices
+
+    def get_pending(self, at_time):
+        return super(ExpirationNoticeManager, self).get_pending(
+            at_time).select_related('organization',
+            'subscription__organization', 'subscription__plan')
+
+
+@python_2_unicode_compatible
+class ExpirationNotice(models.Model):
+    """
+    Notification that a subscription or the card on file for
+    an organization will expire soon, waiting to be sent.
+    """
+    EXPIRES_SOON = 'expires_soon'
+    CARD_EXPIRES_SOON = 'card_expires_soon'
+    SUBSCRIPTION_UPGRADE = 'subscription_upgrade'
+    PAYMENT_METHOD_ABSENT = 'payment_method_absent'
+    KINDS = [
+        (EXPIRES_SOON, "expires soon"),
+        (CARD_EXPIRES_SOON, "card expires soon"),
+        (SUBSCRIPTION_UPGRADE, "subscription upgrade"),
+        (PAYMENT_METHOD_ABSENT, "payment method absent"),
+        ]
+
+    PENDING = 0
+    DONE = 1
+    FAILED = 2
+    STATES = [
+        (PENDING, "pending"),
+        (DONE, "done"),
+        (FAILED, "failed"),
+        ]
+
+    MAX_ATTEMPTS = 5
+    BACKOFF_SECONDS = 60
+    MAX_BACKOFF_SECONDS = 6 * 3600
+    CLAIM_SECONDS = 15 * 60
+
+    objects = ExpirationNoticeManager()
+
+    kind = models.CharField(max_length=32, choices=KINDS)
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE,
+        related_name='+')
+    subscription = models.ForeignKey('Subscription', null=True,
+        on_delete=models.CASCADE, related_name='+')
+    nb_days = models.PositiveSmallIntegerField(
+        help_text=_("Number of days before the expiration"))
+    notice_date = models.DateField(
+        help_text=_("Day the renewals job recorded the notice"))
+    created_at = models.DateTimeField(auto_now_add=True)
+    state = models.PositiveSmallIntegerField(choices=STATES, default=PENDING)
+    nb_attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField()
+    last_error = models.TextField(null=True)
+
+    class Meta:
+        index_together = [('state', 'next_attempt_at')]
+
+    def __str__(self):
+        return '%s/%s/%d' % (self.kind, self.subscription or self.organization,
+            self.nb_days)
+
+
+class SubscriberFlagManager(models.Manager):
+
+    def refresh(self, user_ids, create=True):
+        """
+        Recomputes the earliest date a ``Subscription`` was created
+        for an ``Organization`` each user in *user_ids* has a role on.
+
+        When *create* is False, flags are only updated or removed
+        (ex: while users are deleted).
+        """
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+        subscribed = dict(get_role_model().objects.filter(user__in=user_ids,
+            organization__subscription__isnull=False).values_list(
+            'user_id').annotate(Min('organization__subscription__created_at')))
+        flags = dict(self.filter(user__in=user_ids).values_list(
+            'user_id', 'subscribed_at'))
+        stale = [user_id for user_id in flags if user_id not in subscribed]
+        if stale:
+            self.filter(user__in=stale).delete()
+        bulk_update(SubscriberFlag, [
+            SubscriberFlag(user_id=user_id, subscribed_at=subscribed_at)
+            for user_id, subscribed_at in six.iteritems(subscribed)
+            if user_id in flags and flags[user_id] != subscribed_at],
+            ['subscribed_at'])
+        if create:
+            self.bulk_create([
+                SubscriberFlag(user_id=user_id, subscribed_at=subscribed_at)
+                for user_id, subscribed_at in six.iteritems(subscribed)
+                if user_id not in flags])
+
+
+@python_2_unicode_compatible
+class SubscriberFlag(models.Model):
+    """
+    Users that have, or had, a role on an ``Organization``
+    with a ``Subscription``.
+
+    This table is maintained from ``Role`` and ``Subscription`` changes
+    such that registered users (i.e. users without subscriptions) can be
+    listed without joining ``Role`` and ``Subscription``
+    (see ``SUBSCRIBER_FLAGS``).
+    """
+    objects = SubscriberFlagManager()
+
+    user = models.OneToOneField(settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE, primary_key=True,
+        related_name='subscriber_flag')
+    subscribed_at = models.DateTimeField(db_index=True,
+        help_text=_("Date/time the earliest subscription was created"))
+
+    def __str__(self):
+        return '%s-%s' % (self.user_id, self.subscribed_at)
+
+
+def on_subscription_post_save(sender, instance, created, raw, **kwargs):
+    #pylint:disable=unused-argument
+    if created:
+        SubscriberFlag.objects.refresh(get_role_model().objects.filter(
+            organization_id=instance.organization_id).values_list(
+            'user_id', flat=True))
+
+
+def on_role_post_save(sender, instance, created, raw, **kwargs):
+    #pylint:disable=unused-argument
+    if created:
+        SubscriberFlag.objects.refresh([instance.user_id])
+
+
+def on_subscription_post_delete(sender, instance, **kwargs):
+    #pylint:disable=unused-argument
+    # Roles and subscriptions of an organization might be deleted
+    # in any order so we recompute flags once everything is gone.
+    user_ids = list(get_role_model().objects.filter(
+        organization_id=instance.organization_id).values_list(
+        'user_id', flat=True))
+    transaction.on_commit(
+        lambda: SubscriberFlag.objects.refresh(user_ids, create=False))
+
+
+def on_role_post_delete(sender, instance, **kwargs):
+    #pylint:disable=unused-argument
+    user_ids = [instance.user_id]
+    transaction.on_commit(
+        lambda: SubscriberFlag.objects.refresh(user_ids, create=False))
+
+
+if settings.SUBSCRIBER_FLAGS:
+    # Sites which do not look up ``SubscriberFlag`` do not pay
+    # for maintaining it.
+    post_save.connect(on_subscription_post_save, sender=Subscription)
+    post_save.connect(on_role_post_save, sender=settings.ROLE_RELATION)
+    post_delete.connect(on_subscription_post_delete, sender=Subscription)
+    post_delete.connect(on_role_post_delete, sender=settings.ROLE_RELATION)
+
+
 def get_broker():
     """
     Returns the site-wide provider from a request.
@@ -4101,6 +4971,23 @@ def get_charge_event_id(charge, charge_item=None):
     return substr
 
 
+def parse_event_id(event_id):
+    """
+    Returns a tuple (subscription_id, use_charge_id, charge_id) out of
+    an *event_id* formatted by ``get_sub_event_id`` or
+    ``get_charge_event_id``.
+    """
+    if event_id:
+        look = re.match(r'sub_(\d+)/((\d+)/)?', event_id)
+        if look:
+            return (int(look.group(1)),
+                int(look.group(3)) if look.group(3) else None, None)
+        look = re.match(r'cha_(\d+)/', event_id)
+        if look:
+            return (None, None, int(look.group(1)))
+    return (None, None, None)
+
+
 def get_sub_event_id(subscription, use_charge=None):
     """
     Returns a formatted id for a subscription (or a use_charge
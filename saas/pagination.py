@@ -27,7 +27,8 @@ from collections import OrderedDict
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 
-from .models import sum_dest_amount, sum_orig_amount, sum_balance_amount
+from .models import (Transaction, sum_dest_amount, sum_orig_amount,
+    sum_balance_amount)
 
 
 class BalancePagination(PageNumberPagination):
@@ -39,10 +40,11 @@ class BalancePagination(PageNumberPagination):
     def paginate_queryset(self, queryset, request, view=None):
         self.ends_at = view.ends_at
         if view.selector is not None:
+            accounts = Transaction.objects.get_accounts_like(view.selector)
             dest_totals = sum_dest_amount(queryset.filter(
-                dest_account__icontains=view.selector))
+                dest_account__in=accounts))
             orig_totals = sum_orig_amount(queryset.filter(
-                orig_account__icontains=view.selector))
+                orig_account__in=accounts))
         else:
             dest_totals = sum_dest_amount(queryset)
             orig_totals = sum_orig_amount(queryset)
@@ -0,0 +1,195 @@
+# Copyright (c) 2018, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Recognition windows are the one-month slices [starts_at, ends_at[ of
+a subscription lifetime, starting at ``Subscription.created_at``,
+over which revenue is recognized.
+
+``recognition_windows`` enumerates the windows of many subscriptions
+at once, together with the number of plan periods each window covers
+(i.e. ``Subscription.nb_periods(starts_at, ends_at)``). Date arithmetic
+is done on numpy ``datetime64`` arrays when numpy is installed.
+"""
+
+import datetime
+
+from django.utils import six
+from django.utils.timezone import utc
+
+from .models import PeriodCalculator, Plan
+from .utils import datetime_or_now
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _recognition_windows_python(subscriptions, starts_at, ends_at):
+    results = {}
+    for subscription in subscriptions:
+        calculator = PeriodCalculator(subscription.created_at, Plan.MONTHLY)
+        index = 0
+        if starts_at is not None:
+            index = max(calculator.index(starts_at), 0)
+            if calculator.bound(index) < starts_at:
+                index += 1
+        windows = []
+        window_end = calculator.bound(index + 1)
+        while window_end <= ends_at:
+            window_start = calculator.bound(index)
+            windows += [(window_start, window_end,
+                subscription.nb_periods(window_start, window_end))]
+            index += 1
+            window_end = calculator.bound(index + 1)
+        results[subscription.pk] = windows
+    return results
+
+
+def _as_datetime64(dtime):
+    return numpy.datetime64(dtime.astimezone(utc).replace(tzinfo=None), 'us')
+
+
+def _month_bounds(months, day_offsets, times_of_day):
+    """
+    Adds *times_of_day* to the day *day_offsets* of *months*, clamping
+    to the last day of the month the way ``relativedelta`` does.
+    """
+    first_days = months.astype('datetime64[D]')
+    last_day_offsets = ((months + 1).astype('datetime64[D]')
+        - first_days).astype(numpy.int64) - 1
+    days = numpy.minimum(day_offsets, last_day_offsets)
+    return (first_days + days).astype('datetime64[us]') + times_of_day
+
+
+def _nb_periods(intervals, window_starts, window_ends, created_days):
+    """
+    Vectorized ``Subscription.nb_periods`` for windows that start
+    and end on a recognition window boundary.
+    """
+    one_day = numpy.timedelta64(1, 'D')
+    lengths = window_ends - window_starts
+    results = numpy.ones(len(intervals), dtype=numpy.float64)
+    # Windows are a whole number of days (and hours) apart
+    # from ``created_at`` so there are no partial hours or days.
+    hourly = intervals == Plan.HOURLY
+    results[hourly] = lengths[hourly] / numpy.timedelta64(1, 'h')
+    daily = intervals == Plan.DAILY
+    results[daily] = lengths[daily] / one_day
+    weekly = intervals == Plan.WEEKLY
+    if weekly.any():
+        # Same arithmetic as ``nb_periods`` (partial-at-start
+        # + full periods + partial-at-end) so floats compare equal.
+        start_days = (window_starts[weekly].astype('datetime64[D]')
+            - created_days[weekly]) // one_day
+        end_days = (window_ends[weekly].astype('datetime64[D]')
+            - created_days[weekly]) // one_day
+        start_weeks = start_days // 7
+        end_weeks = end_days // 7
+        partial_start = (7 * (start_weeks + 1) - start_days) / 7.0
+        partial_end = (end_days - 7 * end_weeks) / 7.0
+        results[weekly] = numpy.where(start_weeks == end_weeks,
+            (end_days - start_days) / 7.0,
+            partial_start + (end_weeks - start_weeks - 1) + partial_end)
+    results[intervals == Plan.YEARLY] = 1 / 12.0
+    return results
+
+
+def _recognition_windows_numpy(subscriptions, starts_at, ends_at):
+    #pylint:disable=too-many-locals
+    created_at = numpy.array([_as_datetime64(subscription.created_at)
+        for subscription in subscriptions], dtype='datetime64[us]')
+    intervals = numpy.array([subscription.plan.interval
+        for subscription in subscriptions], dtype=numpy.int64)
+    created_months = created_at.astype('datetime64[M]')
+    created_days = created_at.astype('datetime64[D]')
+    day_offsets = (created_days - created_months.astype('datetime64[D]')
+        ).astype(numpy.int64)
+    times_of_day = created_at - created_days.astype('datetime64[us]')
+
+    # Window indices are estimated from month differences, then
+    # windows falling outside [starts_at, ends_at] are masked out.
+    ends_at = _as_datetime64(ends_at)
+    last_indices = (ends_at.astype('datetime64[M]') - created_months
+        ).astype(numpy.int64)
+    first_indices = numpy.zeros(len(subscriptions), dtype=numpy.int64)
+    if starts_at is not None:
+        starts_at = _as_datetime64(starts_at)
+        first_indices = numpy.maximum((starts_at.astype('datetime64[M]')
+            - created_months).astype(numpy.int64) - 1, 0)
+    counts = numpy.maximum(last_indices - first_indices, 0)
+    owners = numpy.repeat(numpy.arange(len(subscriptions)), counts)
+    offsets = numpy.cumsum(counts) - counts
+    indices = (numpy.arange(counts.sum()) - numpy.repeat(offsets, counts)
+        + numpy.repeat(first_indices, counts))
+
+    months = created_months[owners] + indices
+    window_starts = _month_bounds(
+        months, day_offsets[owners], times_of_day[owners])
+    window_ends = _month_bounds(
+        months + 1, day_offsets[owners], times_of_day[owners])
+    mask = window_ends <= ends_at
+    if starts_at is not None:
+        mask &= window_starts >= starts_at
+    owners = owners[mask]
+    window_starts = window_starts[mask]
+    window_ends = window_ends[mask]
+    nb_periods = _nb_periods(intervals[owners], window_starts, window_ends,
+        created_days[owners])
+
+    results = {subscription.pk: [] for subscription in subscriptions}
+    for owner, window_start, window_end, nb_period in six.moves.zip(
+            owners.tolist(), window_starts.tolist(), window_ends.tolist(),
+            nb_periods.tolist()):
+        results[subscriptions[owner].pk] += [(
+            window_start.replace(tzinfo=utc), window_end.replace(tzinfo=utc),
+            nb_period)]
+    return results
+
+
+def recognition_windows(subscriptions, ends_at=None, starts_at=None):
+    """
+    Returns a dictionary keyed by subscription pk of the list of
+    recognition windows ``(starts_at, ends_at, nb_periods)``, in order,
+    that fit in [*starts_at*, *ends_at*].
+
+    *subscriptions* is a ``Subscription`` or a sequence of them
+    with their ``plan`` loaded.
+    """
+    if not isinstance(subscriptions, (list, tuple)):
+        if hasattr(subscriptions, 'plan'):
+            subscriptions = [subscriptions]
+        else:
+            subscriptions = list(subscriptions)
+    ends_at = datetime_or_now(ends_at)
+    if starts_at is not None:
+        starts_at = datetime_or_now(starts_at)
+    if numpy is not None and subscriptions and all([
+            isinstance(subscription.created_at, datetime.datetime)
+            and subscription.created_at.tzinfo is not None
+            for subscription in subscriptions]):
+        return _recognition_windows_numpy(subscriptions, starts_at, ends_at)
+    return _recognition_windows_python(subscriptions, starts_at, ends_at)
@@ -28,16 +28,20 @@ in batch mode.
 """
 
 import logging
-
+from collections import OrderedDict
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from django.db import transaction
+from django.db.models import Q
 from django.utils import six
 
 from . import humanize, signals
-from .models import (Charge, Organization, Plan, Subscription, Transaction,
-    sum_dest_amount, get_period_usage, get_sub_event_id)
-from .utils import datetime_or_now
+from .models import (Charge, ExpirationNotice, Organization, Plan,
+    Subscription, Transaction, sum_dest_amount, get_period_usage,
+    get_sub_event_id)
+from .instrumentation import instrumented
+from .periods import recognition_windows
+from .utils import as_card_exp_date, datetime_or_now
 
 LOGGER = logging.getLogger(__name__)
 
@@ -47,17 +51,20 @@ class DryRun(RuntimeError):
     pass
 
 
-def _recognize_subscription_income(subscription, until=None):
+def _recognize_subscription_income(subscription, until=None, windows=None):
     #pylint:disable=too-many-locals,too-many-statements
     until = datetime_or_now(until)
     # [``recognize_start``, ``recognize_end``[ is one period over which
     # revenue is recognized. It will slide over the subscription
     # lifetime from ``created_at`` to ``until``.
+    if windows is None:
+        windows = recognition_windows(
+            subscription, ends_at=until)[subscription.pk]
+    if not windows:
+        return
     order_subscribe_beg = subscription.created_at
     recognize_period_idx = 0
-    recognize_start = subscription.created_at
-    recognize_end = (subscription.created_at
-        + relativedelta(months=recognize_period_idx + 1))
+    recognize_start, recognize_end, nb_periods = windows[recognize_period_idx]
     LOGGER.debug('process %s', subscription)
     for order in Transaction.objects.get_subscription_receivable(
             subscription, until=until):
@@ -65,7 +72,9 @@ def _recognize_subscription_income(subscription, until=None):
         # the subset of the subscription lifetime the order paid for.
         # It covers ``order_periods`` plan periods.
         order_amount = order.dest_amount
-        order_periods = order.get_event().plan.period_number(order.descr)
+        # ``order.get_event()`` is *subscription* since receivables
+        # are filtered on its event_id.
+        order_periods = subscription.plan.period_number(order.descr)
         order_subscribe_end = subscription.plan.end_of_period(
             order_subscribe_beg, nb_periods=order_periods)
         min_end = min(order_subscribe_end, until)
@@ -78,8 +87,6 @@ def _recognize_subscription_income(subscription, until=None):
             # we use ``<=`` here because we compare that bounds
             # are equal instead of searching for points within
             # the interval.
-            nb_periods = subscription.nb_periods(
-                recognize_start, recognize_end)
             # XXX integer division
             to_recognize_amount = int(
                 (nb_periods * order_amount) // order_periods)
@@ -163,16 +170,18 @@ def _recognize_subscription_income(subscription, until=None):
                         descr=descr)
 
             recognize_period_idx += 1
-            recognize_start = (subscription.created_at
-                + relativedelta(months=recognize_period_idx))
-            recognize_end = (subscription.created_at
-                + relativedelta(months=recognize_period_idx + 1))
+            if recognize_period_idx >= len(windows):
+                # All remaining windows end after ``until``.
+                return
+            recognize_start, recognize_end, nb_periods = windows[
+                recognize_period_idx]
 
         order_subscribe_beg = order_subscribe_end
         if recognize_end >= until:
             break
 
 
+@instrumented('renewals.recognize_income')
 def recognize_income(until=None, dry_run=False):
     """
     Create all ``Transaction`` necessary to recognize revenue
@@ -180,12 +189,16 @@ def recognize_income(until=None, dry_run=False):
     """
     until = datetime_or_now(until)
     LOGGER.info("recognize income until %s ...", until)
-    for subscription in Subscription.objects.valid_for(created_at__lte=until):
+    subscriptions = list(Subscription.objects.valid_for(
+        created_at__lte=until).select_related('plan'))
+    windows = recognition_windows(subscriptions, ends_at=until)
+    for subscription in subscriptions:
         # We need to pass through subscriptions otherwise we won't recognize
         # income on subscription that were just cancelled.
         try:
             with transaction.atomic():
-                _recognize_subscription_income(subscription, until=until)
+                _recognize_subscription_income(subscription, until=until,
+                    windows=windows[subscription.pk])
                 if dry_run:
                     raise DryRun()
         except AssertionError as err:
@@ -196,6 +209,7 @@ def recognize_income(until=None, dry_run=False):
             pass
 
 
+@instrumented('renewals.extend_subscriptions')
 def extend_subscriptions(at_time=None, dry_run=False):
     """
     Extend active subscriptions
@@ -233,79 +247,132 @@ def extend_subscriptions(at_time=None, dry_run=False):
                         subscription, subscription.ends_at, err)
 
 
+def _expires_before(exp_date, at_time):
+    return at_time >= datetime(year=exp_date.year,
+        month=exp_date.month, day=1, tzinfo=at_time.tzinfo)
+
+
+@instrumented('renewals.trigger_expiration_notices')
 def trigger_expiration_notices(at_time=None, nb_days=15, dry_run=False):
     """
-    Trigger a signal for all subscriptions which are near the expiration date.
-    """
-
-    def _handle_organization_notices(organization):
-        if organization.processor_card_key:
-            card = organization.retrieve_card()
-            try:
-                exp_month, exp_year = card['exp_date'].split('/')
-                exp_date = datetime(year=int(exp_year),
-                    month=int(exp_month), day=1, tzinfo=at_time.tzinfo)
-                if lower >= exp_date:
-                    LOGGER.info("payment method expires soon for %s",
-                        organization)
-                    if not dry_run:
-                        signals.card_expires_soon.send(
-                            sender=__name__, organization=organization,
-                            days=nb_days)
-            except (KeyError, ValueError):
-                # exp info is missing or the format is incorrect
-                pass
-        else:
-            LOGGER.info("%s doesn't have a payment method attached",
-                organization)
-            if not dry_run:
-                signals.payment_method_absent.send(sender=__name__,
-                    organization=organization)
+    Records a notice for all subscriptions which are near the expiration
+    date. *nb_days* is a number of days or a list of them (ex:
+    ``EXPIRE_NOTICE_DAYS``), all handled in a single pass.
 
+    Notices are sent by ``send_expiration_notices`` such that the renewals
+    job does not wait on the e-mail server.
+    """
+    #pylint:disable=too-many-locals
     at_time = datetime_or_now(at_time)
-    lower = at_time + relativedelta(days=nb_days)
-    upper = at_time + relativedelta(days=nb_days + 1)
-    LOGGER.info(
+    if isinstance(nb_days, six.integer_types):
+        nb_days = [nb_days]
+    windows = []
+    filter_args = Q()
+    for days in nb_days:
+        lower = at_time + relativedelta(days=days)
+        upper = at_time + relativedelta(days=days + 1)
+        LOGGER.info(
         "trigger notifications for subscription expiring within [%s,%s[ ...",
-        lower, upper)
-    prev_organization = None
-    subscription = None
-    for subscription in Subscription.objects.valid_for(ends_at__gte=lower,
-            ends_at__lt=upper).order_by('organization'):
+            lower, upper)
+        windows += [(days, lower, upper)]
+        filter_args |= Q(ends_at__gte=lower, ends_at__lt=upper)
+
+    notice_date = at_time.date()
+    notices = []
+    # Organizations to check for a payment method, per expiration window.
+    organization_windows = OrderedDict()
+    for subscription in Subscription.objects.valid_for().filter(
+            filter_args).select_related('organization', 'plan').order_by(
+            'organization', 'pk'):
         org = subscription.organization
         plan = subscription.plan
-
-        try:
+        for days, lower, upper in windows:
+            if not (lower <= subscription.ends_at < upper):
+                continue
             if subscription.auto_renew:
                 if plan.renewal_type == plan.AUTO_RENEW:
-                    if org.id != prev_organization:
-                        _handle_organization_notices(org)
-
-                    prev_organization = org.id
-            else:
-                if plan.renewal_type == plan.ONE_TIME:
-                    LOGGER.info("trigger upgrade soon for %s", subscription)
-                    if not dry_run:
-                        signals.subscription_upgrade.send(sender=__name__,
-                            subscription=subscription, nb_days=nb_days)
-
-                elif plan.renewal_type == plan.REPEAT:
-                    LOGGER.info("trigger expires soon for %s", subscription)
-                    if not dry_run:
-                        signals.expires_soon.send(sender=__name__,
-                            subscription=subscription, nb_days=nb_days)
-
-        except Exception as err: #pylint:disable=broad-except
-            # We use `Exception` because the email server might be
-            # unavailable but ConnectionRefusedError is not a subclass
-            # of RuntimeError.
-            LOGGER.exception("error: %s", err)
-
-    # flushing the last organization
-    if subscription and subscription.organization.id != prev_organization:
-        _handle_organization_notices(subscription.organization)
+                    organization_windows[(org.pk, days)] = (org, lower)
+            elif plan.renewal_type == plan.ONE_TIME:
+                LOGGER.info("trigger upgrade soon for %s", subscription)
+                notices += [ExpirationNotice(
+                    kind=ExpirationNotice.SUBSCRIPTION_UPGRADE,
+                    organization=org, subscription=subscription,
+                    nb_days=days, notice_date=notice_date,
+                    next_attempt_at=at_time)]
+            elif plan.renewal_type == plan.REPEAT:
+                LOGGER.info("trigger expires soon for %s", subscription)
+                notices += [ExpirationNotice(
+                    kind=ExpirationNotice.EXPIRES_SOON,
+                    organization=org, subscription=subscription,
+                    nb_days=days, notice_date=notice_date,
+                    next_attempt_at=at_time)]
+
+    for (_, days), (org, lower) in six.iteritems(organization_windows):
+        if org.processor_card_key:
+            # Expiration dates are recorded locally after the card was
+            # retrieved from the processor. The card might have been updated
+            # on the processor since, so a local date which expires soon
+            # is checked again before sending a notice.
+            exp_date = org.card_exp_date
+            if not exp_date or _expires_before(exp_date, lower):
+                try:
+                    exp_date = as_card_exp_date(
+                        org.retrieve_card().get('exp_date'))
+                except Exception as err: #pylint:disable=broad-except
+                    # The processor might be unavailable. We log the error
+                    # and move on to the next organization.
+                    LOGGER.exception("error: %s", err)
+                    continue
+            if exp_date and _expires_before(exp_date, lower):
+                LOGGER.info("payment method expires soon for %s", org)
+                notices += [ExpirationNotice(
+                    kind=ExpirationNotice.CARD_EXPIRES_SOON,
+                    organization=org, nb_days=days, notice_date=notice_date,
+                    next_attempt_at=at_time)]
+        else:
+            LOGGER.info("%s doesn't have a payment method attached", org)
+            notices += [ExpirationNotice(
+                kind=ExpirationNotice.PAYMENT_METHOD_ABSENT,
+                organization=org, nb_days=days, notice_date=notice_date,
+                next_attempt_at=at_time)]
+
+    if not dry_run:
+        ExpirationNotice.objects.enqueue(notices)
+
+
+def _send_expiration_notice(notice):
+    if notice.kind == ExpirationNotice.EXPIRES_SOON:
+        signals.expires_soon.send(sender=__name__,
+            subscription=notice.subscription, nb_days=notice.nb_days)
+    elif notice.kind == ExpirationNotice.SUBSCRIPTION_UPGRADE:
+        signals.subscription_upgrade.send(sender=__name__,
+            subscription=notice.subscription, nb_days=notice.nb_days)
+    elif notice.kind == ExpirationNotice.CARD_EXPIRES_SOON:
+        signals.card_expires_soon.send(sender=__name__,
+            organization=notice.organization, days=notice.nb_days)
+    elif notice.kind == ExpirationNotice.PAYMENT_METHOD_ABSENT:
+        signals.payment_method_absent.send(sender=__name__,
+            organization=notice.organization)
+
+
+@instrumented('renewals.send_expiration_notices')
+def send_expiration_notices(at_time=None, batch_size=100):
+    """
+    Triggers the signals for the notices recorded by
+    ``trigger_expiration_notices``. Returns the number of notices processed.
+    """
+    nb_processed = 0
+    while True:
+        nb_batch = ExpirationNotice.objects.process_pending(
+            _send_expiration_notice, at_time=at_time, batch_size=batch_size)
+        nb_processed += nb_batch
+        if nb_batch < batch_size:
+            break
+    return nb_processed
+
 
 
+@instrumented('renewals.create_charges_for_balance')
 def create_charges_for_balance(until=None, dry_run=False):
     """
     Create charges for all accounts payable.
@@ -357,6 +424,7 @@ def create_charges_for_balance(until=None, dry_run=False):
                 organization)
 
 
+@instrumented('renewals.complete_charges')
 def complete_charges():
     """
     Update the state of all charges in progress.
@@ -0,0 +1,165 @@
+# Copyright (c) 2018, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Search backends used by list views to filter a queryset on the words
+passed in the ``q`` parameter.
+
+Each word must match at least one of the view ``search_fields``
+(case-insensitive substring match). All words must match.
+
+``IcontainsSearchBackend`` (the default) matches each field with
+``icontains``. ``SearchDocumentBackend`` matches the fields a model lists
+in ``SEARCH_DOCUMENT_FIELDS`` against its denormalized ``search_document``
+column instead, when a view searches all of them, such that a word
+is looked up in a single column (backed by a trigram index on PostgreSQL)
+rather than across many.
+
+The ``search_document`` column is updated by ``Organization.save()``.
+Rows written without calling ``save()`` (``QuerySet.update``,
+``bulk_create``, ``loaddata``) are left with an empty document and are
+matched field by field until their document is rebuilt, either by saving
+them again or, for all organizations, with:
+
+.. code-block:: python
+
+    for organization in Organization.objects.all().iterator():
+        organization.save(update_fields=['search_document'])
+"""
+from __future__ import unicode_literals
+
+import operator
+from functools import reduce
+
+from django.db.models import Q
+from django.utils import six
+
+from . import settings
+from .compat import import_string
+
+
+_SEARCH_BACKEND = None
+
+
+class IcontainsSearchBackend(object):
+    """
+    Matches each word against every search field with ``icontains``.
+    """
+
+    def get_word_filter(self, model, search_fields, word):
+        #pylint:disable=no-self-use,unused-argument
+        """
+        Returns a ``Q`` which matches *word* in one of *search_fields*.
+        """
+        return reduce(operator.or_, [Q(**{'%s__icontains' % field: word})
+            for field in search_fields])
+
+    def filter_queryset(self, queryset, query, search_fields,
+                        extra_filters=None):
+        """
+        Returns *queryset* filtered on the words in *query*. When specified,
+        *extra_filters* returns a list of additional ``Q`` to match a word.
+        """
+        filters = []
+        for word in query.split():
+            word_filters = [self.get_word_filter(
+                queryset.model, search_fields, word)]
+            if extra_filters:
+                word_filters += extra_filters(word)
+            filters += [reduce(operator.or_, word_filters)]
+        if filters:
+            queryset = queryset.filter(reduce(operator.and_, filters))
+        return queryset.distinct()
+
+
+class SearchDocumentBackend(IcontainsSearchBackend):
+    """
+    Matches search fields against the ``search_document`` column of
+    a (related) model when they include all the fields listed in its
+    ``SEARCH_DOCUMENT_FIELDS``. Rows with an empty ``search_document``
+    are matched field by field.
+    """
+
+    @staticmethod
+    def get_documents(model, search_fields):
+        """
+        Returns the field paths prefixes in *search_fields* which can be
+        matched against a ``search_document`` column.
+        """
+        fields_by_prefix = {}
+        for field in search_fields:
+            prefix, _, name = field.rpartition('__')
+            if prefix not in fields_by_prefix:
+                fields_by_prefix[prefix] = set([])
+            fields_by_prefix[prefix] |= set([name])
+        documents = set([])
+        for prefix, names in six.iteritems(fields_by_prefix):
+            related_model = model
+            for name in prefix.split('__') if prefix else []:
+                related_model = related_model._meta.get_field(
+                    name).related_model
+            document_fields = getattr(
+                related_model, 'SEARCH_DOCUMENT_FIELDS', None)
+            if document_fields and set(document_fields) <= names:
+                documents |= set([prefix])
+        return documents
+
+    def get_word_filter(self, model, search_fields, word):
+        documents = self.get_documents(model, search_fields)
+        by_documents = {}
+        filters = []
+        for field in search_fields:
+            prefix, _, _ = field.rpartition('__')
+            if prefix in documents:
+                by_documents.setdefault(prefix, []).append(field)
+            else:
+                filters += [Q(**{'%s__icontains' % field: word})]
+        for prefix, fields in six.iteritems(by_documents):
+            document = '%s__search_document' % prefix if prefix \
+                else 'search_document'
+            filters += [Q(**{'%s__contains' % document: word.lower()})
+                | (Q(**{document: ""}) & super(
+                    SearchDocumentBackend, self).get_word_filter(
+                    model, fields, word))]
+        return reduce(operator.or_, filters)
+
+
+def get_search_document(instance, fields):
+    """
+    Returns the text matched by ``SearchDocumentBackend`` for *instance*.
+    """
+    # Words never contain whitespaces so they cannot match across fields.
+    return '\n'.join([six.text_type(getattr(instance, field) or "")
+        for field in fields]).lower()
+
+
+def get_search_backend():
+    global _SEARCH_BACKEND #pylint:disable=global-statement
+    if _SEARCH_BACKEND is None:
+        backend = settings.SEARCH_BACKEND
+        if isinstance(backend, six.string_types):
+            backend = import_string(backend)
+        _SEARCH_BACKEND = backend() if isinstance(backend, type) else backend
+    return _SEARCH_BACKEND
@@ -42,6 +42,14 @@ BROKER.IS_INSTANCE_CALLABLE None            Function that will return `True`
                                             broker. If `None` we will compare
                                             provider with the instance returned
                                             by `BROKER.GET_INSTANCE`.
+CART.CACHE                 'default'        Cache the invoicables computed from
+                                            a cart are stored in.
+CART.CACHE_TIMEOUT         300              Number of seconds invoicables
+                                            are reused between renderings
+                                            of the cart page as long as
+                                            the cart is unchanged. Checkout
+                                            always uses current prices
+                                            (0 disables the cache).
 BYPASS_PERMISSION_CHECK    False            Skip all permission checks
 BYPASS_PROCESSOR_AUTH      False            Do not check the auth token against
                                             the processor to set processor keys
@@ -50,12 +58,30 @@ EXTRA_MIXIN               object            Class to to inject into the parents
                                             of the Mixin hierarchy.
                                             (useful for composition of Django
                                             apps)
+INSTRUMENTATION.SINK      None              Sink (dotted path or instance)
+                                            timing events are emitted to
+                                            (ex: ``saas.instrumentation.
+                                            LoggingSink``). `None` disables
+                                            instrumentation.
+INSTRUMENTATION.CACHE     'default'         Django cache processor telemetry
+                                            counters are kept in. It must
+                                            be shared between processes
+                                            (ex: memcached, redis).
+INSTRUMENTATION.COUNT_QUERIES False         Also count SQL queries in timing
+                                            events.
+INSTRUMENTATION.PROCESSOR_TELEMETRY False   Record latency and errors of calls
+                                            to the processor backend
+                                            in the ``CACHE``.
 ORGANIZATION_MODEL        saas.Organization Replace the ``Organization`` model
                                             (useful for composition of Django
                                             apps)
 PAGE_SIZE                 25                Maximum number of objects to return
                                             per API calls.
 PROCESSOR                :doc:`Stripe backend<backends>`
+PROCESSOR.CACHE_TIMEOUT  900                Number of seconds card and bank
+                                            information retrieved from
+                                            the processor are cached
+                                            (0 disables the cache).
 PROCESSOR_ID             1                  pk of the processor ``Organization``
 PROCESSOR_BACKEND_CALLABLE None             Optional function that returns
                                             the processor backend
@@ -70,6 +96,25 @@ PROVIDER_SITE_CALLABLE   None               Optional function that returns
 ROLE_RELATION            saas.Role          Replace the ``Role`` model
                                             (useful for composition of Django
                                             apps)
+SEARCH_BACKEND           saas.search.       Backend (dotted path or instance)
+                         IcontainsSearchBackend filtering lists on the ``q``
+                                            parameter.
+SIGNALS_OUTBOX           False              Record ``order_executed``,
+                                            ``charge_updated``,
+                                            ``user_relation_added``,
+                                            ``subscription_grant_created``
+                                            and ``weekly_sales_report_created``
+                                            when the transaction commits and
+                                            deliver them to receivers through
+                                            the ``process_signal_events``
+                                            command.
+SUBSCRIBER_FLAGS         False              List registered users by looking up
+                                            ``SubscriberFlag`` instead of
+                                            joining ``Role`` and
+                                            ``Subscription``. Flags are only
+                                            maintained while this is on. Run
+                                            ``refresh_subscriber_flags``
+                                            after turning it on.
 TERMS_OF_USE             'terms-of-use'     slug for the ``Agreement`` stating
                                             ther Terms of Use of the site.
 ========================  ================= ===========
@@ -83,10 +128,23 @@ _SETTINGS = {
     # Do not check the auth token against the processor to set processor keys.
     # (useful while testing).
     'BYPASS_PROCESSOR_AUTH': False,
+    'CART': {
+        'CACHE': 'default',
+        'CACHE_TIMEOUT': 300,
+    },
     'DEFAULT_UNIT': 'usd',
     'EXPIRE_NOTICE_DAYS': [15],
     'EXTRA_MIXIN': object,
     'EXTRA_FIELD': None,
+    'INSTRUMENTATION': {
+        'SINK': None,
+        'CACHE': 'default',
+        'COUNT_QUERIES': False,
+        'PREFIX': 'saas',
+        'PROCESSOR_TELEMETRY': False,
+        'STATSD_HOST': 'localhost',
+        'STATSD_PORT': 8125,
+    },
     'ORGANIZATION_MODEL': 'saas.Organization',
     'PAGE_SIZE': 25,
     'BROKER': {
@@ -104,12 +162,17 @@ _SETTINGS = {
         'PRIV_KEY': None,
         'PUB_KEY': None,
         'AUTHORIZE_CALLABLE': None,
+        'CACHE': 'default',
+        'CACHE_TIMEOUT': 900,
         'REDIRECT_CALLABLE': None,
         'WEBHOOK_URL': 'stripe/postevent',
         'WEBHOOK_SECRET': None,
     },
     'PROCESSOR_BACKEND_CALLABLE': None,
     'ROLE_RELATION': 'saas.Role',
+    'SEARCH_BACKEND': 'saas.search.IcontainsSearchBackend',
+    'SIGNALS_OUTBOX': False,
+    'SUBSCRIBER_FLAGS': False,
     'TERMS_OF_USE': 'terms-of-use',
 }
 _SETTINGS.update(getattr(settings, 'SAAS', {}))
@@ -123,13 +186,18 @@ AUTH_USER_MODEL = getattr(
     settings, 'AUTH_USER_MODEL', 'django.contrib.auth.models.User')
 
 BYPASS_PROCESSOR_AUTH = _SETTINGS.get('BYPASS_PROCESSOR_AUTH')
+CART_CACHE = _SETTINGS.get('CART').get('CACHE', 'default')
+CART_CACHE_TIMEOUT = _SETTINGS.get('CART').get('CACHE_TIMEOUT', 300)
 CREDIT_ON_CREATE = _SETTINGS.get('CREDIT_ON_CREATE')
 EXPIRE_NOTICE_DAYS = _SETTINGS.get('EXPIRE_NOTICE_DAYS')
 EXTRA_MIXIN = _SETTINGS.get('EXTRA_MIXIN')
+INSTRUMENTATION = _SETTINGS.get('INSTRUMENTATION')
 ORGANIZATION_MODEL = _SETTINGS.get('ORGANIZATION_MODEL')
 PAGE_SIZE = _SETTINGS.get('PAGE_SIZE')
 PROCESSOR = _SETTINGS.get('PROCESSOR')
 PROCESSOR_BACKEND_CALLABLE = _SETTINGS.get('PROCESSOR_BACKEND_CALLABLE')
+PROCESSOR_CACHE = PROCESSOR.get('CACHE', 'default')
+PROCESSOR_CACHE_TIMEOUT = PROCESSOR.get('CACHE_TIMEOUT', 900)
 PROCESSOR_FALLBACK = PROCESSOR.get('FALLBACK', [])
 PROCESSOR_ID = PROCESSOR.get('INSTANCE_PK', 1)
 PROCESSOR_HOOK_URL = PROCESSOR.get('WEBHOOK_URL', 'stripe/postevent')
@@ -139,6 +207,9 @@ IS_BROKER_CALLABLE = _SETTINGS.get('BROKER').get('IS_INSTANCE_CALLABLE', None)
 BUILD_ABSOLUTE_URI_CALLABLE = _SETTINGS.get('BROKER').get(
     'BUILD_ABSOLUTE_URI_CALLABLE')
 ROLE_RELATION = _SETTINGS.get('ROLE_RELATION')
+SEARCH_BACKEND = _SETTINGS.get('SEARCH_BACKEND')
+SIGNALS_OUTBOX = _SETTINGS.get('SIGNALS_OUTBOX')
+SUBSCRIBER_FLAGS = _SETTINGS.get('SUBSCRIBER_FLAGS')
 TERMS_OF_USE = _SETTINGS.get('TERMS_OF_USE')
 DEFAULT_UNIT = _SETTINGS.get('DEFAULT_UNIT')
 
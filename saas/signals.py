@@ -22,7 +22,161 @@
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+"""
+Signals sent by djaodjin-saas.
+
+When ``SIGNALS_OUTBOX`` is enabled, ``OutboxSignal`` signals are not
+delivered right away. They are recorded as ``SignalEvent`` once
+the current transaction commits and delivered to receivers by
+the ``process_signal_events`` command.
+"""
+import datetime, decimal, json, logging
+
+from django.apps import apps as django_apps
+from django.db import models, router, transaction
 from django.dispatch import Signal
+from django.http import HttpRequest
+from django.utils import six
+
+from . import settings
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _serialize_model(instance):
+    """
+    Snapshots the fields of *instance* such that receivers see it as it was
+    when the signal was sent (ex: ``charge.state``) rather than as it is
+    when the signal is delivered.
+    """
+    fields = {}
+    for field in instance._meta.concrete_fields:
+        value = field.value_from_object(instance)
+        fields[field.attname] = (
+            None if value is None else field.value_to_string(instance))
+    return {'__model__': instance._meta.label, 'pk': instance.pk,
+        'fields': fields}
+
+
+def _deserialize_model(value):
+    model = django_apps.get_model(value['__model__'])
+    if 'fields' not in value:
+        # Signals recorded before fields were part of the payload.
+        return model.objects.get(pk=value['pk'])
+    field_names = []
+    values = []
+    for field in model._meta.concrete_fields:
+        if field.attname in value['fields']:
+            field_value = value['fields'][field.attname]
+            field_names += [field.attname]
+            values += [field_value if field_value is None
+                else field.to_python(field_value)]
+    return model.from_db(router.db_for_read(model), field_names, values)
+
+
+def _serialize(value):
+    #pylint:disable=too-many-return-statements
+    if isinstance(value, models.Model):
+        return _serialize_model(value)
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'__date__': value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {'__decimal__': str(value)}
+    if isinstance(value, HttpRequest):
+        # Requests cannot be persisted. Receivers get `None`.
+        return None
+    if isinstance(value, dict):
+        return {key: _serialize(val) for key, val in six.iteritems(value)}
+    if isinstance(value, (list, tuple, models.QuerySet)):
+        return [_serialize(val) for val in value]
+    return value
+
+
+def _deserialize(value):
+    #pylint:disable=too-many-return-statements
+    from .utils import datetime_or_now # avoid import loop
+    if isinstance(value, dict):
+        if '__model__' in value:
+            return _deserialize_model(value)
+        if '__datetime__' in value:
+            return datetime_or_now(value['__datetime__'])
+        if '__date__' in value:
+            return datetime.datetime.strptime(
+                value['__date__'], '%Y-%m-%d').date()
+        if '__decimal__' in value:
+            return decimal.Decimal(value['__decimal__'])
+        return {key: _deserialize(val) for key, val in six.iteritems(value)}
+    if isinstance(value, list):
+        return [_deserialize(val) for val in value]
+    return value
+
+
+def _get_object_key(value):
+    """
+    Returns the pk of the organization *value* refers to, if any.
+    """
+    if isinstance(value, (list, tuple)):
+        return _get_object_key(value[0]) if value else None
+    if isinstance(value, models.Model):
+        if value._meta.model_name == 'organization':
+            return value.pk
+        for attr in ('organization_id', 'customer_id',
+                     'dest_organization_id'):
+            if getattr(value, attr, None):
+                return getattr(value, attr)
+    return None
+
+
+class OutboxSignal(Signal):
+    """
+    Signal recorded in an outbox table and delivered later on
+    when ``SIGNALS_OUTBOX`` is enabled.
+    """
+    registry = {}
+
+    def __init__(self, name, providing_args=None):
+        super(OutboxSignal, self).__init__(providing_args=providing_args)
+        self.name = name
+        # ``Signal.providing_args`` is a set. We need the arguments
+        # in order to pick the organization the signal refers to.
+        self.object_args = list(providing_args or [])
+        self.registry[name] = self
+
+    def send(self, sender, **named):
+        if not settings.SIGNALS_OUTBOX:
+            return self.send_now(sender, **named)
+        from .models import SignalEvent # avoid import loop
+        object_key = None
+        for arg in self.object_args:
+            object_key = _get_object_key(named.get(arg))
+            if object_key:
+                break
+        payload = json.dumps(_serialize(named))
+        if not isinstance(sender, six.string_types):
+            sender = '%s.%s' % (sender.__module__, sender.__name__)
+        transaction.on_commit(lambda: SignalEvent.objects.record(
+            self.name, sender, payload,
+            object_key=str(object_key) if object_key else None))
+        return []
+
+    def send_now(self, sender, **named):
+        """
+        Delivers the signal to its receivers right away.
+        """
+        return super(OutboxSignal, self).send(sender, **named)
+
+
+def deliver_signal_event(signal_event):
+    """
+    Delivers a ``SignalEvent`` to the receivers of its signal.
+    """
+    signal = OutboxSignal.registry[signal_event.signal_name]
+    signal.send_now(signal_event.sender,
+        **_deserialize(json.loads(signal_event.payload)))
+
 
 #pylint: disable=invalid-name
 organization_updated = Signal(providing_args=[
@@ -32,26 +186,29 @@ plan_updated = Signal(providing_args=['plan'])
 bank_updated = Signal(providing_args=['organization', 'user'])
 card_updated = Signal(
     providing_args=['organization', 'user', 'old_card', 'new_card'])
-charge_updated = Signal(providing_args=['charge', 'user'])
-order_executed = Signal(providing_args=['invoiced_items', 'user'])
+charge_updated = OutboxSignal('charge_updated',
+    providing_args=['charge', 'user'])
+order_executed = OutboxSignal('order_executed',
+    providing_args=['invoiced_items', 'user'])
 claim_code_generated = Signal(providing_args=[
     'subscriber', 'claim_code', 'user'])
 expires_soon = Signal(providing_args=['subscription', 'nb_days'])
 card_expires_soon = Signal(providing_args=['organization', 'nb_days'])
 subscription_upgrade = Signal(providing_args=['subscription', 'nb_days'])
 payment_method_absent = Signal(providing_args=['organization'])
-user_relation_added = Signal(providing_args=['role', 'reason'])
+user_relation_added = OutboxSignal('user_relation_added',
+    providing_args=['role', 'reason'])
 user_relation_requested = Signal(providing_args=[
     'organization', 'user', 'reason'])
 role_grant_accepted = Signal(providing_args=[
     'role', 'grant_key'])
 subscription_grant_accepted = Signal(providing_args=[
     'subscription', 'grant_key'])
-subscription_grant_created = Signal(providing_args=[
-    'subscription', 'reason', 'invite'])
+subscription_grant_created = OutboxSignal('subscription_grant_created',
+    providing_args=['subscription', 'reason', 'invite'])
 subscription_request_accepted = Signal(providing_args=[
     'subscription', 'request_key'])
 subscription_request_created = Signal(providing_args=[
     'subscription', 'reason'])
-weekly_sales_report_created = Signal(providing_args=[
-    'provider', 'dates', 'data'])
+weekly_sales_report_created = OutboxSignal('weekly_sales_report_created',
+    providing_args=['provider', 'dates', 'data'])
@@ -22,9 +22,80 @@
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from django.test import TestCase
+import calendar, datetime, io, json, os, random, time, traceback
+from collections import OrderedDict, deque
 
-from saas.managers.metrics import month_periods
+try:
+    from unittest import mock
+except ImportError: # python2
+    import mock
+
+import django
+from dateutil.relativedelta import relativedelta
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management import call_command
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncMonth
+from django.http import HttpRequest
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import utc
+
+from saas import search, settings as saas_settings, signals
+from saas.api.users import RegisteredQuerysetMixin
+from saas.compat import NoReverseMatch, reverse
+from saas.instrumentation import MemorySink, instrumented, set_sink, timed
+from saas.ledger import LedgerSnapshot
+from saas.management.commands.report_weekly_revenue import (
+    Command as ReportWeeklyRevenueCommand)
+from saas.management.commands.reconcile_with_processor import (
+    Command as ReconcileWithProcessorCommand)
+from saas.managers.metrics import (abs_monthly_balances, active_subscribers,
+    aggregate_transactions_by_period, aggregate_transactions_change_by_period,
+    bulk_aggregate_transactions_by_period,
+    bulk_aggregate_transactions_change_by_period, churn_subscribers,
+    month_periods, monthly_balances, monthly_balances_by_selector,
+    rollup_metrics)
+from saas.mixins import CartMixin
+from saas.periods import recognition_windows
+from saas.renewals import send_expiration_notices, trigger_expiration_notices
+from saas.backends import CardError
+from saas.backends.stripe_processor.base import StripeBackend
+from saas.backends.telemetry import (IN_FLIGHT_TIMEOUT, get_telemetry,
+    record_call_ended, record_call_started, reset_telemetry)
+from saas.models import (CartItem, Charge, Coupon, ExpirationNotice,
+    LedgerAccount, MetricFact, Organization, PeriodCalculator, Plan,
+    SignalEvent, SubscriberFlag, Subscription, Transaction, WebhookEvent)
+from saas.signals import deliver_signal_event
+from saas.utils import datetime_or_now, get_role_model
+
+try:
+    from django.urls import RegexURLResolver
+except ImportError: # django < 1.10
+    from django.core.urlresolvers import RegexURLResolver
+
+
+DJANGO_DIR = os.path.dirname(os.path.abspath(django.__file__))
+SAAS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Values used to fill the url patterns when querying API endpoints
+# against the ``test_data`` fixtures.
+API_URL_KWARGS = {
+    'charge': 'ch_test',
+    'coupon': 'HALLOWEEN',
+    'organization': 'cowork',
+    'plan': 'premium',
+    'rank': '1',
+    'report': 'income',
+    'request_key': '0' * 40,
+    'role': 'manager',
+    'subscribed_plan': 'premium',
+    'subscriber': 'xia',
+    'user': 'donny',
+}
 
 
 class SaasTests(TestCase):
@@ -119,3 +190,1349 @@ class SaasTests(TestCase):
             '2018-03-01 00:00:00-05:00',
             '2018-04-01 00:00:00-04:00',
             '2018-04-18 00:00:00-04:00'])
+
+
+def _reference_period_for(created_at, interval, at_time):
+    """
+    Iterative implementation ``Subscription.period_for`` used to have
+    (with weekly periods computed in weeks rather than days).
+    """
+    delta = at_time - created_at
+    if interval == Plan.HOURLY:
+        estimated = relativedelta(hours=delta.total_seconds() // 3600)
+        period = relativedelta(hours=1)
+    elif interval == Plan.DAILY:
+        estimated = relativedelta(days=delta.days)
+        period = relativedelta(days=1)
+    elif interval == Plan.WEEKLY:
+        estimated = relativedelta(weeks=delta.days // 7)
+        period = relativedelta(days=7)
+    elif interval == Plan.MONTHLY:
+        estimated = relativedelta(at_time, created_at)
+        estimated.normalized()
+        estimated = relativedelta(
+            months=estimated.years * 12 + estimated.months)
+        period = relativedelta(months=1)
+    elif interval == Plan.YEARLY:
+        estimated = relativedelta(at_time, created_at)
+        estimated.normalized()
+        estimated = relativedelta(years=estimated.years)
+        period = relativedelta(years=1)
+    lower = created_at + estimated
+    upper = created_at + (estimated + period)
+    while not (lower <= at_time and at_time < upper):
+        if at_time < lower:
+            upper = lower
+            lower = lower - period
+        elif at_time >= upper:
+            lower = upper
+            upper = upper + period
+    return lower, upper
+
+
+def _reference_nb_periods(subscription, start, until):
+    """
+    Counts periods between *start* and *until* by walking through them
+    one at a time.
+    """
+    created_at = subscription.created_at
+    interval = subscription.plan.interval
+    start_lower, start_upper = _reference_period_for(
+        created_at, interval, start)
+    until_lower, until_upper = _reference_period_for(
+        created_at, interval, until)
+    if start_upper > until_lower:
+        return subscription._period_fraction(
+            start, until, start_lower, start_upper)
+    full_periods = 0
+    upper = start_upper
+    while upper < until_lower:
+        upper = _reference_period_for(created_at, interval, upper)[1]
+        full_periods += 1
+    result = full_periods
+    if start < start_upper:
+        result += subscription._period_fraction(
+            start, start_upper, start_lower, start_upper)
+    if until_lower < until:
+        result += subscription._period_fraction(
+            until_lower, until, until_lower, until_upper)
+    return result
+
+
+class ChurnFactsTests(TestCase):
+    """
+    Tests ``churn_subscribers`` only relies on rolled up facts
+    when they are complete.
+    """
+    fixtures = ['test_data']
+
+    def test_missing_provider_facts(self):
+        from_date = datetime.datetime(2019, 2, 1, tzinfo=utc)
+        live = churn_subscribers(from_date=from_date)
+        starts_at = datetime.datetime(2019, 1, 1, tzinfo=utc)
+        ends_at = datetime.datetime(2019, 2, 1, tzinfo=utc)
+        self.assertIn([ends_at, 3], live)
+        providers = set(Subscription.objects.values_list(
+            'plan__organization', flat=True))
+        for provider_id in providers:
+            MetricFact.objects.create(organization_id=provider_id,
+                interval=Plan.MONTHLY, starts_at=starts_at, ends_at=ends_at,
+                churned_subscribers=100)
+        self.assertIn([ends_at, 100 * len(providers)],
+            churn_subscribers(from_date=from_date))
+        # A provider which was not rolled up yet.
+        subscriber = Subscription.objects.get(pk=7).organization
+        plan = Plan.objects.create(slug='churn-facts', title="Churn facts",
+            organization=subscriber, period_amount=100,
+            interval=Plan.MONTHLY)
+        subscription = Subscription.objects.create(organization=subscriber,
+            plan=plan, ends_at=starts_at + relativedelta(days=10))
+        # ``created_at`` is ``auto_now_add``.
+        Subscription.objects.filter(pk=subscription.pk).update(
+            created_at=starts_at)
+        self.assertIn([ends_at, 4], churn_subscribers(from_date=from_date))
+
+
+class RollupMetricsTests(TestCase):
+    """
+    Tests ``rollup_metrics`` is idempotent and rolls up the values
+    computed on the fly when there are no facts.
+    """
+    fixtures = ['test_data']
+
+    def setUp(self):
+        # ``created_at`` is ``auto_now_add``.
+        Subscription.objects.update(
+            created_at=datetime.datetime(2018, 11, 20, tzinfo=utc))
+        Transaction.objects.update(
+            created_at=datetime.datetime(2018, 12, 5, tzinfo=utc))
+        self.provider = Organization.objects.get(slug='cowork')
+        self.until = datetime.datetime(2019, 2, 1, tzinfo=utc)
+
+    @staticmethod
+    def _facts():
+        return sorted(MetricFact.objects.values_list('organization', 'plan',
+            'interval', 'starts_at', 'ends_at', 'active_subscribers',
+            'new_subscribers', 'churned_subscribers', 'customers',
+            'receivables', 'payments', 'refunds', 'income', 'unit'),
+            key=lambda fact: [str(field) for field in fact])
+
+    def test_idempotent(self):
+        rollup_metrics(self.provider, until=self.until)
+        facts = self._facts()
+        self.assertTrue(facts)
+        rollup_metrics(self.provider, until=self.until)
+        self.assertEqual(self._facts(), facts)
+        # ``plan`` is nullable so ``unique_together`` does not prevent
+        # duplicate totals.
+        for interval in (Plan.DAILY, Plan.MONTHLY):
+            totals = list(MetricFact.objects.filter(organization=self.provider,
+                plan=None, interval=interval).values_list(
+                'starts_at', flat=True))
+            self.assertTrue(totals)
+            self.assertEqual(len(totals), len(set(totals)))
+
+    def test_facts_match_live_values(self):
+        plans = list(Plan.objects.filter(organization=self.provider))
+        live = ([active_subscribers(plan, from_date=self.until)
+                for plan in plans],
+            [churn_subscribers(plan=plan, from_date=self.until)
+                for plan in plans + [None]])
+        rollup_metrics(self.provider, until=self.until)
+        self.assertTrue(MetricFact.objects.filter(
+            interval=Plan.DAILY, ends_at=self.until).exists())
+        self.assertTrue(MetricFact.objects.filter(
+            interval=Plan.MONTHLY, ends_at=self.until).exists())
+        for fact in MetricFact.objects.filter(interval=Plan.MONTHLY,
+                plan__isnull=False):
+            self.assertEqual(fact.active_subscribers,
+                Subscription.objects.active_at(
+                    fact.ends_at, plan=fact.plan).count())
+            self.assertEqual(fact.churned_subscribers,
+                Subscription.objects.churn_in_period(
+                    fact.starts_at, fact.ends_at, plan=fact.plan).count())
+        self.assertEqual(([active_subscribers(plan, from_date=self.until)
+                for plan in plans],
+            [churn_subscribers(plan=plan, from_date=self.until)
+                for plan in plans + [None]]), live)
+
+
+class BalancesTests(TestCase):
+    """
+    Tests balances computed in bulk match the balances computed
+    one account selector at a time.
+    """
+    fixtures = ['test_data']
+
+    selectors = ['Receivable', 'Payable', 'Liability', 'EurIncome',
+        'EurWash', 'NoSuchAccount']
+
+    def setUp(self):
+        self.until = datetime.datetime(2016, 12, 1, tzinfo=utc)
+        provider = Organization.objects.get(slug='cowork')
+        for created_at, orig_account, dest_account, amount in (
+                (datetime.datetime(2016, 9, 10, tzinfo=utc),
+                 'EurBank', 'EurWash', 500),
+                (datetime.datetime(2016, 9, 20, tzinfo=utc),
+                 'EurWash', 'EurBank', 500),
+                (datetime.datetime(2016, 10, 5, tzinfo=utc),
+                 'EurBank', 'EurIncome', 1000)):
+            Transaction.objects.create(created_at=created_at,
+                descr="%s to %s" % (orig_account, dest_account),
+                orig_account=orig_account, orig_amount=amount,
+                orig_unit='eur', orig_organization=provider,
+                dest_account=dest_account, dest_amount=amount,
+                dest_unit='eur', dest_organization=provider)
+
+    def test_by_selector(self):
+        balances = monthly_balances_by_selector(
+            self.selectors, until=self.until)
+        for selector in self.selectors:
+            values, unit = balances[selector]
+            expected, expected_unit = monthly_balances(
+                like_account=selector, until=self.until)
+            self.assertEqual(values, expected)
+            self.assertEqual([(item[0], abs(item[1])) for item in values],
+                abs_monthly_balances(like_account=selector,
+                    until=self.until)[0])
+            if expected[-1][1] != 0:
+                self.assertEqual(unit, expected_unit)
+        self.assertEqual(balances['Payable'][1], 'usd')
+        self.assertEqual(balances['EurIncome'][1], 'eur')
+        # A line whose balances are all zero reports the unit of its
+        # transactions, and a line without transactions none at all.
+        self.assertTrue(all([item[1] == 0
+            for item in balances['EurWash'][0]]))
+        self.assertEqual(balances['EurWash'][1], 'eur')
+        self.assertIsNone(balances['NoSuchAccount'][1])
+
+    def test_ledger_snapshot(self):
+        snapshot = LedgerSnapshot.load(chunk_size=2)
+        self.assertEqual(len(snapshot), Transaction.objects.count())
+        provider = Organization.objects.get(slug='cowork')
+        for organization, account in ((None, 'Payable'),
+                (None, 'Liability'), (None, 'EurWash'),
+                (provider, 'EurIncome'), (provider, 'Receivable'),
+                (provider, 'Payable'), (None, 'NoSuchAccount')):
+            values, unit = snapshot.monthly_balances(
+                organization=organization, account=account, until=self.until)
+            expected, expected_unit = monthly_balances(
+                organization=organization, account=account, until=self.until)
+            self.assertEqual(values, expected)
+            if expected[-1][1] != 0:
+                self.assertEqual(unit, expected_unit)
+        for side in ('dest', 'orig'):
+            expected = {}
+            for row in Transaction.objects.annotate(month=TruncMonth(
+                    'created_at', tzinfo=utc)).values('month',
+                    '%s_account' % side, '%s_organization' % side,
+                    '%s_unit' % side).annotate(
+                    amount=Sum('%s_amount' % side)):
+                expected.update({((row['month'].year, row['month'].month),
+                    row['%s_account' % side], row['%s_organization' % side],
+                    row['%s_unit' % side]): row['amount']})
+            self.assertEqual(snapshot.sum_by(
+                ('month', 'account', 'organization', 'unit'), side=side),
+                expected)
+
+    def test_mixed_units(self):
+        Transaction.objects.create(
+            created_at=datetime.datetime(2016, 10, 5, tzinfo=utc),
+            descr="Payable in eur", orig_account='EurBank', orig_amount=100,
+            orig_unit='eur', orig_organization_id=7,
+            dest_account='Payable', dest_amount=100, dest_unit='eur',
+            dest_organization_id=7)
+        with self.assertRaises(ValueError):
+            monthly_balances(account='Payable', until=self.until)
+        with self.assertRaises(ValueError):
+            monthly_balances_by_selector(['Payable'], until=self.until)
+        with self.assertRaises(ValueError):
+            LedgerSnapshot.load().monthly_balances(
+                account='Payable', until=self.until)
+
+
+class WeeklyRevenueTests(TestCase):
+    """
+    Tests revenue aggregated for many providers at once matches
+    the aggregates computed one provider at a time.
+    """
+    fixtures = ['test_data']
+
+    def setUp(self):
+        self.at_time = datetime.datetime(2016, 9, 14, tzinfo=utc)
+        self.providers = list(Organization.objects.filter(
+            is_provider=True).order_by('pk'))
+        organizations = {organization.slug: organization
+            for organization in Organization.objects.all()}
+        for created_at, orig_account, orig_organization, dest_account, \
+            dest_organization, amount in (
+            # Sales
+            ((2015, 9, 1, 12), Transaction.RECEIVABLE, 'cowork',
+             Transaction.PAYABLE, 'xia', 1000),
+            ((2016, 8, 30, 12), Transaction.RECEIVABLE, 'cowork',
+             Transaction.PAYABLE, 'xia', 1000),
+            ((2016, 9, 5, 10), Transaction.RECEIVABLE, 'cowork',
+             Transaction.PAYABLE, 'xia', 1000),
+            # Between midnight UTC and midnight in Los Angeles.
+            ((2016, 9, 4, 3), Transaction.RECEIVABLE, 'cowork',
+             Transaction.PAYABLE, 'stephanie', 500),
+            ((2016, 8, 29, 12), Transaction.RECEIVABLE, 'dibaggio-parents',
+             Transaction.PAYABLE, 'xia', 2000),
+            ((2016, 9, 6, 12), Transaction.RECEIVABLE, 'dibaggio-parents',
+             Transaction.PAYABLE, 'joe-bulk', 3000),
+            ((2016, 9, 11, 2), Transaction.RECEIVABLE, 'tennis-club',
+             Transaction.PAYABLE, 'xia-card7', 700),
+            # Payments
+            ((2016, 9, 5, 11), Transaction.BACKLOG, 'cowork',
+             Transaction.RECEIVABLE, 'cowork', 1000),
+            ((2016, 9, 11, 3), Transaction.BACKLOG, 'tennis-club',
+             Transaction.RECEIVABLE, 'tennis-club', 700),
+            # Refunds
+            ((2016, 9, 7, 12), Transaction.PAYABLE, 'xia',
+             Transaction.REFUND, 'cowork', 200)):
+            Transaction.objects.create(
+                created_at=datetime.datetime(*created_at, tzinfo=utc),
+                descr="%s to %s" % (orig_account, dest_account),
+                orig_account=orig_account, orig_amount=amount,
+                orig_unit='usd',
+                orig_organization=organizations[orig_organization],
+                dest_account=dest_account, dest_amount=amount,
+                dest_unit='usd',
+                dest_organization=organizations[dest_organization])
+
+    def test_bulk_matches_per_provider(self):
+        self.assertEqual(len(self.providers), 3)
+        construct_date_periods = \
+            ReportWeeklyRevenueCommand.construct_date_periods
+        date_periods = (list(construct_date_periods(self.at_time))
+            + list(construct_date_periods(
+                self.at_time, timezone='America/Los_Angeles'))
+            + [month_periods(3, self.at_time),
+               month_periods(3, self.at_time, tz='America/Los_Angeles')])
+        for periods in date_periods:
+            changes = bulk_aggregate_transactions_change_by_period(
+                self.providers, Transaction.RECEIVABLE, periods,
+                account_title='Sales')
+            payments = bulk_aggregate_transactions_by_period(
+                self.providers, Transaction.RECEIVABLE, periods,
+                orig='dest', dest='dest', orig_account=Transaction.BACKLOG,
+                orig_organization=F('dest_organization'))
+            refunds = bulk_aggregate_transactions_by_period(
+                self.providers, Transaction.REFUND, periods,
+                orig='dest', dest='dest')
+            for provider in self.providers:
+                self.assertEqual(changes[provider.pk],
+                    aggregate_transactions_change_by_period(provider,
+                        Transaction.RECEIVABLE, periods,
+                        account_title='Sales'))
+                self.assertEqual(payments[provider.pk],
+                    aggregate_transactions_by_period(provider,
+                        Transaction.RECEIVABLE, periods,
+                        orig='dest', dest='dest',
+                        orig_account=Transaction.BACKLOG,
+                        orig_organization=provider))
+                self.assertEqual(refunds[provider.pk],
+                    aggregate_transactions_by_period(provider,
+                        Transaction.REFUND, periods,
+                        orig='dest', dest='dest'))
+        # The data set is not trivial.
+        self.assertNotEqual(changes[self.providers[0].pk][0][0]['values'],
+            [(period, 0) for period in date_periods[-1][1:]])
+
+    def _send_reports(self, jobs):
+        reports = []
+        def receiver(sender, provider, dates, data, **kwargs):
+            #pylint:disable=unused-argument
+            reports.append((provider, dates, data, os.getpid()))
+        signals.weekly_sales_report_created.connect(receiver)
+        try:
+            call_command('report_weekly_revenue', at_time=self.at_time,
+                jobs=jobs, stdout=io.StringIO())
+        finally:
+            signals.weekly_sales_report_created.disconnect(receiver)
+        return reports
+
+    def test_parallel_jobs(self):
+        expected = self._send_reports(jobs=1)
+        reports = self._send_reports(jobs=2)
+        self.assertEqual([report[0] for report in reports],
+            list(Organization.objects.filter(is_provider=True)))
+        self.assertEqual(reports, expected)
+        # Signals are sent from the command process.
+        self.assertEqual(set([report[3] for report in reports]),
+            set([os.getpid()]))
+
+
+class PeriodArithmeticTests(TestCase):
+    """
+    Randomized checks that the closed-form period arithmetic agrees
+    with walking through periods one at a time.
+    """
+    nb_samples = 500
+    intervals = (Plan.HOURLY, Plan.DAILY, Plan.WEEKLY,
+        Plan.MONTHLY, Plan.YEARLY)
+    horizons = {
+        Plan.HOURLY: datetime.timedelta(days=10),
+        Plan.DAILY: datetime.timedelta(days=400),
+        Plan.WEEKLY: datetime.timedelta(days=1000),
+        Plan.MONTHLY: datetime.timedelta(days=3000),
+        Plan.YEARLY: datetime.timedelta(days=10000),
+    }
+
+    def _random_datetime(self, rng):
+        # Month ends and leap days are where clamping kicks in,
+        # so they are drawn far more often than chance would.
+        year = rng.randint(1999, 2030)
+        month = rng.randint(1, 12)
+        last_day = calendar.monthrange(year, month)[1]
+        day = rng.choice([1, 15, 28, last_day, last_day,
+            rng.randint(1, last_day)])
+        if rng.random() < 0.1:
+            year, month, day = rng.choice([2000, 2004, 2016, 2020]), 2, 29
+        return datetime.datetime(year, month, day,
+            rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59),
+            rng.choice([0, rng.randint(0, 999999)]), tzinfo=utc)
+
+    def _random_after(self, rng, created_at, interval):
+        horizon = self.horizons[interval]
+        return created_at + datetime.timedelta(
+            seconds=rng.randint(0, int(horizon.total_seconds())))
+
+    def test_period_for(self):
+        rng = random.Random(46)
+        for _ in range(self.nb_samples):
+            interval = rng.choice(self.intervals)
+            created_at = self._random_datetime(rng)
+            subscription = Subscription(created_at=created_at,
+                plan=Plan(interval=interval))
+            at_time = self._random_after(rng, created_at, interval)
+            if rng.random() < 0.2:
+                # exactly on a period boundary
+                at_time = _reference_period_for(
+                    created_at, interval, at_time)[0]
+            self.assertEqual(subscription.period_for(at_time),
+                _reference_period_for(created_at, interval, at_time),
+                "created_at=%s, interval=%d, at_time=%s" % (
+                created_at, interval, at_time))
+
+    def test_nb_periods(self):
+        rng = random.Random(460)
+        for _ in range(self.nb_samples):
+            interval = rng.choice(self.intervals)
+            created_at = self._random_datetime(rng)
+            subscription = Subscription(created_at=created_at,
+                plan=Plan(interval=interval))
+            start = self._random_after(rng, created_at, interval)
+            until = self._random_after(rng, start, interval)
+            if until == start:
+                continue
+            self.assertAlmostEqual(subscription.nb_periods(start, until),
+                _reference_nb_periods(subscription, start, until),
+                msg="created_at=%s, interval=%d, [%s, %s[" % (
+                created_at, interval, start, until))
+
+    def test_recognition_windows(self):
+        rng = random.Random(47)
+        subscriptions = [Subscription(pk=idx,
+            created_at=self._random_datetime(rng),
+            plan=Plan(interval=rng.choice(self.intervals)))
+            for idx in range(50)]
+        until = datetime.datetime(2032, 3, 1, tzinfo=utc)
+        windows = recognition_windows(subscriptions, ends_at=until)
+        for subscription in subscriptions:
+            expected = []
+            idx = 0
+            created_at = subscription.created_at
+            while created_at + relativedelta(months=idx + 1) <= until:
+                starts_at = created_at + relativedelta(months=idx)
+                ends_at = created_at + relativedelta(months=idx + 1)
+                expected += [(starts_at, ends_at,
+                    subscription.nb_periods(starts_at, ends_at))]
+                idx += 1
+            self.assertEqual(windows[subscription.pk], expected)
+
+    def test_undefined_interval(self):
+        with self.assertRaises(ValueError):
+            PeriodCalculator(datetime.datetime(2018, 1, 31, tzinfo=utc), 0)
+
+
+class _QueriesLog(deque):
+    """
+    Records the call site in the saas application that issued each query.
+    """
+
+    def append(self, query):
+        query['call_site'] = _call_site()
+        super(_QueriesLog, self).append(query)
+
+
+def _call_site():
+    """
+    Returns the innermost frame in the saas application, followed
+    by the innermost frame in a third-party library (ex: a serializer
+    field) when the query was not issued directly by saas code.
+    """
+    call_site = "(outside saas)"
+    library_site = None
+    for filename, lineno, function, _ in reversed(
+            traceback.extract_stack()[:-2]):
+        if filename.startswith(SAAS_DIR):
+            call_site = "%s:%d in %s" % (
+                os.path.relpath(filename, SAAS_DIR), lineno, function)
+            break
+        if library_site is None and not filename.startswith(DJANGO_DIR):
+            library_site = "%s:%d in %s" % (
+                os.path.basename(filename), lineno, function)
+    if library_site:
+        call_site = "%s via %s" % (call_site, library_site)
+    return call_site
+
+
+def _api_endpoints(patterns, kwargs):
+    """
+    Returns ``(url_name, path, view_class)`` for each url pattern
+    in *patterns*, recursively.
+    """
+    endpoints = []
+    for pattern in patterns:
+        if isinstance(pattern, RegexURLResolver):
+            endpoints += _api_endpoints(pattern.url_patterns, kwargs)
+        elif pattern.name:
+            keys = sorted(pattern.regex.groupindex,
+                key=pattern.regex.groupindex.get)
+            path = None
+            while path is None:
+                try:
+                    path = reverse(pattern.name, kwargs={
+                        key: kwargs[key] for key in keys})
+                except NoReverseMatch:
+                    if not keys:
+                        raise
+                    # Optional trailing groups cannot be reversed.
+                    keys = keys[:-1]
+            endpoints += [(pattern.name, path,
+                getattr(pattern.callback, 'view_class', None))]
+    return endpoints
+
+
+def queries_report(results, nb_offenders=10):
+    """
+    Formats the worst offenders in *results*, with the SQL they executed
+    grouped by call site.
+    """
+    lines = []
+    for result in sorted(results,
+            key=lambda res: len(res['queries']), reverse=True)[:nb_offenders]:
+        lines += ["%s %s: %d queries (budget: %s)" % (result['url_name'],
+            result['path'], len(result['queries']), result['budget'])]
+        by_call_site = OrderedDict()
+        for query in result['queries']:
+            by_call_site.setdefault(query['call_site'], []).append(
+                query['sql'])
+        for call_site, statements in sorted(by_call_site.items(),
+                key=lambda item: len(item[1]), reverse=True):
+            lines += ["    %dx %s" % (len(statements), call_site)]
+            for sql in sorted(set(statements))[:3]:
+                lines += ["        %s" % sql[:200]]
+    return "\n".join(lines)
+
+
+# Requests for the views which do not respond to a GET, as
+# (method, data, format).
+API_REQUESTS = {
+    'saas_api_accessible_detail': ('delete', None, 'json'),
+    'saas_api_cancel_balance_due': ('delete', None, 'json'),
+    'saas_api_cart': ('post', {'plan': 'basic'}, 'json'),
+    'saas_api_cart_delete': ('delete', None, 'json'),
+    'saas_api_cart_upload': ('post', None, 'csv'),
+    'saas_api_charge_refund': ('post', {
+        'lines': [{'num': 0, 'refunded_amount': 100}]}, 'json'),
+    'saas_api_email_charge_receipt': ('post', None, 'json'),
+    'saas_api_import_transactions': ('post', {
+        'subscription': 'xia:premium', 'amount': '10.00',
+        'descr': "Paid by check"}, 'json'),
+    'saas_api_plans': ('post', {'title': "Budget", 'period_amount': 1000,
+        'interval': 'MONTHLY'}, 'json'),
+    'saas_api_redeem_coupon': ('post', {'code': 'HALLOWEEN'}, 'json'),
+    'saas_api_role_detail': ('delete', None, 'json'),
+    'saas_api_subscription_grant_accept': ('patch', None, 'json'),
+}
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Tests API views stay within the number of queries declared
+    by the ``query_budget`` attribute of their class.
+    """
+    fixtures = ['test_data']
+
+    def setUp(self):
+        # Objects the views look up through ``API_URL_KWARGS``.
+        ends_at = datetime_or_now() + relativedelta(years=1)
+        provider = Organization.objects.get(slug=API_URL_KWARGS['organization'])
+        plan = Plan.objects.get(slug=API_URL_KWARGS['plan'])
+        Subscription.objects.filter(
+            organization__slug=API_URL_KWARGS['subscriber'],
+            plan=plan).update(ends_at=ends_at)
+        Subscription.objects.create(organization=provider,
+            plan=Plan.objects.get(slug=API_URL_KWARGS['subscribed_plan']),
+            ends_at=ends_at)
+        Subscription.objects.create(
+            organization=Organization.objects.get(slug='stephanie'),
+            plan=plan, ends_at=ends_at,
+            request_key=API_URL_KWARGS['request_key'])
+        user = get_user_model().objects.get(username=API_URL_KWARGS['user'])
+        CartItem.objects.create(user=user, plan=plan)
+        invoiced = Transaction.objects.filter(
+            dest_account=Transaction.PAYABLE).first()
+        charge = Charge.objects.create_charge(invoiced.dest_organization,
+            [invoiced], invoiced.dest_amount, invoiced.dest_unit,
+            Organization.objects.get(slug='stripe'), API_URL_KWARGS['charge'],
+            {'last4': 4242, 'exp_date': datetime.date(2030, 1, 1),
+             'card_name': "Test"}, descr="Charge %s" % API_URL_KWARGS['charge'])
+        charge.payment_successful()
+
+    def _request(self, url_name, path):
+        method, data, fmt = API_REQUESTS.get(url_name, ('get', None, None))
+        if fmt == 'csv':
+            upload = io.StringIO(
+                "Joe,Smith,joe.smith@localhost.localdomain\n")
+            upload.name = 'upload.csv'
+            return self.client.post(path, {'file': upload})
+        if fmt == 'json':
+            return getattr(self.client, method)(path,
+                data=json.dumps(data or {}), content_type='application/json')
+        return getattr(self.client, method)(path)
+
+    def test_api_query_budgets(self):
+        from saas.urls.api import urlpatterns # avoid import loop
+        self.client.force_login(get_user_model().objects.get(
+            username=API_URL_KWARGS['user']))
+        results = []
+        failed = []
+        # The processor is not reachable from the tests.
+        with mock.patch.object(StripeBackend, 'retrieve_bank',
+                return_value={'bank_name': "Test", 'last4': '1234',
+                    'balance_amount': 0, 'balance_unit': 'usd'}), \
+            mock.patch.object(StripeBackend, 'retrieve_charge',
+                side_effect=lambda charge: charge), \
+            mock.patch.object(StripeBackend, 'reconcile_transfers'), \
+            mock.patch.object(StripeBackend, 'refund_charge'):
+            for url_name, path, view_class in _api_endpoints(
+                    urlpatterns, API_URL_KWARGS):
+                # Each request starts from the same records.
+                with transaction.atomic():
+                    queries_log = connection.queries_log
+                    connection.queries_log = _QueriesLog(
+                        maxlen=connection.queries_limit)
+                    connection.force_debug_cursor = True
+                    try:
+                        response = self._request(url_name, path)
+                    finally:
+                        queries = list(connection.queries_log)
+                        connection.queries_log = queries_log
+                        connection.force_debug_cursor = False
+                    transaction.set_rollback(True)
+                if not 200 <= response.status_code < 300:
+                    failed += ["%s %s: %d %s" % (url_name, path,
+                        response.status_code, response.content[:200])]
+                results += [{'url_name': url_name, 'path': path,
+                    'budget': getattr(view_class, 'query_budget', None),
+                    'queries': queries}]
+        if failed:
+            self.fail("API views did not respond with a 2xx status:\n%s" %
+                "\n".join(failed))
+        over_budget = [result for result in results
+            if result['budget'] is not None
+            and len(result['queries']) > result['budget']]
+        if over_budget:
+            self.fail("API views over query budget:\n%s" %
+                queries_report(over_budget))
+        missing = [result['url_name'] for result in results
+            if result['budget'] is None]
+        if missing:
+            self.fail("API views without a query budget: %s\n%s" % (
+                ', '.join(missing), queries_report(results)))
+
+
+class ProviderAPITests(TestCase):
+    """
+    Tests API views a provider uses to manage plans and subscribers.
+    """
+    fixtures = ['test_data']
+
+    def setUp(self):
+        self.ends_at = datetime_or_now() + relativedelta(years=1)
+        self.client.force_login(
+            get_user_model().objects.get(username='donny'))
+
+    def test_create_plan(self):
+        response = self.client.post(
+            reverse('saas_api_plans', args=('cowork',)),
+            data=json.dumps({'title': "Basic", 'period_amount': 1000,
+                'interval': 'MONTHLY'}), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        # A plan with slug 'basic' already exists.
+        plan = Plan.objects.get(slug='basic-0')
+        self.assertEqual(plan.organization.slug, 'cowork')
+        self.assertEqual(plan.title, "Basic")
+
+    def test_import_transactions(self):
+        Subscription.objects.filter(organization__slug='xia',
+            plan__slug='premium').update(ends_at=self.ends_at)
+        path = reverse('saas_api_import_transactions', args=('cowork',))
+        # ``descr`` and ``created_at`` are optional.
+        response = self.client.post(path, data=json.dumps({
+            'subscription': 'xia:premium', 'amount': '10.00'}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        created_at = datetime.datetime(2018, 6, 1, tzinfo=utc)
+        response = self.client.post(path, data=json.dumps({
+            'subscription': 'xia:premium', 'amount': '10.00',
+            'descr': "Paid by check",
+            'created_at': created_at.isoformat()}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Transaction.objects.filter(
+            created_at=created_at, dest_organization__slug='cowork').exists())
+
+    def test_accept_subscription_request(self):
+        request_key = '1' * 40
+        Subscription.objects.create(
+            organization=Organization.objects.get(slug='stephanie'),
+            plan=Plan.objects.get(slug='premium'), ends_at=self.ends_at,
+            request_key=request_key)
+        response = self.client.patch(
+            reverse('saas_api_subscription_grant_accept',
+                args=('cowork', request_key)),
+            data=json.dumps({}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        subscription = Subscription.objects.get(
+            organization__slug='stephanie', plan__slug='premium')
+        self.assertIsNone(subscription.request_key)
+
+
+class SearchTests(TestCase):
+    """
+    Tests search backends match the same organizations.
+    """
+    fixtures = ['test_data']
+    expected = {'xia': 2, 'cow': 3, 'san': 7}
+
+    def tearDown(self):
+        search._SEARCH_BACKEND = None #pylint:disable=protected-access
+
+    def _counts(self):
+        counts = {}
+        for query in self.expected:
+            response = self.client.get('/api/profile/', {'q': query})
+            self.assertEqual(response.status_code, 200)
+            counts.update({query: response.data['count']})
+        return counts
+
+    def test_backends(self):
+        self.client.force_login(get_user_model().objects.get(
+            username=API_URL_KWARGS['user']))
+        #pylint:disable=protected-access
+        search._SEARCH_BACKEND = search.IcontainsSearchBackend()
+        self.assertEqual(self._counts(), self.expected)
+        # Fixtures are loaded without calling ``save()``.
+        search._SEARCH_BACKEND = search.SearchDocumentBackend()
+        self.assertFalse(Organization.objects.exclude(
+            search_document="").exists())
+        self.assertEqual(self._counts(), self.expected)
+        for organization in Organization.objects.all():
+            organization.save(update_fields=['search_document'])
+        self.assertFalse(Organization.objects.filter(
+            search_document="").exists())
+        self.assertEqual(self._counts(), self.expected)
+
+
+class InstrumentationTests(TestCase):
+    """
+    Tests timing events are emitted to the configured sink.
+    """
+
+    def tearDown(self):
+        set_sink(None)
+
+    def test_timed_events(self):
+        sink = MemorySink()
+        set_sink(sink)
+        with timed('test.block', organization='cowork'):
+            pass
+
+        @instrumented('test.func')
+        def failing():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            failing()
+        self.assertEqual([event['event'] for event in sink.events],
+            ['test.block', 'test.func'])
+        self.assertEqual(sink.events[0]['organization'], 'cowork')
+        self.assertIsNone(sink.events[0]['error'])
+        self.assertEqual(sink.events[1]['error'], 'ValueError')
+
+    def test_disabled(self):
+        sink = MemorySink()
+        set_sink(sink)
+
+        @instrumented('test.func')
+        def func():
+            return 1
+
+        self.assertEqual(func(), 1)
+        self.assertEqual(len(sink.events), 1)
+        sink.clear()
+        set_sink(None)
+        self.assertEqual(func(), 1)
+        with timed('test.block'):
+            pass
+        self.assertEqual(sink.events, [])
+
+
+class TelemetryTests(TestCase):
+    """
+    Tests processor calls in flight are counted until they return or expire.
+    """
+
+    def setUp(self):
+        reset_telemetry()
+
+    def tearDown(self):
+        reset_telemetry()
+
+    def test_in_flight_expires(self):
+        now = time.time()
+        # A call from a worker which died before the call returned.
+        record_call_started('retrieve_card', now - 2 * IN_FLIGHT_TIMEOUT)
+        record_call_started('retrieve_card', now)
+        self.assertEqual(get_telemetry()['retrieve_card']['in_flight'], 1)
+        record_call_ended('retrieve_card', now)
+        counters = get_telemetry()['retrieve_card']
+        self.assertEqual(counters['in_flight'], 0)
+        self.assertEqual(counters['calls'], 1)
+
+
+class CartCacheTests(TestCase):
+    """
+    Tests cached invoicables are recomputed when prices change.
+    """
+    fixtures = ['test_data']
+
+    def _option_amounts(self, request, customer):
+        return [[option.dest_amount for option in invoicable['options']]
+            for invoicable in CartMixin().as_cached_invoicables(
+                request, customer)]
+
+    def test_price_changes(self):
+        request = HttpRequest()
+        request.user = get_user_model().objects.get(username='xia')
+        request.session = SessionStore()
+        request.session.create()
+        customer = Organization.objects.get(slug='xia')
+        coupon = Coupon.objects.get(code='HALLOWEEN')
+        CartItem.objects.create(user=request.user,
+            plan=Plan.objects.get(slug='medium'), coupon=coupon)
+        amounts = self._option_amounts(request, customer)
+        self.assertEqual(self._option_amounts(request, customer), amounts)
+        coupon.percent = 10
+        coupon.save()
+        discounted = self._option_amounts(request, customer)
+        self.assertNotEqual(discounted, amounts)
+        Plan.objects.filter(slug='medium').update(period_amount=10000)
+        self.assertNotEqual(
+            self._option_amounts(request, customer), discounted)
+
+
+class CartUploadTests(TestCase):
+    """
+    Tests uploading a file of cart items into a cart which already
+    has items.
+    """
+    fixtures = ['test_data']
+
+    def test_new_duplicate_and_malformed(self):
+        user = get_user_model().objects.get(username='donny')
+        plan = Plan.objects.get(slug='premium')
+        CartItem.objects.create(user=user, plan=plan, first_name="Alice",
+            last_name="Member", sync_on='alice@localhost.localdomain')
+        self.client.force_login(user)
+        upload = io.StringIO(
+            "Alice,Again,alice@localhost.localdomain\n"
+            "Bob,Member,bob@localhost.localdomain\n"
+            "Malformed,row\n"
+            "Bob,Again,bob@localhost.localdomain\n")
+        upload.name = 'upload.csv'
+        resp = self.client.post(reverse('saas_api_cart_upload',
+            kwargs={'plan': plan.slug}), {'file': upload})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([item['sync_on'] for item in resp.data['created']],
+            ['bob@localhost.localdomain'])
+        self.assertEqual([item['sync_on'] for item in resp.data['updated']],
+            ['alice@localhost.localdomain', 'bob@localhost.localdomain'])
+        self.assertEqual([item['data'] for item in resp.data['failed']],
+            [{'raw': ['Malformed', 'row']}])
+        self.assertEqual(sorted(CartItem.objects.get_cart(
+            user, plan=plan).values_list('first_name', 'sync_on')),
+            [("Alice", 'alice@localhost.localdomain'),
+             ("Bob", 'bob@localhost.localdomain')])
+
+
+class BulkInsertTests(TestCase):
+    """
+    Tests records inserted in bulk by ``execute_order`` are the same
+    as if they had been saved one by one.
+    """
+    fixtures = ['test_data']
+
+    def test_execute_order(self):
+        user = get_user_model().objects.get(username='stephanie')
+        customer = Organization.objects.get(slug='stephanie')
+        CartItem.objects.create(user=user,
+            plan=Plan.objects.get(slug='medium'), option=1)
+        CartItem.objects.create(user=user,
+            plan=Plan.objects.get(slug='basic'), option=1,
+            sync_on='new.member@localhost.localdomain',
+            first_name='New', last_name='Member')
+        invoicables = CartMixin().as_invoicables(user, customer)
+        for invoicable in invoicables:
+            invoicable['lines'] += invoicable['options'][:1]
+        # SQLite returns the id of a row inserted one at a time.
+        with mock.patch.object(connection.features,
+                'can_return_ids_from_bulk_insert', True):
+            with mock.patch.object(connection.ops, 'bulk_batch_size',
+                    return_value=1):
+                with mock.patch.object(saas_settings, 'SUBSCRIBER_FLAGS',
+                        True):
+                    customer.execute_order(invoicables, user)
+        coupon = Coupon.objects.get(code__startswith='cpn_')
+        # ``created_at`` is ``auto_now_add`` so it is set again on insert.
+        self.assertTrue(abs(coupon.ends_at - coupon.created_at
+            - datetime.timedelta(days=30)) < datetime.timedelta(seconds=1))
+        self.assertEqual(set(SubscriberFlag.objects.filter(
+            user__role__organization=customer).values_list(
+            'user', flat=True)), set(get_role_model().objects.filter(
+            organization=customer).values_list('user', flat=True)))
+        accounts = set([])
+        for orig_account, dest_account in Transaction.objects.filter(
+                dest_organization=customer).values_list(
+                'orig_account', 'dest_account'):
+            accounts |= set([orig_account, dest_account])
+        self.assertTrue(accounts)
+        self.assertEqual(set(LedgerAccount.objects.filter(
+            name__in=accounts).values_list('name', flat=True)), accounts)
+
+    def test_event_references(self):
+        subscription = Subscription.objects.get(pk=4)
+        references = {}
+        for event_id in ('sub_4/', 'sub_4/9999/', 'cha_9999/'):
+            references[event_id] = Transaction.objects.get(pk=1)
+            references[event_id].pk = None
+            references[event_id].event_id = event_id
+        # Events which do not exist anymore are left NULL.
+        Transaction.objects.update_event_references([
+            references['sub_4/9999/'], references['cha_9999/']])
+        self.assertEqual(references['sub_4/9999/'].subscription_id, 4)
+        self.assertIsNone(references['sub_4/9999/'].use_charge_id)
+        self.assertIsNone(references['cha_9999/'].charge_id)
+        Transaction.objects.bulk_create([
+            references['sub_4/9999/'], references['cha_9999/']])
+        # Ledger entries saved one at a time refer to events the caller
+        # holds. They are not looked up again.
+        with CaptureQueriesContext(connection) as queries:
+            references['sub_4/'].save()
+        self.assertFalse([query for query in queries
+            if 'saas_subscription' in query['sql']])
+        self.assertEqual(references['sub_4/'].subscription_id, 4)
+        # A use charge of the subscription is not an order
+        # for the subscription itself.
+        self.assertEqual(list(Transaction.objects.by_subsciptions(
+            [subscription])), [references['sub_4/']])
+
+    def test_resolve_events(self):
+        event_ids = ('sub_4/', 'sub_2/9999/', 'HALLOWEEN', 'DIS100',
+            'cha_9999/', None)
+        invoiced_items = []
+        for event_id in event_ids:
+            invoiced_item = Transaction.objects.get(pk=1)
+            invoiced_item.event_id = event_id
+            invoiced_items += [invoiced_item]
+        expected = [Transaction(event_id=event_id).get_event()
+            for event_id in event_ids]
+        self.assertEqual([type(event) for event in expected], [Subscription,
+            Subscription, Coupon, Coupon, type(None), type(None)])
+        invoiced_items = Transaction.objects.resolve_events(invoiced_items)
+        with self.assertNumQueries(0):
+            events = [invoiced_item.get_event()
+                for invoiced_item in invoiced_items]
+            # Attached events are fetched with what is needed to print
+            # an invoice line.
+            for event in events[:2]:
+                self.assertIsNotNone(event.plan.organization.slug)
+                self.assertIsNotNone(event.organization.slug)
+            for event in events[2:4]:
+                self.assertIsNotNone(event.organization.slug)
+        self.assertEqual(events, expected)
+
+
+class RegisteredUsersTests(TestCase):
+    """
+    Tests registered users are the same whether they are listed through
+    ``SubscriberFlag`` or through ``Role`` and ``Subscription``.
+    """
+    fixtures = ['test_data']
+
+    def _registered(self, ends_at, subscriber_flags):
+        view = RegisteredQuerysetMixin()
+        view.ends_at = ends_at
+        with mock.patch.object(saas_settings, 'SUBSCRIBER_FLAGS',
+                subscriber_flags):
+            return set(view.get_queryset().values_list('pk', flat=True))
+
+    def test_flags_match_subscriptions(self):
+        SubscriberFlag.objects.refresh(
+            get_user_model().objects.values_list('pk', flat=True))
+        self.assertTrue(SubscriberFlag.objects.exists())
+        first_created_at = Subscription.objects.order_by(
+            'created_at').first().created_at
+        for ends_at in (first_created_at,
+                first_created_at + datetime.timedelta(seconds=1),
+                datetime_or_now()):
+            self.assertEqual(self._registered(ends_at, True),
+                self._registered(ends_at, False))
+
+
+class WebhookEventTests(TestCase):
+    """
+    Tests webhook events are deduplicated and processed in order.
+    """
+
+    def test_deduplicate_and_order(self):
+        _, created = WebhookEvent.objects.record(
+            'evt_1', 'charge.succeeded', '{}', object_key='ch_1')
+        self.assertTrue(created)
+        _, created = WebhookEvent.objects.record(
+            'evt_1', 'charge.succeeded', '{}', object_key='ch_1')
+        self.assertFalse(created)
+        WebhookEvent.objects.record(
+            'evt_2', 'charge.refunded', '{}', object_key='ch_1')
+        WebhookEvent.objects.record(
+            'evt_3', 'charge.succeeded', '{}', object_key='ch_2')
+
+        at_time = datetime_or_now()
+        processed = []
+        def handler(event):
+            if event.event_id == 'evt_1':
+                raise ValueError()
+            processed.append(event.event_id)
+
+        WebhookEvent.objects.process_pending(handler, at_time=at_time)
+        # evt_2 must wait until evt_1 for the same charge succeeds.
+        self.assertEqual(processed, ['evt_3'])
+        self.assertEqual(WebhookEvent.objects.get(
+            event_id='evt_1').nb_attempts, 1)
+
+    def test_blocked_and_claimed(self):
+        for idx in range(5):
+            WebhookEvent.objects.record('evt_blocked%d' % idx,
+                'charge.refunded', '{}', object_key='ch_blocked')
+        WebhookEvent.objects.record(
+            'evt_claimed1', 'charge.succeeded', '{}', object_key='ch_claimed')
+        WebhookEvent.objects.record(
+            'evt_claimed2', 'charge.refunded', '{}', object_key='ch_claimed')
+        WebhookEvent.objects.record('evt_free', 'charge.succeeded', '{}')
+        at_time = datetime_or_now()
+        WebhookEvent.objects.filter(event_id='evt_blocked0').update(
+            nb_attempts=1, next_attempt_at=at_time + datetime.timedelta(
+            seconds=60))
+
+        processed = []
+        def handler(event):
+            processed.append(event.event_id)
+            if event.event_id == 'evt_claimed1':
+                # A concurrent worker must not pick up any event
+                # for the same charge in the meantime.
+                WebhookEvent.objects.process_pending(
+                    handler, at_time=at_time, batch_size=3)
+
+        # Events waiting on a retry do not take up room in the batch.
+        WebhookEvent.objects.process_pending(
+            handler, at_time=at_time, batch_size=3)
+        self.assertEqual(processed,
+            ['evt_claimed1', 'evt_free', 'evt_claimed2'])
+
+
+class ExpirationNoticeTests(TestCase):
+    """
+    Tests expiration notices are recorded once and sent out of
+    the renewals job.
+    """
+    fixtures = ['test_data']
+
+    def test_record_then_send(self):
+        subscription = Subscription.objects.valid_for().select_related(
+            'plan').first()
+        Plan.objects.filter(pk=subscription.plan_id).update(
+            renewal_type=Plan.REPEAT)
+        Subscription.objects.filter(pk=subscription.pk).update(
+            auto_renew=False)
+        at_time = subscription.ends_at - datetime.timedelta(days=15, hours=1)
+        sent = []
+        def receiver(sender, subscription, nb_days, **kwargs):
+            #pylint:disable=unused-argument
+            sent.append((subscription.pk, nb_days))
+        signals.expires_soon.connect(receiver)
+        try:
+            for _ in range(2):
+                trigger_expiration_notices(at_time, nb_days=[7, 15])
+            self.assertEqual(sent, [])
+            send_expiration_notices(at_time)
+        finally:
+            signals.expires_soon.disconnect(receiver)
+        self.assertEqual(sent, [(subscription.pk, 15)])
+        self.assertEqual(send_expiration_notices(at_time), 0)
+
+    def test_card_updated_on_processor(self):
+        subscription = Subscription.objects.valid_for().select_related(
+            'plan', 'organization').first()
+        Plan.objects.filter(pk=subscription.plan_id).update(
+            renewal_type=Plan.AUTO_RENEW)
+        Subscription.objects.filter(pk=subscription.pk).update(
+            auto_renew=True)
+        at_time = subscription.ends_at - datetime.timedelta(days=15, hours=1)
+        # The locally recorded date says the card expires before renewal.
+        Organization.objects.filter(pk=subscription.organization_id).update(
+            processor_card_key='cus_test',
+            card_exp_date=subscription.ends_at.date().replace(day=1))
+        with mock.patch.object(Organization, 'retrieve_card',
+                return_value={'exp_date': '01/2099'}) as retrieve_card:
+            trigger_expiration_notices(at_time, nb_days=[15])
+        self.assertEqual(retrieve_card.call_count, 1)
+        self.assertFalse(ExpirationNotice.objects.filter(
+            kind=ExpirationNotice.CARD_EXPIRES_SOON).exists())
+
+
+class ReconcileWithProcessorTests(TransactionTestCase):
+    """
+    Tests reconciling providers concurrently.
+    """
+    fixtures = ['test_data']
+
+    def test_workers(self):
+        reconciled_at = datetime.datetime(2018, 12, 31, tzinfo=utc)
+        providers = list(Organization.objects.filter(
+            is_provider=True).order_by('pk'))
+        self.assertTrue(len(providers) > 2)
+        failing = providers[0]
+
+        class Backend(object):
+            #pylint:disable=no-self-use,unused-argument
+            def __init__(self, provider):
+                self.provider = provider
+
+            def reconcile_transfers(self, provider, created_at,
+                                    dry_run=False):
+                if provider == failing:
+                    raise RuntimeError("cannot reconcile %s" % provider)
+                return reconciled_at
+
+        stderr = io.StringIO()
+        command = ReconcileWithProcessorCommand(stdout=io.StringIO(),
+            stderr=stderr)
+        with mock.patch('saas.management.commands.reconcile_with_processor'\
+                '.get_processor_backend', Backend):
+            command.run_reconcile(workers=2)
+        self.assertIn("cannot reconcile %s" % failing, stderr.getvalue())
+        for provider in providers:
+            provider.refresh_from_db()
+            self.assertEqual(provider.processor_reconciled_at,
+                None if provider == failing else reconciled_at)
+
+
+class StripeListPagesTests(TestCase):
+    """
+    Tests following the Stripe ``starting_after`` cursor.
+    """
+    def setUp(self):
+        self.objects = [mock.Mock(id="obj_%d" % idx) for idx in range(5)]
+        self.requests = []
+
+    def list_func(self, limit=None, starting_after=None, **kwargs):
+        self.requests += [dict(kwargs, starting_after=starting_after)]
+        start = 0
+        if starting_after:
+            start = [obj.id for obj in self.objects].index(starting_after) + 1
+        # Stubbed pages are two objects long regardless of *limit*.
+        data = self.objects[start:start + 2]
+        return mock.Mock(data=data,
+            has_more=(start + len(data) < len(self.objects)))
+
+    def test_list_pages(self):
+        pages = list(StripeBackend._list_pages(self.list_func, status='paid'))
+        self.assertEqual([[obj.id for obj in page] for page in pages],
+            [['obj_0', 'obj_1'], ['obj_2', 'obj_3'], ['obj_4']])
+        self.assertEqual(self.requests, [
+            {'status': 'paid', 'starting_after': None},
+            {'status': 'paid', 'starting_after': 'obj_1'},
+            {'status': 'paid', 'starting_after': 'obj_3'}])
+
+    def test_starting_after(self):
+        pages = list(StripeBackend._list_pages(
+            self.list_func, starting_after='obj_2'))
+        self.assertEqual([[obj.id for obj in page] for page in pages],
+            [['obj_3', 'obj_4']])
+        self.assertEqual(self.requests, [{'starting_after': 'obj_2'}])
+
+    def test_prefetch(self):
+        pages = StripeBackend._list_pages(self.list_func, prefetch=True)
+        self.assertEqual([obj.id for obj in next(pages)], ['obj_0', 'obj_1'])
+        # The next page was requested before the first one was handed out.
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual([[obj.id for obj in page] for page in pages],
+            [['obj_2', 'obj_3'], ['obj_4']])
+        self.assertEqual(len(self.requests), 3)
+
+
+class SignalOutboxTests(TransactionTestCase):
+    """
+    Tests signals are recorded on commit and delivered in order
+    for each organization.
+    """
+    fixtures = ['test_data']
+
+    def test_deliver_on_commit(self):
+        first, second = Subscription.objects.order_by('pk')[:2]
+        delivered = []
+        def receiver(sender, subscription, reason, invite, **kwargs):
+            #pylint:disable=unused-argument
+            if not delivered:
+                delivered.append(None)
+                raise ValueError()
+            delivered.append((sender, subscription, reason))
+        prev_outbox = saas_settings.SIGNALS_OUTBOX
+        saas_settings.SIGNALS_OUTBOX = True
+        signals.subscription_grant_created.connect(receiver)
+        try:
+            with transaction.atomic():
+                for subscription in (first, second, first):
+                    signals.subscription_grant_created.send(sender=__name__,
+                        subscription=subscription, reason="hello",
+                        invite=True, request=HttpRequest())
+                self.assertEqual(SignalEvent.objects.count(), 0)
+            self.assertEqual(delivered, [])
+            self.assertEqual(SignalEvent.objects.count(), 3)
+
+            at_time = datetime_or_now()
+            SignalEvent.objects.process_pending(
+                deliver_signal_event, at_time=at_time)
+            # The third signal waits until the first one for the same
+            # organization is delivered.
+            self.assertEqual(delivered[1:], [(__name__, second, "hello")])
+            SignalEvent.objects.process_pending(deliver_signal_event,
+                at_time=at_time + datetime.timedelta(minutes=1))
+            self.assertEqual(delivered[2:], [
+                (__name__, first, "hello"), (__name__, first, "hello")])
+        finally:
+            signals.subscription_grant_created.disconnect(receiver)
+            saas_settings.SIGNALS_OUTBOX = prev_outbox
+
+    def test_snapshot_and_deleted(self):
+        subscription = Subscription.objects.order_by('pk').first()
+        subscription.description = "sent"
+        subscription.save()
+        delivered = []
+        def receiver(sender, subscription, **kwargs):
+            #pylint:disable=unused-argument
+            delivered.append(subscription.description)
+            subscription.refresh_from_db()
+        prev_outbox = saas_settings.SIGNALS_OUTBOX
+        saas_settings.SIGNALS_OUTBOX = True
+        signals.subscription_grant_created.connect(receiver)
+        try:
+            signals.subscription_grant_created.send(sender=__name__,
+                subscription=subscription, reason="hello", invite=True)
+            Subscription.objects.filter(pk=subscription.pk).update(
+                description="delivered")
+            self.assertEqual(SignalEvent.objects.process_pending(
+                deliver_signal_event), 1)
+            self.assertEqual(delivered, ["sent"])
+            self.assertEqual(SignalEvent.objects.get().state,
+                SignalEvent.DONE)
+
+            signals.subscription_grant_created.send(sender=__name__,
+                subscription=subscription, reason="hello", invite=True)
+            Subscription.objects.filter(pk=subscription.pk).delete()
+            SignalEvent.objects.process_pending(deliver_signal_event)
+            # The subscription will not come back. No point retrying.
+            signal_event = SignalEvent.objects.order_by('pk').last()
+            self.assertEqual(signal_event.state, SignalEvent.FAILED)
+            self.assertEqual(signal_event.nb_attempts, 1)
+        finally:
+            signals.subscription_grant_created.disconnect(receiver)
+            saas_settings.SIGNALS_OUTBOX = prev_outbox
+
+
+class ChargeIdempotencyTests(TestCase):
+    """
+    Tests charging the same invoiced items twice does not contact
+    the processor again.
+    """
+    fixtures = ['test_data']
+
+    def setUp(self):
+        caches[saas_settings.PROCESSOR_CACHE].clear()
+        self.keys = []
+        self.declines = []
+
+    def _create_charge(self, backend, amount, unit, **kwargs):
+        #pylint:disable=unused-argument
+        self.keys.append(kwargs.get('idempotency_key'))
+        if self.declines:
+            raise CardError("declined", 'card_declined',
+                charge_processor_key=self.declines.pop(0))
+        return ('ch_test%d' % len(self.keys), kwargs.get('created_at'), {
+            'last4': '4242', 'exp_date': datetime.date(2030, 1, 1),
+            'card_name': 'Test'})
+
+    def _get_invoiced(self):
+        invoiced = list(Transaction.objects.filter(
+            orig_account=Transaction.PAYABLE,
+            event_id__startswith='sub_').order_by('pk')[:1])
+        customer = invoiced[0].dest_organization
+        customer.processor_card_key = 'cus_test'
+        return customer, invoiced
+
+    def test_charge_card_once(self):
+        customer, invoiced = self._get_invoiced()
+        with mock.patch.object(StripeBackend, '_create_charge',
+                autospec=True, side_effect=self._create_charge):
+            charge = Charge.objects.charge_card(customer, invoiced)
+            self.assertEqual(
+                Charge.objects.charge_card(customer, invoiced), charge)
+            self.assertEqual(len(self.keys), 1)
+            # A failed charge can be retried.
+            charge.state = Charge.FAILED
+            charge.save()
+            self.assertNotEqual(
+                Charge.objects.charge_card(customer, invoiced), charge)
+            self.assertEqual(len(self.keys), 2)
+            self.assertNotEqual(self.keys[0], self.keys[1])
+
+    def test_retry_declined(self):
+        customer, invoiced = self._get_invoiced()
+        self.declines = ['ch_declined1']
+        with mock.patch.object(StripeBackend, '_create_charge',
+                autospec=True, side_effect=self._create_charge):
+            with self.assertRaises(CardError):
+                Charge.objects.charge_card(customer, invoiced)
+            # The retry is not a replay of the declined charge.
+            charge = Charge.objects.charge_card(customer, invoiced)
+            self.assertEqual(charge.processor_key, 'ch_test2')
+            self.assertEqual(len(self.keys), 2)
+            self.assertNotEqual(self.keys[0], self.keys[1])
+            # Once successful, the charge is not created twice.
+            self.assertEqual(
+                Charge.objects.charge_card(customer, invoiced), charge)
+            self.assertEqual(len(self.keys), 2)
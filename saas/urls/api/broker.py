@@ -29,6 +29,7 @@ URLs API for resources available typically only to the broker platform.
 from django.conf.urls import url
 
 from ... import settings
+from ...api.backend import ProcessorTelemetryAPIView
 from ...api.balances import (BalanceLineListAPIView, BrokerBalancesAPIView,
     BalanceLineDetailAPIView)
 from ...api.charges import ChargeListAPIView
@@ -52,6 +53,9 @@ urlpatterns = [
         name='saas_api_balance_line'),
     url(r'^metrics/balances/(?P<report>%s)/lines/?' % settings.ACCT_REGEX,
         BalanceLineListAPIView.as_view(), name='saas_api_balance_lines'),
+    url(r'^metrics/processor/?',
+        ProcessorTelemetryAPIView.as_view(),
+        name='saas_api_processor_telemetry'),
     url(r'^metrics/registered/?',
         RegisteredAPIView.as_view(), name='saas_api_registered'),
     url(r'^users/$',
@@ -25,7 +25,8 @@
 import datetime, inspect, random, sys
 
 from django.conf import settings as django_settings
-from django.db import transaction, IntegrityError
+from django.db import connections, router, transaction, IntegrityError
+from django.db.models import Case, Value, When
 from django.http.request import split_domain_port, validate_host
 from django.template.defaultfilters import slugify
 from django.utils import six
@@ -81,6 +82,47 @@ def parse_tz(tzone):
     return None
 
 
+def bulk_update(model, objs, fields, batch_size=100):
+    """
+    Updates *fields* of already saved *objs* with one ``UPDATE`` statement
+    per *batch_size* objects.
+
+    Django 1.11 has no ``QuerySet.bulk_update`` and, as with ``update``,
+    neither ``save`` nor the ``pre_save``/``post_save`` signals are called.
+    """
+    #pylint:disable=protected-access
+    objs = [obj for obj in objs if obj.pk is not None]
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+        updates = {}
+        for field_name in fields:
+            field = model._meta.get_field(field_name)
+            updates.update({field.attname: Case(*[
+                When(pk=obj.pk, then=Value(
+                    getattr(obj, field.attname), output_field=field))
+                for obj in batch], output_field=field)})
+        model.objects.filter(pk__in=[obj.pk for obj in batch]).update(
+            **updates)
+
+
+def as_card_exp_date(exp_date):
+    """
+    Returns the first day of the month a card expires as a ``date``
+    from an expiration date as returned by the processor backends
+    (i.e. "MM/YYYY", a ``date`` or a ``datetime``), or ``None``.
+    """
+    if isinstance(exp_date, datetime.datetime):
+        exp_date = exp_date.date()
+    if isinstance(exp_date, datetime.date):
+        return exp_date.replace(day=1)
+    try:
+        exp_month, exp_year = exp_date.split('/')
+        return datetime.date(int(exp_year), int(exp_month), 1)
+    except (AttributeError, ValueError):
+        # exp info is missing or the format is incorrect
+        return None
+
+
 def convert_dates_to_utc(dates):
     return [date.astimezone(utc) for date in dates]
 
@@ -174,6 +216,29 @@ def get_role_model():
     return get_model_class(settings.ROLE_RELATION, 'ROLE_RELATION')
 
 
+def insert_many(model, objs):
+    """
+    Inserts new *objs* into the database such that each has a primary key
+    afterwards.
+
+    When the database returns the ids of bulk-inserted rows
+    (ex: PostgreSQL), this is a single ``bulk_create`` and the function
+    returns True to let the caller take over what ``save`` and
+    ``post_save`` receivers would otherwise have done. Else each object
+    is saved in turn and the function returns False.
+    """
+    objs = list(objs)
+    if not objs:
+        return False
+    features = connections[router.db_for_write(model)].features
+    if features.can_return_ids_from_bulk_insert:
+        model.objects.bulk_create(objs)
+        return True
+    for obj in objs:
+        obj.save()
+    return False
+
+
 def normalize_role_name(role_name):
     if role_name.endswith('s'):
         role_name = role_name[:-1]
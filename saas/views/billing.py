@@ -603,8 +603,10 @@ class CartBaseView(InvoicablesFormMixin, CartMixin, FormView):
         return context
 
     def get_queryset(self):
-        return super(CartBaseView, self).as_invoicables(
-            self.request.user, self.organization)
+        if self.request.method.lower() == 'post':
+            # Orders are placed at current prices, never from the cache.
+            return self.as_invoicables(self.request.user, self.organization)
+        return self.as_cached_invoicables(self.request, self.organization)
 
     def get_success_url(self):
         redirect_path = validate_redirect_url(
@@ -898,6 +900,8 @@ djaodjin-saas/tree/master/saas/templates/saas/billing/receipt.html>`__).
 
     def get_context_data(self, **kwargs):
         context = super(ChargeReceiptView, self).get_context_data(**kwargs)
+        Transaction.objects.resolve_events(
+            [line.invoiced for line in context['charge_items']])
         for rank, line in enumerate(context['charge_items']):
             event = line.invoiced.get_event()
             setattr(line, 'rank', rank)
@@ -0,0 +1,99 @@
+# Copyright (c) 2018, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Benchmarks for the ledger, metrics and renewals hot paths.
+
+Each workload is run against the database configured in the settings
+and measured for wall time, number of SQL queries and peak memory.
+The results are returned as a dictionary that can be serialized to JSON
+such that runs can be compared over time.
+"""
+
+import gc, logging, time
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+try:
+    import tracemalloc
+except ImportError: # Python < 3.4
+    tracemalloc = None
+    import resource
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def measure(func, repeat=1):
+    """
+    Runs *func* *repeat* times and returns the best wall time (in seconds),
+    the number of SQL queries and the peak memory (in bytes) of a run.
+    """
+    best_time = None
+    nb_queries = 0
+    peak_memory = 0
+    for _ in range(repeat):
+        gc.collect()
+        if tracemalloc:
+            tracemalloc.start()
+        else:
+            # ``ru_maxrss`` is a high-water mark for the whole process
+            # so it will only ever increase.
+            peak_memory = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss * 1024
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+        if tracemalloc:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+        nb_queries = len(queries)
+    return {
+        'wall_time': best_time,
+        'queries': nb_queries,
+        'peak_memory': peak_memory
+    }
+
+
+def run_benchmarks(workloads, repeat=1, only=None):
+    """
+    Measures each ``(name, func)`` in *workloads*, optionally restricted
+    to names starting with one of the prefixes in *only*.
+    """
+    results = {}
+    for name, func in workloads:
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        LOGGER.info("benchmark %s ...", name)
+        try:
+            results[name] = measure(func, repeat=repeat)
+        except Exception as err: #pylint:disable=broad-except
+            LOGGER.exception("benchmark %s", name)
+            results[name] = {'error': str(err)}
+    return results
@@ -0,0 +1,96 @@
+# Copyright (c) 2018, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Deterministic synthetic datasets for benchmarks.
+"""
+
+import datetime, logging
+
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models import Max, Min
+
+from saas.models import Subscription, Transaction
+
+
+LOGGER = logging.getLogger(__name__)
+
+SCALES = {
+    'small': 10000,
+    'medium': 1000000,
+    'large': 10000000,
+}
+
+BATCH_SIZE = 10000
+
+# Fields copied over when the generated ledger is replicated.
+TRANSACTION_FIELDS = ('created_at', 'descr', 'event_id',
+    'subscription_id', 'use_charge_id', 'charge_id',
+    'dest_amount', 'dest_unit', 'dest_account', 'dest_organization_id',
+    'orig_amount', 'orig_unit', 'orig_account', 'orig_organization_id')
+
+
+def populate(provider, nb_transactions, seed=0, at_time=None):
+    """
+    Loads the database with at least *nb_transactions* ``Transaction``.
+
+    A base set of subscriptions, orders and charges is generated through
+    ``load_test_transactions`` with a fixed *seed* and *at_time*,
+    then the whole ledger is replicated back in time, one copy
+    per span of the ledger, until the database contains
+    *nb_transactions* records.
+    """
+    if not Subscription.objects.filter(plan__organization=provider,
+            organization__slug__startswith='demo').exists():
+        LOGGER.info("generate base dataset for %s (seed=%d)", provider, seed)
+        kwargs = {'provider': str(provider), 'seed': seed}
+        if at_time:
+            kwargs.update({'at_time': at_time.isoformat()})
+        call_command('load_test_transactions', **kwargs)
+
+    nb_missing = nb_transactions - Transaction.objects.count()
+    if nb_missing <= 0:
+        return
+    bounds = Transaction.objects.aggregate(
+        first=Min('created_at'), last=Max('created_at'))
+    span = (bounds['last'] - bounds['first']) + datetime.timedelta(days=1)
+    last_pk = Transaction.objects.aggregate(last_pk=Max('pk'))['last_pk']
+    LOGGER.info("replicate ledger into %d more transactions", nb_missing)
+    shift = 1
+    batch = []
+    while nb_missing > 0:
+        for template in Transaction.objects.filter(pk__lte=last_pk).order_by(
+                'pk').values(*TRANSACTION_FIELDS).iterator():
+            template['created_at'] -= shift * span
+            batch += [Transaction(**template)]
+            nb_missing -= 1
+            if len(batch) >= BATCH_SIZE or nb_missing <= 0:
+                with transaction.atomic():
+                    Transaction.objects.bulk_create(batch)
+                batch = []
+            if nb_missing <= 0:
+                break
+        shift += 1
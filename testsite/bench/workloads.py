@@ -0,0 +1,138 @@
+# Copyright (c) 2018, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Workloads measured by the benchmarks.
+"""
+
+from importlib import import_module
+
+from django.conf import settings
+from django.test.client import RequestFactory
+from django.utils.http import urlencode
+
+try:
+    from django.urls import resolve
+except ImportError: # django < 1.10
+    from django.core.urlresolvers import resolve
+
+from saas import decorators
+from saas.compat import reverse
+from saas.models import BalanceLine, Coupon, Subscription, Transaction
+from saas.renewals import create_charges_for_balance, recognize_income
+
+
+def _call_view(request_factory, user, path, query=None):
+    """
+    Resolves *path* through the site urls, such that permission decorators
+    are part of the measure, calls the view and renders the response.
+    """
+    if query:
+        path = '%s?%s' % (path, urlencode(query))
+    request = request_factory.get(path)
+    request.user = user
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+    match = resolve(request.path_info)
+    response = match.func(request, *match.args, **match.kwargs)
+    if hasattr(response, 'render'):
+        response.render()
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    if response.status_code != 200:
+        raise RuntimeError("GET %s returned %d" % (
+            path, response.status_code))
+    return response
+
+
+def get_workloads(provider, user, at_time=None):
+    """
+    Returns the list of ``(name, func)`` to measure when *user*,
+    a manager of *provider*, exercises the site.
+    """
+    #pylint:disable=too-many-locals
+    request_factory = RequestFactory(SERVER_NAME='localhost')
+    query = {'ends_at': at_time.isoformat()} if at_time else None
+    customer = Subscription.objects.filter(
+        plan__organization=provider).order_by('pk').values_list(
+        'organization', flat=True).first()
+    coupon = Coupon.objects.filter(
+        organization=provider).order_by('pk').values_list(
+        'code', flat=True).first()
+    report = BalanceLine.objects.order_by('pk').values_list(
+        'report', flat=True).first()
+
+    workloads = [
+        ('ledger.get_balance', lambda: Transaction.objects.get_balance(
+            organization=provider, account=Transaction.FUNDS)),
+        ('ledger.get_balance.like_account',
+            lambda: Transaction.objects.get_balance(
+                like_account=Transaction.RECEIVABLE)),
+        ('renewals.recognize_income', lambda: recognize_income(
+            until=at_time, dry_run=True)),
+        ('renewals.create_charges_for_balance',
+            lambda: create_charges_for_balance(until=at_time, dry_run=True)),
+    ]
+    if customer:
+        workloads += [
+            ('ledger.get_statement_balances',
+             lambda: Transaction.objects.get_statement_balances(
+                 customer, until=at_time))]
+
+    # Permission decorators
+    request = request_factory.get('/')
+    request.user = user
+    for name in ('fail_direct', 'fail_provider', 'fail_provider_only',
+                 'fail_subscription'):
+        workloads += [('decorators.%s' % name,
+            lambda fail=getattr(decorators, name): fail(
+                request, organization=provider))]
+    workloads += [('decorators.fail_self_provider',
+        lambda: decorators.fail_self_provider(request, user=user))]
+
+    # Metrics APIs and CSV downloads
+    organization_urls = (
+        'saas_api_subscribed', 'saas_api_balances', 'saas_api_churned',
+        'saas_api_customer', 'saas_api_metrics_plans', 'saas_api_revenue',
+        'saas_subscriber_pipeline_download_subscribed',
+        'saas_subscriber_pipeline_download_churned',
+        'saas_metrics_coupons_download')
+    paths = [(url_name, reverse(url_name, kwargs={'organization': provider}))
+        for url_name in organization_urls]
+    paths += [(url_name, reverse(url_name)) for url_name in (
+        'saas_transactions_download',
+        'saas_subscriber_pipeline_download_registered')]
+    if coupon:
+        paths += [('saas_api_coupon_uses', reverse('saas_api_coupon_uses',
+            kwargs={'organization': provider, 'coupon': coupon}))]
+    if report:
+        paths += [(url_name, reverse(url_name, kwargs={'report': report}))
+            for url_name in ('saas_api_broker_balances',
+                'saas_balances_download')]
+    for url_name, path in paths:
+        workloads += [('views.%s' % url_name,
+            lambda path=path: _call_view(
+                request_factory, user, path, query=query))]
+    return workloads
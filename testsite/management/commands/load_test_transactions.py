@@ -28,7 +28,6 @@ from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.db.utils import IntegrityError
 from django.template.defaultfilters import slugify
-from django.utils.timezone import utc
 
 from saas.backends.razorpay_processor import RazorpayBackend
 from saas.models import Transaction
@@ -154,6 +153,12 @@ class Command(BaseCommand):
             action='store', dest='provider',
             default=settings.SAAS['BROKER']['GET_INSTANCE'],
             help='create sample subscribers on this provider')
+        parser.add_argument('--seed', action='store', dest='seed',
+            type=int, default=None,
+            help='seed the random generator to create reproducible datasets')
+        parser.add_argument('--at-time', action='store', dest='at_time',
+            default=None,
+            help='generate transactions up to this date/time')
 
     def handle(self, *args, **options):
         #pylint: disable=too-many-locals,too-many-statements
@@ -163,7 +168,9 @@ class Command(BaseCommand):
 
         RazorpayBackend.bypass_api = True
 
-        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        if options.get('seed') is not None:
+            random.seed(options['seed'])
+        now = datetime_or_now(options.get('at_time'))
         from_date = now
         from_date = datetime.datetime(
             year=from_date.year, month=from_date.month, day=1)
@@ -177,7 +184,7 @@ class Command(BaseCommand):
             nb_new_customers = random.randint(0, 9)
             for _ in range(nb_new_customers):
                 queryset = Plan.objects.filter(
-                    organization=provider, period_amount__gt=0)
+                    organization=provider, period_amount__gt=0).order_by('pk')
                 plan = queryset[random.randint(0, queryset.count() - 1)]
                 created = False
                 trials = 0
@@ -207,7 +214,7 @@ class Command(BaseCommand):
             # Insert some churn in %
             churn_rate = 2
             all_subscriptions = Subscription.objects.filter(
-                plan__organization=provider)
+                plan__organization=provider).order_by('pk')
             nb_churn_customers = (all_subscriptions.count()
                 * churn_rate // 100)
             subscriptions = random.sample(list(all_subscriptions),
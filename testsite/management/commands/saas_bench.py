@@ -0,0 +1,121 @@
+# Copyright (c) 2018, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Runs benchmarks on the ledger, metrics and renewals hot paths
+and prints the wall time, number of SQL queries and peak memory
+of each workload as JSON.
+
+The database is first loaded with a deterministic synthetic dataset
+of the requested ``--scale`` (small: 10k, medium: 1M, large: 10M
+transactions) unless ``--no-populate`` is specified.
+"""
+
+import json, logging
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from saas.models import Organization
+from saas.settings import MANAGER
+from saas.utils import datetime_or_now
+
+from ...bench import run_benchmarks
+from ...bench.datasets import SCALES, populate
+from ...bench.workloads import get_workloads
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Benchmark the ledger, metrics and renewals hot paths."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', action='store', dest='scale',
+            default='small', choices=sorted(SCALES.keys()),
+            help='size of the synthetic dataset')
+        parser.add_argument('--nb-transactions', action='store',
+            dest='nb_transactions', type=int, default=None,
+            help='number of transactions in the dataset (overrides --scale)')
+        parser.add_argument('--seed', action='store', dest='seed',
+            type=int, default=0,
+            help='seed used to generate the synthetic dataset')
+        parser.add_argument('--no-populate', action='store_false',
+            dest='populate', default=True,
+            help='run the benchmarks on the database as is')
+        parser.add_argument('--at-time', action='store', dest='at_time',
+            default=None,
+            help='date/time at which the dataset and reports end')
+        parser.add_argument('--provider', action='store', dest='provider',
+            default=settings.SAAS['BROKER']['GET_INSTANCE'],
+            help='provider to run the benchmarks for')
+        parser.add_argument('--user', action='store', dest='user',
+            default=None,
+            help='user (manager of the provider) making the requests')
+        parser.add_argument('--repeat', action='store', dest='repeat',
+            type=int, default=1,
+            help='number of runs per workload (best wall time is reported)')
+        parser.add_argument('--only', action='append', dest='only',
+            default=None,
+            help='only run workloads whose name starts with this prefix')
+        parser.add_argument('--output', action='store', dest='output',
+            default=None,
+            help='write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        at_time = datetime_or_now(options['at_time'])
+        provider = Organization.objects.get(slug=options['provider'])
+        nb_transactions = options['nb_transactions']
+        if nb_transactions is None:
+            nb_transactions = SCALES[options['scale']]
+        if options['populate']:
+            populate(provider, nb_transactions,
+                seed=options['seed'], at_time=at_time)
+
+        user_model = get_user_model()
+        if options['user']:
+            user = user_model.objects.get(username=options['user'])
+        else:
+            user = user_model.objects.filter(
+                role__organization=provider,
+                role__role_description__slug=MANAGER).order_by('pk').first()
+
+        results = run_benchmarks(get_workloads(provider, user, at_time),
+            repeat=options['repeat'], only=options['only'])
+        report = {
+            'at_time': at_time.isoformat(),
+            'database': connection.vendor,
+            'nb_transactions': nb_transactions,
+            'seed': options['seed'],
+            'results': results
+        }
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+        else:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))